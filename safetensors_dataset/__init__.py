@@ -2,6 +2,21 @@ from .dict_dataset import SafetensorsDataset
 from .safetensors_dict import SafetensorsDict
 from .sequence_dataset import SequenceSafetensorsDataset
 from .loading import load_safetensors
+from .writer import SafetensorsDatasetWriter
+from .samplers import ShardAwareSampler, LengthBucketedBatchSampler
+from .streaming import StreamingSafetensorsDataset
+from .prefetch import PrefetchLoader
 from .version import __version__
 
-__all__ = ["SafetensorsDataset", "SafetensorsDict", "SequenceSafetensorsDataset","load_safetensors", "__version__"]
+__all__ = [
+    "SafetensorsDataset",
+    "SafetensorsDict",
+    "SequenceSafetensorsDataset",
+    "SafetensorsDatasetWriter",
+    "ShardAwareSampler",
+    "LengthBucketedBatchSampler",
+    "StreamingSafetensorsDataset",
+    "PrefetchLoader",
+    "load_safetensors",
+    "__version__",
+]
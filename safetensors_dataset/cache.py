@@ -0,0 +1,229 @@
+import enum
+import hashlib
+import os
+import pickle
+import sys
+import time
+import types
+import warnings
+import weakref
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Mapping, Optional, Sequence, Union
+
+import torch
+
+from safetensors_dataset.utils import _LazyRows, _compact_value
+from safetensors_dataset.version import __version__
+
+
+class _NotFingerprintable(TypeError):
+    pass
+
+
+# the datasets of this process that are served from cache entries, by the path of the entry,
+# these entries are not evicted, as pickling the datasets re-opens their files
+_served_entries: "weakref.WeakValueDictionary[Path, Any]" = weakref.WeakValueDictionary()
+
+
+def _hash_tensor(h, tensor: torch.Tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    h.update(f"tensor {tensor.dtype} {tuple(tensor.shape)}".encode())
+    h.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+
+
+def _hash_value(h, value: Any):
+    # content hash of a value of the dataset, views are compacted so that only their own elements are hashed
+    if isinstance(value, _LazyRows):
+        value = value[:]
+    value = _compact_value(value)
+    if not isinstance(value, torch.Tensor):
+        # values that are not tensors, f. e. the tuples of the rows of a shard, are hashed by their elements
+        if not isinstance(value, Sequence) or isinstance(value, (str, bytes)):
+            raise _NotFingerprintable(f"Cannot fingerprint a value of type {type(value).__qualname__}")
+        h.update(f"sequence {len(value)}".encode())
+        for elem in value:
+            _hash_object(h, elem, set())
+    elif value.is_nested:
+        h.update(b"nested")
+        _hash_tensor(h, value._nested_tensor_size())
+        _hash_tensor(h, value.values())
+    elif value.is_sparse:
+        h.update(f"sparse {tuple(value.shape)}".encode())
+        _hash_tensor(h, value._indices())
+        _hash_tensor(h, value._values())
+    else:
+        _hash_tensor(h, value)
+
+
+def _hash_code(h, code: types.CodeType, seen: set[int]):
+    # file names and line numbers are left out, moving a function does not change its fingerprint
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames, code.co_freevars, code.co_argcount)).encode())
+    _hash_object(h, code.co_consts, seen)
+
+
+def _global_names(code: types.CodeType) -> set[str]:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _hash_function(h, func: types.FunctionType, seen: set[int]):
+    h.update(f"function {func.__module__}.{func.__qualname__}".encode())
+    if id(func) in seen:
+        # recursive functions are only hashed once
+        return
+    seen.add(id(func))
+    _hash_code(h, func.__code__, seen)
+    _hash_object(h, func.__defaults__, seen)
+    _hash_object(h, func.__kwdefaults__, seen)
+    for cell in func.__closure__ or ():
+        try:
+            contents = cell.cell_contents
+        except ValueError:
+            contents = None
+        _hash_object(h, contents, seen)
+    for name in sorted(_global_names(func.__code__)):
+        if name in func.__globals__:
+            h.update(f"global {name}".encode())
+            _hash_object(h, func.__globals__[name], seen)
+
+
+def _hash_object(h, obj: Any, seen: set[int]):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, enum.Enum, torch.dtype, torch.device)):
+        h.update(f"{type(obj).__qualname__} {obj!r}".encode())
+    elif isinstance(obj, torch.Tensor):
+        _hash_value(h, obj)
+    elif isinstance(obj, types.CodeType):
+        _hash_code(h, obj, seen)
+    elif isinstance(obj, types.FunctionType):
+        _hash_function(h, obj, seen)
+    elif isinstance(obj, types.MethodType):
+        _hash_function(h, obj.__func__, seen)
+        _hash_object(h, obj.__self__, seen)
+    elif isinstance(obj, partial):
+        h.update(b"partial")
+        _hash_object(h, (obj.func, obj.args, obj.keywords), seen)
+    elif isinstance(obj, (types.ModuleType, types.BuiltinFunctionType, type)):
+        h.update(f"{type(obj).__qualname__} {getattr(obj, '__module__', '')}.{obj.__name__}".encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__qualname__} {len(obj)}".encode())
+        for elem in obj:
+            _hash_object(h, elem, seen)
+    elif isinstance(obj, Mapping):
+        h.update(f"mapping {len(obj)}".encode())
+        for key in sorted(obj.keys(), key=repr):
+            _hash_object(h, key, seen)
+            _hash_object(h, obj[key], seen)
+    elif isinstance(obj, (set, frozenset)):
+        # the order of sets of strings changes between interpreters
+        h.update(f"set {len(obj)}".encode())
+        for elem in sorted(obj, key=repr):
+            _hash_object(h, elem, seen)
+    elif callable(obj) and hasattr(obj, "__dict__"):
+        # callable instances are fingerprinted by their __call__ and their attributes
+        _hash_object(h, type(obj), seen)
+        _hash_object(h, type(obj).__call__, seen)
+        _hash_object(h, vars(obj), seen)
+    else:
+        try:
+            h.update(pickle.dumps(obj))
+        except Exception as e:
+            raise _NotFingerprintable(f"Cannot fingerprint {type(obj).__qualname__}: {e}") from e
+
+
+def _hash_dataset(h, dataset):
+    if dataset._mmap_path is not None:
+        # memory-mapped datasets are identified by their file instead of their contents
+        path = Path(dataset._mmap_path).resolve()
+        stat = path.stat()
+        h.update(f"file {path} {stat.st_size} {stat.st_mtime_ns} {dataset._mmap_rows!r}".encode())
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            h.update(f.read(header_size))
+        h.update(repr(sorted(dataset.keys())).encode())
+        return
+    for key in sorted(dataset.keys()):
+        h.update(f"key {key}".encode())
+        _hash_value(h, dataset.dataset[key])
+
+
+def _map_fingerprint(dataset, func: Callable, **arguments) -> Optional[str]:
+    """
+    Fingerprint of the output of `dataset.map(func, **arguments)`, or None if `func` cannot be fingerprinted
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{__version__} {sys.version_info[:2]}".encode())
+    try:
+        _hash_dataset(h, dataset)
+        _hash_object(h, func, set())
+        _hash_object(h, arguments, set())
+    except _NotFingerprintable as e:
+        warnings.warn(f"Not caching the output of map(): {e}")
+        return None
+    return h.hexdigest()
+
+
+def _map_cache_path(cache_dir: Union[str, Path], fingerprint: str) -> Path:
+    return Path(cache_dir).resolve() / f"map-{fingerprint}.safetensors"
+
+
+def _lookup_map_cache(cache_dir: Union[str, Path], fingerprint: str) -> Optional[Path]:
+    path = _map_cache_path(cache_dir, fingerprint)
+    try:
+        _touch(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def _serve_from_map_cache(path: Path, dataset):
+    _served_entries[path] = dataset
+    return dataset
+
+
+def _touch(path: Path):
+    # the modification time orders the entries for eviction, the file system
+    # would set it from a clock that is too coarse to order quick successive uses
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def _store_in_map_cache(cache_dir: Union[str, Path], fingerprint: str, dataset, max_size: int) -> Optional[Path]:
+    """
+    Save `dataset` as the entry of `fingerprint`, then evict the least recently used entries
+    until the entries take up at most `max_size` bytes. Returns None if `dataset` cannot be saved.
+    Entries served by datasets of this process are kept, entries used by other processes are not tracked.
+    """
+    path = _map_cache_path(cache_dir, fingerprint)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        dataset.save_to_file(tmp_path)
+    except (ValueError, TypeError, RuntimeError, OSError) as e:
+        tmp_path.unlink(missing_ok=True)
+        warnings.warn(f"Not caching the output of map(): {e}")
+        return None
+    os.replace(tmp_path, path)
+    _touch(path)
+
+    entries = []
+    for entry in path.parent.glob("map-*.safetensors"):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, entry))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total_size <= max_size:
+            break
+        elif entry == path or entry in _served_entries:
+            continue
+        entry.unlink(missing_ok=True)
+        total_size -= size
+    return path
@@ -1,3 +1,4 @@
+import copy
 import gc
 import json
 import warnings
@@ -18,12 +19,24 @@ import torch.utils.data
 from typing_extensions import Self
 
 from safetensors_dataset.version import __version__
+from safetensors_dataset.cache import (
+    _map_fingerprint, _lookup_map_cache, _store_in_map_cache, _serve_from_map_cache,
+)
+from safetensors_dataset.encoding import (
+    encoding_spec_t, _encode_pack, _decoded_storage, _encode_chunked, _ChunkedTensor,
+)
 from safetensors_dataset.utils import (
     get_torch_dtype_from_str,
     TensorLayout,
-    _map_batch_into_dataset, _map_into_dataset, slice_tensor, _load_safetensors_metadata, _apply_function_to_iterable,
-    _maybe_wrap_index, _CHECK_INVARIANTS,
+    _map_into_dataset, _apply_transforms, _unbind_batch, slice_tensor, _load_safetensors_metadata, _apply_function_to_iterable,
+    _maybe_wrap_index, _CHECK_INVARIANTS, _LazySafetensorsStorage, _PrefixedStorage, _sparse_coo_tensor_from_storage,
+    _share_memory_of_value, _index_tensor, _gather_nested_tensor, _gather_sparse_tensor, _gather_value,
+    _collate_gathered_batch, NestedBatchLayout, _concat_gathered_values, _apply_function_in_processes,
+    _resolve_row_range, _nested_tensor_rows_from_storage, _sparse_coo_tensor_rows_from_storage, _clone_value,
+    _LazyRows, _sparse_indices_are_coalesced, _compact_value, _shard_directory, _save_shard_index,
+    _value_is_shared,
 )
+from safetensors_dataset.writer import SafetensorsDatasetWriter
 
 pack_tensor_t = dict[str, torch.Tensor]
 pack_metadata_t = dict[str, Any] | None
@@ -36,7 +49,13 @@ config = {
     # split into multiple files, possibly improving
     # performance as file handles are not shared and
     # thus are smaller
-    "shards_into_separate_files": False
+    "shards_into_separate_files": False,
+    # number of decoded chunks kept in memory
+    # for every key that is stored in chunks
+    "chunk_cache_size": 16,
+    # maximum number of bytes taken up by the
+    # outputs of map() in a cache directory
+    "map_cache_size": 10 * 2 ** 30,
 }
 
 
@@ -59,8 +78,15 @@ def _check_is_tensor(key: str, value: Any) -> torch.Tensor:
     raise ValueError(f"Key {key} must be a tensor, but is a {type(value)}")
 
 def _get_items_from_tensor(key: str, tensor: torch.Tensor, indices: list[int]):
-    if isinstance(tensor, Sequence) or tensor.is_nested or tensor.is_sparse:
+    if isinstance(tensor, _LazyRows):
+        tensor = tensor.gather(_index_tensor(indices, len(tensor)))
+        indices = list(range(len(indices)))
+    if isinstance(tensor, Sequence):
         return [_check_is_tensor(key, tensor[i]) for i in indices]
+    elif tensor.is_nested:
+        return _gather_nested_tensor(tensor, _index_tensor(indices, tensor.size(0))).unbind(0)
+    elif tensor.is_sparse:
+        return _gather_sparse_tensor(tensor, _index_tensor(indices, tensor.size(0))).unbind(0)
     return tensor[indices]
 
 def _get_len_of_item(i):
@@ -101,9 +127,76 @@ class DatasetIterator:
 class SafetensorsDataset(torch.utils.data.Dataset):
     dataset: MutableMapping[str, list[Any] | torch.Tensor]
     layout: dict[str, bool]
+    # set if the dataset is served from a memory-mapped file,
+    # worker processes then re-open the file instead of copying the tensors
+    _mmap_path: Optional[Path]
+    _mmap_rows: Optional[slice]
+    # keyword arguments to get_batch() if __getitems__ returns a single batch
+    _batch_output: Optional[dict[str, Any]]
+    # applied to every batch that is returned, see with_transform()
+    _transforms: tuple[Callable[[dict[str, Any]], dict[str, Any]], ...]
 
     def __init__(self, dataset=None, preprocess=False):
         self.dataset = _map_into_dataset(dataset or {}) if preprocess else dataset
+        self._mmap_path = None
+        self._mmap_rows = None
+        self._batch_output = None
+        self._transforms = ()
+
+    def share_memory(self) -> Self:
+        """
+        Move all tensors of the dataset into shared memory, so that DataLoader worker processes
+        access the same memory instead of each receiving a private copy of the dataset.
+        Memory-mapped datasets already share the page cache and are left untouched.
+        """
+        if self._mmap_path is None:
+            self.dataset = {key: _share_memory_of_value(value) for key, value in self.dataset.items()}
+        return self
+
+    def __getstate__(self):
+        if self._mmap_path is not None:
+            state = {key: value for key, value in self.__dict__.items() if key != "dataset"}
+            state["columns"] = tuple(self.dataset.keys())
+            return state
+        # the default reduction of nested tensors copies the buffer when unpickling,
+        # so pass their components separately to keep sharing the memory
+        state = dict(self.__dict__)
+        # views of a larger storage, f. e. shards created with shard(copy=False), would pickle the whole storage,
+        # unless it is in shared memory and only a handle to it is passed
+        state["dataset"] = {
+            key: value if _value_is_shared(value) else _compact_value(value)
+            for key, value in self.dataset.items()
+        }
+        state["nested"] = {
+            key: (
+                value.values(),
+                value._nested_tensor_size(),
+                value._nested_tensor_strides(),
+                value._nested_tensor_storage_offsets(),
+            )
+            for key, value in state["dataset"].items()
+            if isinstance(value, torch.Tensor) and value.is_nested
+        }
+        for key in state["nested"].keys():
+            del state["dataset"][key]
+        return state
+
+    def __setstate__(self, state):
+        if "dataset" not in state:
+            dataset = self.load_from_file(
+                state["_mmap_path"],
+                mmap=True,
+                columns=state.pop("columns", None),
+                rows=state.get("_mmap_rows"),
+            )
+            state = dict(dataset.__dict__) | state
+        else:
+            nested = state.pop("nested", dict())
+            state["dataset"].update({
+                key: torch._nested_view_from_buffer(*components)
+                for key, components in nested.items()
+            })
+        self.__dict__.update(state)
 
     def __contains__(self, item: str):
         return item in self.dataset
@@ -112,7 +205,16 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         self,
         chunk_size: int = 5000,
         preprocess_if_unprocessed: bool = True,
+        copy: bool = True,
     ) -> "ShardedSafetensorsDataset | SafetensorsDataset":
+        """
+        Split the dataset into shards of `chunk_size` rows.
+
+        With `copy`, every shard receives its own copy of its rows, and the tensors of this dataset are released
+        while sharding. Otherwise, the shards are views of the tensors of this dataset, which is left intact, and
+        sharding only splits the sizes and offsets of the rows (sparse shards copy their indices, as the rows
+        are renumbered). The views are compacted when the shards are saved.
+        """
         if len(self) <= chunk_size:
             raise ValueError(f"Dataset size is smaller than chunk size ({len(self)} < {chunk_size})")
 
@@ -125,9 +227,11 @@ class SafetensorsDataset(torch.utils.data.Dataset):
             for _ in range(num_chunks)
         )
 
+        if copy:
+            self._mmap_path = None
         keys = set(self.dataset.keys())
         for key in keys:
-            value = self.dataset.pop(key)
+            value = self.dataset.pop(key) if copy else self.dataset[key]
             if isinstance(value, Iterable) and not isinstance(value, torch.Tensor):
                 chunks_of_lists = more_itertools.batched(value, n=chunk_size, strict=False)
                 for pos, chunk in enumerate(chunks_of_lists):
@@ -139,10 +243,24 @@ class SafetensorsDataset(torch.utils.data.Dataset):
                 if not is_nested and not is_sparse:
                     # medium easy path, just slice/chunk the tensor
                     chunks = torch.split(tensor, chunk_size, dim=0)
-                    # clone here, so that we can delete the original tensor
-                    chunks = tuple(chunk.clone() for chunk in chunks)
-                    del tensor  # release memory
-                    gc.collect()
+                    if copy:
+                        # clone here, so that we can delete the original tensor
+                        chunks = tuple(chunk.clone() for chunk in chunks)
+                        del tensor  # release memory
+                        gc.collect()
+                elif is_nested and not is_sparse and not copy:
+                    if type(tensor) is not torch.Tensor:
+                        raise NotImplementedError("nested", type(tensor))
+                    # the storage offsets are relative to the whole buffer, so every shard keeps a view of it
+                    values = tensor.values()
+                    chunks = tuple(
+                        torch._nested_view_from_buffer(values, size_chunk, stride_chunk, storage_offset_chunk)
+                        for size_chunk, stride_chunk, storage_offset_chunk in zip(
+                            torch.split(tensor._nested_tensor_size(), chunk_size, dim=0),
+                            torch.split(tensor._nested_tensor_strides(), chunk_size, dim=0),
+                            torch.split(tensor._nested_tensor_storage_offsets(), chunk_size, dim=0),
+                        )
+                    )
                 elif is_nested and not is_sparse:
                     if type(tensor) is torch.Tensor:
                         sizes = tensor._nested_tensor_size()
@@ -174,50 +292,33 @@ class SafetensorsDataset(torch.utils.data.Dataset):
                     else:
                         raise NotImplementedError("nested", type(tensor))
                 elif is_sparse and not is_nested:
+                    if tensor.layout != torch.sparse_coo:
+                        raise NotImplementedError(tensor.layout)
+                    # the indices of a coalesced tensor are sorted by row, so every chunk is a contiguous
+                    # range of them, which is found with a single binary search for all chunk boundaries
+                    tensor = tensor.coalesce()
                     indices = tensor._indices()
                     values = tensor._values()
-                    if indices.numel() == 0:
-                        if tensor.layout == torch.sparse_coo:
-                            chunks = tuple(
-                                torch.sparse_coo_tensor(
-                                    indices,
-                                    values,
-                                    size=(chunk_size if pos + 1 != num_chunks else remainder,) + tensor.shape[1:],
-                                    check_invariants=_CHECK_INVARIANTS,
-                                    is_coalesced=tensor.is_coalesced()
-                                )
-                                for pos in range(num_chunks)
-                            )
-                        else:
-                            raise NotImplementedError(tensor.layout)
-                    elif tensor.layout == torch.sparse_coo:
-                        chunks = tuple()
-                        indices_dim0 = indices[0]
-                        for pos in range(num_chunks):
-                            chunk_start = pos * chunk_size
-                            chunk_end = (pos + 1) * chunk_size
-                            chunk_mask = (indices_dim0 >= chunk_start) & (indices_dim0 < chunk_end)
-                            chunk_indices_dim0 = indices_dim0[chunk_mask]
-                            chunk_values = values[chunk_mask]
-                            assert chunk_values.numel() == chunk_indices_dim0.numel()
-                            if chunk_indices_dim0.numel() == 0:
-                                raise NotImplementedError
-
-                            chunk_indices = indices[:, chunk_mask]
-                            chunk_indices[0] -= chunk_start
-                            chunks = chunks + (torch.sparse_coo_tensor(
-                                chunk_indices.clone(),
-                                chunk_values.clone(),
-                                (chunk_size if pos + 1 != num_chunks else remainder,) + tensor.shape[1:],
-                                check_invariants=_CHECK_INVARIANTS,
-                                is_coalesced=tensor.is_coalesced()
-                            ),)
-                        del tensor
-                        del indices
-                        del values
+                    chunk_starts = torch.arange(num_chunks + 1, dtype=indices.dtype) * chunk_size
+                    boundaries = torch.searchsorted(indices[0].contiguous(), chunk_starts)
+                    counts = boundaries.diff().tolist()
+                    chunk_indices = torch.cat((indices[:1] % chunk_size, indices[1:]))
+                    chunks = tuple(
+                        torch.sparse_coo_tensor(
+                            chunk_indices_of_pos.clone() if copy else chunk_indices_of_pos,
+                            chunk_values.clone() if copy else chunk_values,
+                            (chunk_size if pos + 1 != num_chunks or not remainder else remainder,) + tensor.shape[1:],
+                            check_invariants=_CHECK_INVARIANTS,
+                            is_coalesced=True,
+                        )
+                        for pos, (chunk_indices_of_pos, chunk_values) in enumerate(zip(
+                            torch.split(chunk_indices, counts, dim=1),
+                            torch.split(values, counts, dim=0),
+                        ))
+                    )
+                    if copy:
+                        del tensor, indices, values, chunk_indices
                         gc.collect()
-                    else:
-                        raise NotImplementedError(tensor.layout)
                 else:
                     raise ValueError(f"Tensor cannot be nested and sparse")
 
@@ -232,21 +333,34 @@ class SafetensorsDataset(torch.utils.data.Dataset):
 
     def filter(
         self,
-        filter_fn: Callable[[dict[str, torch.Tensor]], bool],
-        use_tqdm: bool = True
+        filter_fn: Callable[[dict[str, torch.Tensor]], bool | Sequence[bool] | torch.Tensor],
+        use_tqdm: bool = True,
+        batched: bool = False,
+        batch_size: int = 1,
     ):
-        filtered_dataset = dict({k: list() for k in self.dataset.keys()})
-        from_to = range if not use_tqdm else partial(trange, leave=False)
-        for i in from_to(len(self)):
-            elem = self.__getitem__unsafe(i)
-            if filter_fn(elem):
-                for k in filtered_dataset.keys():
-                    filtered_dataset[k].append(elem[k])
-        return SafetensorsDataset(filtered_dataset)
+        """
+        Keep the rows for which filter_fn returns True. With batched=True, filter_fn receives batches of
+        batch_size rows and returns a boolean mask over the rows of the batch.
+        """
+        if batched:
+            masks = list()
+            batches = self._transpose(batched=True, batch_size=batch_size)
+            for start in tqdm(range(0, len(self), batch_size), disable=not use_tqdm, leave=False):
+                mask = torch.as_tensor(filter_fn(next(batches)), dtype=torch.bool).reshape(-1)
+                expected = min(batch_size, len(self) - start)
+                if mask.numel() != expected:
+                    raise ValueError(f"filter_fn must return a mask with {expected} elements, got {mask.numel()}")
+                masks.append(mask)
+            indices = torch.cat(masks).nonzero().squeeze(1) if masks else torch.zeros((0,), dtype=torch.long)
+        else:
+            from_to = range if not use_tqdm else partial(trange, leave=False)
+            indices = [i for i in from_to(len(self)) if filter_fn(self.__getitem__unsafe(i))]
+        return self.select(indices)
 
     def pack(self) -> Self:
         for key in self.keys():
             if isinstance(self[key], list):
+                self._mmap_path = None
                 if any(elem.is_sparse for elem in self[key]):
                     self.dataset[key] = torch.stack(self.dataset[key], dim=0).coalesce()
                     continue
@@ -264,9 +378,69 @@ class SafetensorsDataset(torch.utils.data.Dataset):
     def __getitem__(self, item: int | str) -> dict[str, torch.Tensor] | torch.Tensor:
         if isinstance(item, str):
             return self.dataset[item]
+        if self._transforms:
+            return _unbind_batch(self.get_batch([item], nested_layout="nested"), 1)[0]
         return {k: _check_is_tensor(k, v[item]) for k, v in self.dataset.items()}
 
+    def set_batch_output(
+        self,
+        enabled: bool = True,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> Self:
+        """
+        Let __getitems__ return a single batch as returned by get_batch() instead of a list of samples.
+        Use it with `collate_fn=torch.utils.data.default_convert` in a DataLoader.
+        """
+        self._batch_output = {"nested_layout": nested_layout, "padding_value": padding_value} if enabled else None
+        return self
+
+    def set_transform(self, transform: Optional[Callable[[dict[str, Any]], dict[str, Any]]]) -> Self:
+        """
+        Replace the transforms of the dataset with `transform`, or remove them if it is None. See with_transform().
+        """
+        self._transforms = (transform,) if transform is not None else ()
+        return self
+
+    def with_transform(self, transform: Callable[[dict[str, Any]], dict[str, Any]]) -> Self:
+        """
+        Return a dataset over the same tensors that applies `transform` after the transforms of this dataset.
+
+        The transforms are applied lazily to every batch that is returned by __getitem__, __getitems__ and
+        get_batch(), all transforms of the chain in one pass over the batch. They receive the batch as returned by
+        get_batch() and return the transformed batch. If samples are returned instead of a batch, the samples are
+        gathered into a batch with nested keys as nested tensors, and the transformed batch is split into samples
+        again, every value of it must have one row per sample. Accessing a key and map(), filter(), select() or
+        saving the dataset use the untransformed tensors.
+        """
+        dataset = copy.copy(self)
+        dataset.dataset = dict(self.dataset)
+        dataset._transforms = self._transforms + (transform,)
+        return dataset
+
+    def get_batch(
+        self,
+        indices: Sequence[int] | torch.Tensor,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> dict[str, Any]:
+        """
+        Gather the elements at `indices` into a single batch. Dense keys are stacked and sparse keys returned as one
+        sparse tensor. Nested keys are padded with `padding_value`, with the lengths of the rows in `key.lengths`, or
+        returned as a jagged or nested tensor depending on `nested_layout`.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        batch = {key: _gather_value(key, value, indices) for key, value in self.dataset.items()}
+        return _apply_transforms(self._transforms, _collate_gathered_batch(batch, nested_layout, padding_value))
+
     def __getitems__(self, indices: list[int]):
+        if self._batch_output is not None:
+            return self.get_batch(indices, **self._batch_output)
+        elif self._transforms:
+            return _unbind_batch(self.get_batch(indices, nested_layout="nested"), len(indices))
+        return self._get_samples(indices)
+
+    def _get_samples(self, indices: list[int]) -> list[dict[str, torch.Tensor]]:
         elements_per_key = {k: _get_items_from_tensor(k, v, indices) for k, v in self.dataset.items()}
         return [{k: elements_per_key[k][i] for k in elements_per_key.keys()} for i in range(len(indices))]
 
@@ -287,8 +461,10 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         if self_device == device:
             return self
 
-        device_dataset = {key: value.to(device) for key, value in self.dataset.items()}
-        return self.__class__(device_dataset)
+        device_dataset = self.__class__({key: value.to(device) for key, value in self.dataset.items()})
+        device_dataset._batch_output = self._batch_output
+        device_dataset._transforms = self._transforms
+        return device_dataset
 
     def map(
         self,
@@ -298,7 +474,60 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         use_tqdm: bool = True,
         batched: bool = False,
         batch_size: int = 1,
-    ) -> "SafetensorsDataset":
+        num_proc: Optional[int] = None,
+        output_path: Optional[Union[str, Path]] = None,
+        writer_batch_size: int = 10000,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ) -> "SafetensorsDataset | ShardedSafetensorsDataset":
+        """
+        Apply `func` to every element of the dataset, or to batches of `batch_size` elements if `batched`.
+
+        With `output_path`, the outputs are not kept in memory, but written to a sharded dataset at `output_path`
+        whenever the outputs of `writer_batch_size` elements have been collected, one shard of `writer_batch_size`
+        elements at a time. The memory-mapped dataset is returned, see `SafetensorsDatasetWriter`.
+
+        With `cache_dir`, the output is saved in `cache_dir` under a fingerprint of the dataset (its file and header
+        if it is memory-mapped, its contents otherwise), of `func` (its bytecode, defaults, closure and referenced
+        globals) and of the arguments. If the same map was applied before, the saved output is loaded memory-mapped
+        instead. The least recently used outputs are evicted beyond `config["map_cache_size"]` bytes, except the
+        ones still served by datasets of this process. Outputs that cannot be saved are returned without caching.
+        Evicting an output that another process serves breaks pickling its dataset, which re-opens the file, so
+        processes that share `cache_dir` should not evict each other's outputs while they use them.
+        """
+        if cache_dir is not None:
+            if output_path is not None:
+                raise ValueError("cache_dir cannot be combined with output_path")
+            fingerprint = _map_fingerprint(self, func, info=info, strict=strict, batched=batched, batch_size=batch_size)
+            if fingerprint is not None:
+                if (cached_path := _lookup_map_cache(cache_dir, fingerprint)) is not None:
+                    return _serve_from_map_cache(cached_path, self.__class__.load_from_file(cached_path, mmap=True))
+                dataset = self.map(func, info, strict, use_tqdm, batched, batch_size, num_proc)
+                _store_in_map_cache(cache_dir, fingerprint, dataset, config["map_cache_size"])
+                return dataset
+        if output_path is not None:
+            return _map_to_file(
+                func,
+                self._transpose(batched, batch_size),
+                len(self),
+                batched=batched,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                disable_tqdm=not use_tqdm,
+                output_path=output_path,
+                writer_batch_size=writer_batch_size,
+            )
+        if num_proc is not None and num_proc > 1:
+            dataset = _apply_function_in_processes(
+                func,
+                partial(self._transpose, batched, batch_size),
+                len(self),
+                batched=batched,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                disable_tqdm=not use_tqdm,
+            )
+            return self.__class__(dataset, preprocess=False)
+
         items = self._transpose(batched, batch_size)
         dataset = _apply_function_to_iterable(
             func,
@@ -312,12 +541,13 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         return self.__class__(dataset, preprocess=False)
 
     def select(self, indices: list[int], use_tqdm=False) -> "SafetensorsDataset":
-        select_dataset: MutableMapping[str, torch.Tensor] = {}
-        info = self.info()
-        for pos in tqdm(indices, disable=not use_tqdm, total=len(indices)):
-            entry = {k: v.clone() for k, v in self[pos].items()}
-
-            _map_batch_into_dataset(select_dataset, entry, info, False)
+        # gather every key at once instead of appending row by row,
+        # which copied the accumulated tensors for every selected row
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        select_dataset: MutableMapping[str, torch.Tensor] = {
+            key: _gather_value(key, value, indices)
+            for key, value in tqdm(self.dataset.items(), disable=not use_tqdm, total=len(self.dataset))
+        }
         return self.__class__(select_dataset)
 
     def info(self) -> Mapping[str, TensorLayout]:
@@ -340,6 +570,7 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         }
 
     def rename(self, key: str, new_key: str):
+        self._mmap_path = None
         self.dataset[new_key] = self.dataset[key]
 
     def __add__(self, other: "SafetensorsDataset") -> "SafetensorsDataset":
@@ -354,25 +585,20 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         for key in other.keys():
             if key in self:
                 raise ValueError(f"Duplicate key {key}")
+            self._mmap_path = None
             self.dataset[key] = other.dataset[key]
 
-    def _transpose(self, batched=False, batch_size=0):
+    def _transpose(self, batched=False, batch_size=0, start=0, stop=None):
         keys = self.keys()
+        stop = len(self) if stop is None else stop
         if batched:
-            pos = 0
-            for i in range(0, len(self), batch_size):
-                pos += batch_size
-                yield {
-                    key: slice_tensor(self.dataset[key], slice(i, i+batch_size, None))
-                    for key in keys
-                }
-            if pos < len(self):
+            for i in range(start, stop, batch_size):
                 yield {
-                    key: slice_tensor(self.dataset[key], slice(pos, None, None))
+                    key: slice_tensor(self.dataset[key], slice(i, min(i + batch_size, stop), None))
                     for key in keys
                 }
         else:
-            for i in range(len(self)):
+            for i in range(start, stop):
                 yield {
                     key: self.dataset[key][i] for key in keys
                 }
@@ -424,15 +650,27 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         del self.dataset
 
     @staticmethod
-    def unpack_list_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]):
+    def unpack_list_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ):
         numel = meta.get("numel")
         tensors = list()
-        for elem in range(numel):
-            tensors.append(storage.get(key + str(elem)))
+        for elem in range(numel)[rows or slice(None)]:
+            tensors.append(storage[key + "." + str(elem)])
         return torch.nested.nested_tensor(tensors)
 
     @staticmethod
-    def unpack_nested_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]):
+    def unpack_nested_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ):
         buffer = storage[key + ".buffer"]
         sizes = storage[key + ".sizes"]
         if key + ".strides" in storage:
@@ -442,13 +680,21 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         if key + ".storage_offsets" in storage:
             storage_offsets = storage[key + ".storage_offsets"]
         else:
-            storage_offsets = sizes.cumsum(dim=0).roll(1).squeeze()
+            storage_offsets = sizes.prod(dim=-1).cumsum(dim=0).roll(1)
             storage_offsets[0] = 0
+        if rows is not None:
+            return _nested_tensor_rows_from_storage(buffer, sizes, strides, storage_offsets, rows)
         tensor = torch._nested_view_from_buffer(buffer, sizes, strides, storage_offsets)
         return tensor
 
     @staticmethod
-    def unpack_sparse_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]):
+    def unpack_sparse_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ):
         numel = meta.get("numel")
         if not numel:
             numel = metadata.get("size")
@@ -458,16 +704,16 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         dtype = meta.get("dtype")
         dtype = get_torch_dtype_from_str(dtype)
         if dtype == torch.bool and key + ".indices" not in storage:
-            tensor = storage[key]
-            tensor = torch.sparse_coo_tensor(tensor, torch.ones(tensor.size(-1), dtype=dtype), size=tuple(dims), check_invariants=_CHECK_INVARIANTS)
-            tensor = tensor.coalesce()
+            indices = storage[key]
+            values = torch.ones(indices.size(-1), dtype=dtype)
         else:
             indices = storage[key + ".indices"]
             if key + ".values" not in storage:
                 raise ValueError(f"Need {key}.values to restore sparsely stored tensor")
             values = storage[key + ".values"]
-            tensor = torch.sparse_coo_tensor(indices, values, size=dims, check_invariants=_CHECK_INVARIANTS)
-            tensor = tensor.coalesce()
+        if rows is not None:
+            return _sparse_coo_tensor_rows_from_storage(indices, values, dims, rows, meta.get("coalesced"))
+        tensor = _sparse_coo_tensor_from_storage(indices, values, dims, meta.get("coalesced"))
         return tensor
 
     @staticmethod
@@ -475,20 +721,23 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         pack: pack_tensor_t
         metadata: pack_metadata_t
         if tensor.is_sparse:
+            # coalesced indices are sorted by row, which lets loading skip coalesce()
+            coalesced = tensor.is_coalesced() or _sparse_indices_are_coalesced(tensor._indices(), tensor.shape)
             if tensor.dtype == torch.bool:
                 pack = {
-                    key: tensor._indices()
+                    key: tensor._indices().contiguous()
                 }
             else:
                 pack = {
-                    key + ".values": tensor._values(),
-                    key + ".indices": tensor._indices()
+                    key + ".values": tensor._values().contiguous(),
+                    key + ".indices": tensor._indices().contiguous()
                 }
             metadata = {
                 "sparse": True,
                 "dtype": repr(tensor.dtype),
                 "dims": tensor.shape,
                 "numel": tensor.size(0),
+                "coalesced": coalesced,
             }
             return pack, metadata
         elif tensor.is_nested:
@@ -536,14 +785,18 @@ class SafetensorsDataset(torch.utils.data.Dataset):
             same_size_tensors = list(map(lambda t: torch.sparse_coo_tensor(t._indices(), t._values(), size=sparse_shape, check_invariants=_CHECK_INVARIANTS), tensors))
             sparse_tensor = torch.stack(same_size_tensors, dim=0).coalesce()
             if sparse_tensor.dtype == torch.bool:
-                pack = {key: sparse_tensor._indices()}
+                pack = {key: sparse_tensor._indices().contiguous()}
             else:
-                pack = {key + ".indices": sparse_tensor._indices(), key + ".values": sparse_tensor._values()}
+                pack = {
+                    key + ".indices": sparse_tensor._indices().contiguous(),
+                    key + ".values": sparse_tensor._values().contiguous(),
+                }
             metadata = {
                 "sparse": True,
                 "dims": sparse_tensor.shape,
                 "dtype": repr(sparse_tensor.dtype),
-                "numel": len(tensors)
+                "numel": len(tensors),
+                "coalesced": True,
             }
             return pack, metadata
 
@@ -574,24 +827,38 @@ class SafetensorsDataset(torch.utils.data.Dataset):
             metadata = {"nested": True, "numel": len(tensors)}
             return pack, metadata
 
-    def _save_to_dict(self):
+    def _save_to_dict(
+        self,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ):
         def check_key(key: str):
             if "." in key:
                 raise ValueError(f". is not allowed in a safetensors dataset (used in {key})")
 
+        encodings = encodings or dict()
+        if missing_keys := encodings.keys() - self.dataset.keys():
+            raise KeyError(f"Cannot encode {', '.join(sorted(missing_keys))}, they are not part of the dataset")
         metadata = {"size": len(self), "version": __version__}
         tensors = OrderedDict()
         for k, v in self.dataset.items():
             check_key(k)
 
             pack, pack_metadata = None, None
-            if isinstance(v, torch.Tensor):
+            if isinstance(v, _LazyRows):
+                v = v.gather(torch.arange(len(v)))
+            v = _compact_value(v)
+            if chunk_size is not None and k in encodings:
+                pack, pack_metadata = _encode_chunked(k, v, encodings[k], chunk_size, self.pack_single_tensor)
+            elif isinstance(v, torch.Tensor):
                 pack, pack_metadata = self.pack_single_tensor(k, v)
             elif isinstance(v, Sequence):
                 pack, pack_metadata = self.pack_tensor_list(k, v)
             else:
                 raise ValueError(f"Cannot pack value type {type(v)} for key {k}")
 
+            if k in encodings and chunk_size is None:
+                pack, pack_metadata = _encode_pack(k, pack, pack_metadata, encodings[k])
             if pack is not None:
                 tensors.update(pack)
                 if pack_metadata is not None:
@@ -600,12 +867,36 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         metadata = {k: json.dumps(v) for k, v in metadata.items()}
         return tensors, metadata
 
-    def save_to_file(self, path: Union[str, Path]):
-        tensors, metadata = self._save_to_dict()
+    def save_to_file(
+        self,
+        path: Union[str, Path],
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        """
+        Save the dataset to a safetensors file.
+
+        :param path: the file to write
+        :param encodings: encodings for the tensors of some keys, f. e. `{"input_ids": ("narrow", "zstd")}`.
+            `narrow` stores integers in the smallest dtype that fits their range, `delta` stores the differences
+            of sorted positions (sparse indices, nested offsets or integer tensors along their last dimension),
+            and `zlib`, `zstd` or `lz4` compress the tensors. The encodings are reversed when loading the file.
+        :param chunk_size: store the keys in `encodings` in chunks of `chunk_size` rows that are encoded
+            independently, accessing rows then only decodes the chunks they are part of. The most recently used
+            chunks are cached, see `config["chunk_cache_size"]`
+        """
+        tensors, metadata = self._save_to_dict(encodings, chunk_size)
         safetensors.torch.save_file(tensors, path, metadata=metadata)
 
     @classmethod
-    def _load_from_dict(cls, tensors: dict[str, torch.Tensor], metadata: dict[str, Any]):
+    def _load_from_dict(
+        cls,
+        tensors: Mapping[str, torch.Tensor],
+        metadata: dict[str, Any],
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ):
+        tensors = _decoded_storage(tensors, metadata)
         dataset = {}
         keys = set()
         for k in tensors.keys():
@@ -617,27 +908,76 @@ class SafetensorsDataset(torch.utils.data.Dataset):
             else:
                 keys.add(k)
 
+        if columns is not None:
+            columns = set(columns)
+            if missing_columns := columns - keys:
+                raise KeyError(f"Columns {', '.join(sorted(missing_columns))} are not part of the dataset")
+            keys = columns
+
         for k in keys:
             meta: Mapping[str, Any] = metadata.get(k, dict())
-            if not meta:
-                # load a single tensor
-                tensor = tensors[k]
-            elif meta.get("sparse", False) is True:
-                tensor = cls.unpack_sparse_tensor(k, metadata, meta, tensors)
-            elif meta.get("nested", False) is True:
-                tensor = cls.unpack_nested_tensor(k, metadata, meta, tensors)
-            elif meta.get("list", False) is True:
-                tensor = cls.unpack_list_tensor(k, metadata, meta, tensors)
+            if meta.get("chunked", False) is True:
+                chunk_data = tensors[k + ".chunks"]
+                tensor = _ChunkedTensor(k, meta, chunk_data, cls._unpack_value, config["chunk_cache_size"], rows)
             else:
-                raise ValueError(f"Cannot unpack stored tensor {k} with metadata = {meta}")
+                tensor = cls._unpack_value(k, meta, metadata, tensors, rows)
             dataset[k] = tensor
         return SafetensorsDataset(dataset)
 
     @classmethod
-    def load_from_file(cls, path: Path):
+    def _unpack_value(
+        cls,
+        k: str,
+        meta: Mapping[str, Any],
+        metadata: Mapping[str, Any],
+        tensors: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ):
+        if not meta.keys() - {"encodings"}:
+            # load a single tensor
+            return tensors[k] if rows is None else tensors[k][rows]
+        elif meta.get("sparse", False) is True:
+            return cls.unpack_sparse_tensor(k, metadata, meta, tensors, rows)
+        elif meta.get("nested", False) is True:
+            return cls.unpack_nested_tensor(k, metadata, meta, tensors, rows)
+        elif meta.get("list", False) is True:
+            return cls.unpack_list_tensor(k, metadata, meta, tensors, rows)
+        raise ValueError(f"Cannot unpack stored tensor {k} with metadata = {meta}")
+
+    @classmethod
+    def load_from_file(
+        cls,
+        path: Path,
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ):
+        """
+        Load a dataset from a safetensors file.
+
+        :param path: the file to load
+        :param mmap: do not read the file upfront, but serve all tensors as
+            zero-copy views of the memory-mapped file
+        :param columns: only load these keys of the dataset, the tensors of
+            all other keys are not read from the file
+        :param rows: only load this contiguous range of rows, f. e. the part of
+            the dataset used by one rank in distributed training
+        """
         metadata = _load_safetensors_metadata(path)
-        tensors = safetensors.torch.load_file(path, device="cpu")
-        return cls._load_from_dict(tensors, metadata)
+        if rows is not None:
+            rows = _resolve_row_range(rows, metadata["size"])
+        if mmap or columns is not None or rows is not None:
+            tensors = _LazySafetensorsStorage(path)
+        else:
+            tensors = safetensors.torch.load_file(path, device="cpu")
+        dataset = cls._load_from_dict(tensors, metadata, columns, rows)
+        if mmap:
+            dataset._mmap_path = Path(path)
+            dataset._mmap_rows = rows
+        elif rows is not None:
+            # do not keep the views of the file alive, they would pull in the whole file when pickled
+            dataset.dataset = {key: _clone_value(value) for key, value in dataset.dataset.items()}
+        return dataset
 
     @classmethod
     def from_dict(cls, x: dict[str, torch.Tensor | list[torch.Tensor]], preprocess: bool=False):
@@ -655,28 +995,140 @@ class SafetensorsDataset(torch.utils.data.Dataset):
                     out[k].append(v)
         return cls.from_dict(out, preprocess=preprocess)
 
+def _split_rows_by_shard(shard_offsets: Sequence[int], rows: slice) -> list[tuple[int, slice]]:
+    # the shards overlapping with `rows`, each with the range of its own rows that is part of `rows`
+    shard_rows = [
+        (pos, slice(max(rows.start, start) - start, min(rows.stop, stop) - start))
+        for pos, (start, stop) in enumerate(zip(shard_offsets[:-1], shard_offsets[1:]))
+        if start < rows.stop and rows.start < stop
+    ]
+    return shard_rows or [(0, slice(0, 0))]
+
+
+def _map_to_file(
+    func,
+    iterable,
+    numel: int,
+    batched: bool,
+    batch_size: int,
+    num_proc: Optional[int],
+    disable_tqdm: bool,
+    output_path: Union[str, Path],
+    writer_batch_size: int,
+) -> "ShardedSafetensorsDataset":
+    if num_proc is not None and num_proc > 1:
+        raise ValueError("num_proc cannot be combined with output_path")
+    if writer_batch_size < 1:
+        raise ValueError(f"writer_batch_size must be at least 1, got {writer_batch_size}")
+    with SafetensorsDatasetWriter(output_path, shard_size=writer_batch_size) as writer:
+        _apply_function_to_iterable(
+            func,
+            iterable,
+            numel,
+            batched=batched,
+            batch_size=batch_size,
+            disable_tqdm=disable_tqdm,
+            writer=writer,
+            writer_batch_size=writer_batch_size,
+        )
+    return ShardedSafetensorsDataset.load_from_index(output_path, mmap=True)
+
+
+class _LazyShards(Sequence[SafetensorsDataset]):
+    """
+    Shards stored in separate files, every shard is loaded on first access
+    """
+
+    def __init__(
+        self,
+        shards: Sequence[Union[Path, SafetensorsDataset]],
+        mmap: bool = False,
+        columns: Optional[Sequence[str]] = None,
+    ):
+        self.entries = list(shards)
+        self.mmap = mmap
+        self.columns = columns
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return _LazyShards(self.entries[pos], self.mmap, self.columns)
+        entry = self.entries[pos]
+        if isinstance(entry, Path):
+            entry = SafetensorsDataset.load_from_file(entry, mmap=self.mmap, columns=self.columns)
+            self.entries[pos] = entry
+        return entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __add__(self, other: Sequence[SafetensorsDataset]) -> "_LazyShards":
+        return _LazyShards(self.entries + list(other), self.mmap, self.columns)
+
+
 class ShardedSafetensorsDataset(torch.utils.data.Dataset):
-    shards: tuple[SafetensorsDataset, ...]
+    shards: Sequence[SafetensorsDataset]
+    # position of the first element of every shard, followed by the total size
+    shard_offsets: torch.Tensor
+
+    def __init__(self, shards: Sequence[SafetensorsDataset], shard_offsets: Optional[Sequence[int]] = None):
+        # shards loaded from separate files stay lazy, other sequences are copied so that shards can be appended
+        self.shards: Sequence[SafetensorsDataset] = shards if isinstance(shards, _LazyShards) else tuple(shards)
+        if shard_offsets is None:
+            shard_sizes = torch.tensor([len(shard) for shard in shards], dtype=torch.long)
+            shard_offsets = torch.cat((shard_sizes.new_zeros((1,)), shard_sizes.cumsum(0)))
+        self.shard_offsets = torch.as_tensor(shard_offsets, dtype=torch.long)
+        if self.shard_offsets.numel() != len(shards) + 1:
+            raise ValueError(f"Expected {len(shards) + 1} shard offsets, got {self.shard_offsets.numel()}")
+        self.shard_size = int(self.shard_offsets[1] - self.shard_offsets[0])
+        self._mmap_path: Optional[Path] = None
+        self._mmap_rows: Optional[slice] = None
+        self._batch_output: Optional[dict[str, Any]] = None
+        self._transforms: tuple[Callable[[dict[str, Any]], dict[str, Any]], ...] = ()
 
-    def __init__(self, shards: tuple[SafetensorsDataset, ...]):
-        self.shards: tuple[SafetensorsDataset, ...] = shards
-        self.shard_size = len(shards[0])
+    @classmethod
+    def concat(cls, datasets: Sequence["SafetensorsDataset | ShardedSafetensorsDataset"]) -> "ShardedSafetensorsDataset":
+        """
+        Concatenate datasets of arbitrary sizes into a single sharded dataset without copying any data
+        """
+        shards = tuple()
+        for dataset in datasets:
+            shards = shards + (tuple(dataset.shards) if isinstance(dataset, ShardedSafetensorsDataset) else (dataset,))
+        sharded_dataset = cls(shards[:1])
+        for shard in shards[1:]:
+            sharded_dataset.append_shard(shard)
+        return sharded_dataset
+
+    def append_shard(self, shard: SafetensorsDataset) -> Self:
+        if shard.keys() != self.shards[0].keys():
+            raise ValueError(f"Shard has keys {shard.keys()}, but the dataset has {self.shards[0].keys()}")
+        self._mmap_path = None
+        self.shards = self.shards + (shard,)
+        self.shard_offsets = torch.cat((self.shard_offsets, self.shard_offsets[-1:] + len(shard)))
+        return self
 
     def __contains__(self, item):
         return item in self.shards[0]
 
+    def keys(self) -> set[str]:
+        return self.shards[0].keys()
+
     def __len__(self):
-        return (len(self.shards) - 1) * self.shard_size + (len(self.shards[-1]) if len(self.shards) > 1 else 0)
+        return int(self.shard_offsets[-1])
+
+    def _shard_of(self, indices: torch.Tensor) -> torch.Tensor:
+        return torch.searchsorted(self.shard_offsets, indices, right=True) - 1
 
     def __getitem__(self, item: int | str) -> dict[str, torch.Tensor] | torch.Tensor:
         if isinstance(item, str):
             raise NotImplementedError(f"Cannot access keys for sharded datasets")
         item = _maybe_wrap_index(item, len(self))
-        shard = item // self.shard_size
-        if shard >= len(self.shards) or item >= len(self):
+        if item < 0 or item >= len(self):
             raise IndexError(item)
+        elif self._transforms:
+            return _unbind_batch(self.get_batch([item], nested_layout="nested"), 1)[0]
+        shard = int(self._shard_of(torch.tensor(item)))
         dataset_shard = self.shards[shard].dataset
-        item %= self.shard_size
+        item -= int(self.shard_offsets[shard])
         return {k: v[item] for k, v in dataset_shard.items()}
 
     def __repr__(self):
@@ -689,39 +1141,141 @@ class ShardedSafetensorsDataset(torch.utils.data.Dataset):
         lines.append(")")
         return "".join(lines)
 
+    def share_memory(self) -> Self:
+        if self._mmap_path is None:
+            for shard in self.shards:
+                shard.share_memory()
+        return self
+
+    def __getstate__(self):
+        if self._mmap_path is not None:
+            state = {key: value for key, value in self.__dict__.items() if key != "shards"}
+            state["columns"] = tuple(self.shards[0].keys()) if len(self.shards) > 0 else None
+            return state
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        if "shards" not in state:
+            dataset = self.load_from_file(
+                state["_mmap_path"],
+                mmap=True,
+                columns=state.pop("columns", None),
+                rows=state.get("_mmap_rows"),
+            )
+            state = dict(dataset.__dict__) | state
+        self.__dict__.update(state)
+
     def get_shard(self, pos: Optional[int] = None) -> SafetensorsDataset:
         if pos is None:
             raise NotImplementedError("Cannot shard() a sharded dataset")
         return self.shards[pos]
 
+    def _split_indices_by_shard(
+        self,
+        indices: Sequence[int] | torch.Tensor,
+    ) -> tuple[list[int], list[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Group `indices` by shard. Returns the shards, the indices into every shard and the permutation that restores
+        the original order of the concatenated per-shard results, or None if they are already in order.
+        """
+        indices = _index_tensor(indices, len(self))
+        shard_ids = self._shard_of(indices)
+        offsets = indices - self.shard_offsets[shard_ids]
+        if shard_ids.numel() == 0 or bool(shard_ids[1:].ge(shard_ids[:-1]).all()):
+            order, inverse = None, None
+        else:
+            order = torch.argsort(shard_ids, stable=True)
+            shard_ids, offsets = shard_ids[order], offsets[order]
+            inverse = torch.empty_like(order)
+            inverse[order] = torch.arange(order.numel())
+        shards, counts = torch.unique_consecutive(shard_ids, return_counts=True)
+        return shards.tolist(), list(torch.split(offsets, counts.tolist())), inverse
+
     def __getitems__(self, indices: list[int]):
-        buckets: MutableMapping[int, list[int]] = dict()
-        size = len(self)
-        wrapped_indices = list()
-        for index in indices:
-            wrapped_index = _maybe_wrap_index(index, size)
-            if wrapped_index >= size:
-                raise IndexError(f"Index {index} ({wrapped_index}) is out of range for {self}")
-            wrapped_indices.append(wrapped_index)
-            bucket = wrapped_index // self.shard_size
-            if bucket not in buckets:
-                buckets[bucket] = list()
-            buckets[bucket].append(wrapped_index % self.shard_size)
-
-        bucket_items: MutableMapping[int, list[dict[str, torch.Tensor]]] = dict()
-        for bucket, bucket_indices in buckets.items():
-            bucket_items[bucket] = self.get_shard(bucket).__getitems__(bucket_indices)
-
-        return [
-            bucket_items[index // self.shard_size][buckets[index // self.shard_size].index(index % self.shard_size)]
-            for index in wrapped_indices
-        ]
-
-    def save_to_file(self, path: Union[str, Path]):
+        if self._batch_output is not None:
+            return self.get_batch(indices, **self._batch_output)
+        elif self._transforms:
+            return _unbind_batch(self.get_batch(indices, nested_layout="nested"), len(indices))
+
+        shards, shard_indices, inverse = self._split_indices_by_shard(indices)
+        items = list()
+        for shard, offsets in zip(shards, shard_indices):
+            items.extend(self.get_shard(shard)._get_samples(offsets.tolist()))
+        if inverse is None:
+            return items
+        return [items[pos] for pos in inverse.tolist()]
+
+    def set_batch_output(
+        self,
+        enabled: bool = True,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> Self:
+        self._batch_output = {"nested_layout": nested_layout, "padding_value": padding_value} if enabled else None
+        return self
+
+    def set_transform(self, transform: Optional[Callable[[dict[str, Any]], dict[str, Any]]]) -> Self:
+        self._transforms = (transform,) if transform is not None else ()
+        return self
+
+    def with_transform(self, transform: Callable[[dict[str, Any]], dict[str, Any]]) -> Self:
+        """
+        Return a dataset over the same shards that applies `transform` after the transforms of this dataset,
+        see `SafetensorsDataset.with_transform`
+        """
+        dataset = copy.copy(self)
+        dataset._transforms = self._transforms + (transform,)
+        return dataset
+
+    def get_batch(
+        self,
+        indices: Sequence[int] | torch.Tensor,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> dict[str, Any]:
+        shards, shard_indices, inverse = self._split_indices_by_shard(indices)
+        shard_datasets = [self.get_shard(shard).dataset for shard in shards]
+        batch = dict()
+        for key in self.shards[0].keys():
+            value = _concat_gathered_values(key, [
+                _gather_value(key, dataset[key], offsets)
+                for dataset, offsets in zip(shard_datasets, shard_indices)
+            ])
+            if inverse is not None:
+                value = _gather_value(key, value, inverse)
+            batch[key] = value
+        return _apply_transforms(self._transforms, _collate_gathered_batch(batch, nested_layout, padding_value))
+
+    def save_to_file(
+        self,
+        path: Union[str, Path],
+        separate_files: Optional[bool] = None,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        """
+        Save the dataset to `path`. With `separate_files` (defaults to `config["shards_into_separate_files"]`), every
+        shard is written to its own file next to an `index.json`, in the directory `path` or, if `path` ends with
+        `.safetensors`, in a directory named after the file. See `SafetensorsDataset.save_to_file` for `encodings`
+        and `chunk_size`.
+        """
+        if separate_files is None:
+            separate_files = config["shards_into_separate_files"]
+        if separate_files:
+            directory = _shard_directory(Path(path))
+            directory.mkdir(parents=True, exist_ok=True)
+            for pos in range(len(self.shards)):
+                self.shards[pos].save_to_file(directory / f"shards.{pos}.safetensors", encodings, chunk_size)
+            self._save_index(directory)
+            return
+
         tensors: OrderedDict[str, torch.Tensor] = OrderedDict()
-        metadata: dict[str, Any] = {"num_shards": str(len(self.shards))}
+        metadata: dict[str, Any] = {
+            "num_shards": str(len(self.shards)),
+            "shard_offsets": json.dumps(self.shard_offsets.tolist()),
+        }
         for pos, shard in enumerate(self.shards):
-            shard_tensors, shard_metadata = shard._save_to_dict()
+            shard_tensors, shard_metadata = shard._save_to_dict(encodings, chunk_size)
 
             for key, tensor in shard_tensors.items():
                 tensors[f"shards.{pos}.{key}"] = tensor
@@ -730,19 +1284,73 @@ class ShardedSafetensorsDataset(torch.utils.data.Dataset):
                 metadata[f"shards.{pos}.{key}"] = value
         safetensors.torch.save_file(tensors, path, metadata=metadata)
 
+    def save_shard(
+        self,
+        path: Union[str, Path],
+        pos: int,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        """
+        Rewrite a single shard of a dataset that was saved with `separate_files=True`
+        """
+        directory = _shard_directory(Path(path))
+        if not (directory / "index.json").exists():
+            raise ValueError(f"{directory} does not contain a sharded dataset")
+        # the size of the shard may have changed since the dataset was created
+        shard_sizes = self.shard_offsets.diff()
+        shard_sizes[pos] = len(self.shards[pos])
+        self.shard_offsets = torch.cat((shard_sizes.new_zeros((1,)), shard_sizes.cumsum(0)))
+        self.shard_size = int(shard_sizes[0])
+        self.shards[pos].save_to_file(directory / f"shards.{pos}.safetensors", encodings, chunk_size)
+        self._save_index(directory)
+
+    def _save_index(self, directory: Path):
+        _save_shard_index(directory, self.shard_offsets.tolist())
+
     @classmethod
-    def _load_from_dict(cls, tensors, metadata):
+    def load_from_index(
+        cls,
+        path: Union[str, Path],
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ):
+        """
+        Load a dataset saved with `separate_files=True`, the shards are only loaded when they are first accessed.
+        With `rows`, only the shards overlapping the range are loaded, and only the rows of the range in them.
+        """
+        path = Path(path)
+        index_path = path if path.name == "index.json" else _shard_directory(path) / "index.json"
+        with open(index_path) as f:
+            index = json.load(f)
+        columns = tuple(columns) if columns is not None else None
+        files = [index_path.parent / file for file in index["shards"]]
+        if rows is None:
+            shards = _LazyShards(files, mmap=mmap, columns=columns)
+            return cls(shards, index["shard_offsets"])
+        rows = _resolve_row_range(rows, index["shard_offsets"][-1])
+        return cls(tuple(
+            SafetensorsDataset.load_from_file(files[pos], mmap=mmap, columns=columns, rows=shard_rows)
+            for pos, shard_rows in _split_rows_by_shard(index["shard_offsets"], rows)
+        ))
+
+    @classmethod
+    def _load_from_dict(cls, tensors, metadata, columns: Optional[Iterable[str]] = None, rows: Optional[slice] = None):
         if "num_shards" not in metadata:
             raise ValueError("num_shards")
         num_shards = int(metadata["num_shards"])
+        shard_offsets = metadata.get("shard_offsets")
+        if shard_offsets is None:
+            shard_sizes = [int(metadata[f"shards.{pos}.size"]) for pos in range(num_shards)]
+            shard_offsets = [0] + torch.tensor(shard_sizes, dtype=torch.long).cumsum(0).tolist()
+        shard_rows = dict.fromkeys(range(num_shards))
+        if rows is not None:
+            shard_rows = dict(_split_rows_by_shard(shard_offsets, _resolve_row_range(rows, shard_offsets[-1])))
 
         shard_datasets = tuple()
-        for pos in range(num_shards):
-            shard_tensors = {
-                key[len(shard_prefix):]: value
-                for key, value in tensors.items()
-                if key.startswith(shard_prefix := f"shards.{pos}.")
-            }
+        for pos, rows_of_shard in shard_rows.items():
+            shard_tensors = _PrefixedStorage(tensors, f"shards.{pos}.")
 
             shard_metadata = {
                 key[len(shard_prefix):]: value
@@ -750,12 +1358,30 @@ class ShardedSafetensorsDataset(torch.utils.data.Dataset):
                 if key.startswith(shard_prefix := f"shards.{pos}.")
             }
 
-            shard_dataset = SafetensorsDataset._load_from_dict(shard_tensors, shard_metadata)
+            shard_dataset = SafetensorsDataset._load_from_dict(shard_tensors, shard_metadata, columns, rows_of_shard)
             shard_datasets = shard_datasets + (shard_dataset,)
-        return ShardedSafetensorsDataset(shard_datasets)
+        if rows is not None:
+            return ShardedSafetensorsDataset(shard_datasets)
+        return ShardedSafetensorsDataset(shard_datasets, shard_offsets)
 
     @classmethod
-    def load_from_file(cls, path: Union[str, Path]):
+    def load_from_file(
+        cls,
+        path: Union[str, Path],
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ):
         metadata = _load_safetensors_metadata(path)
-        tensors = safetensors.torch.load_file(path, device="cpu")
-        return cls._load_from_dict(tensors, metadata)
+        if mmap or columns is not None or rows is not None:
+            tensors = _LazySafetensorsStorage(path)
+        else:
+            tensors = safetensors.torch.load_file(path, device="cpu")
+        dataset = cls._load_from_dict(tensors, metadata, columns, rows)
+        if mmap:
+            dataset._mmap_path = Path(path)
+            dataset._mmap_rows = rows
+        elif rows is not None:
+            for shard in dataset.shards:
+                shard.dataset = {key: _clone_value(value) for key, value in shard.dataset.items()}
+        return dataset
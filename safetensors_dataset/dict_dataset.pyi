@@ -1,11 +1,12 @@
 from collections import OrderedDict
 from pathlib import Path
-from typing import Callable, overload, Self, Mapping, Any, Optional, Generator, Union, Sequence, MutableMapping
+from typing import Iterable, Callable, overload, Self, Mapping, Any, Optional, Generator, Union, Sequence, MutableMapping
 
 import torch.utils.data
 from torch import Tensor
 
-from safetensors_dataset.utils import TensorLayout
+from safetensors_dataset.utils import TensorLayout, NestedBatchLayout
+from safetensors_dataset.encoding import encoding_spec_t
 
 pack_tensor_t = dict[str, torch.Tensor]
 pack_metadata_t = dict[str, Any] | None
@@ -22,13 +23,22 @@ class SafetensorsDataset(torch.utils.data.Dataset):
 
     def pack(self) -> Self: ...
 
+    def share_memory(self) -> Self: ...
+
     def shard(
         self,
         chunk_size: int = 5000,
         preprocess_if_unprocessed: bool = True,
+        copy: bool = True,
     ) -> ShardedSafetensorsDataset | SafetensorsDataset: ...
 
-    def filter(self, filter_fn: Callable[[dict[str, Tensor]], bool], tqdm: bool = True) -> SafetensorsDataset: ...
+    def filter(
+        self,
+        filter_fn: Callable[[dict[str, Tensor]], bool | Sequence[bool] | Tensor],
+        use_tqdm: bool = True,
+        batched: bool = False,
+        batch_size: int = 1,
+    ) -> SafetensorsDataset: ...
 
     def keys(self) -> set[str]: ...
 
@@ -37,7 +47,25 @@ class SafetensorsDataset(torch.utils.data.Dataset):
     @overload
     def __getitem__(self, item: int) -> dict[str, Tensor]: ...
 
-    def __getitems__(self, items: list[int]) -> list[dict[str, Tensor]]: ...
+    def __getitems__(self, items: list[int]) -> list[dict[str, Tensor]] | dict[str, Any]: ...
+
+    def set_batch_output(
+        self,
+        enabled: bool = True,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> Self: ...
+
+    def set_transform(self, transform: Optional[Callable[[dict[str, Any]], dict[str, Any]]]) -> Self: ...
+
+    def with_transform(self, transform: Callable[[dict[str, Any]], dict[str, Any]]) -> Self: ...
+
+    def get_batch(
+        self,
+        indices: Sequence[int] | Tensor,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> dict[str, Any]: ...
 
     def __len__(self) -> int: ...
 
@@ -53,7 +81,11 @@ class SafetensorsDataset(torch.utils.data.Dataset):
         use_tqdm: bool = True,
         batched: bool = False,
         batch_size: int = 1,
-    ) -> "SafetensorsDataset": ...
+        num_proc: Optional[int] = None,
+        output_path: Optional[Union[str, Path]] = None,
+        writer_batch_size: int = 10000,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ) -> "SafetensorsDataset | ShardedSafetensorsDataset": ...
 
     def select(self, indices: list[int], use_tqdm: bool = False) -> "SafetensorsDataset": ...
 
@@ -66,15 +98,36 @@ class SafetensorsDataset(torch.utils.data.Dataset):
 
     def info(self) -> Mapping[str, TensorLayout]: ...
 
-    def _save_to_dict(self) -> tuple[OrderedDict[str, Tensor], dict[str, Any]]: ...
+    def _save_to_dict(
+        self,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ) -> tuple[OrderedDict[str, Tensor], dict[str, Any]]: ...
 
-    def save_to_file(self, path: Union[str, Path]): ...
+    def save_to_file(
+        self,
+        path: Union[str, Path],
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ): ...
 
     @classmethod
-    def _load_from_dict(cls, tensors: dict[str, torch.Tensor], metadata: dict[str, Any]) -> SafetensorsDataset: ...
+    def _load_from_dict(
+        cls,
+        tensors: Mapping[str, torch.Tensor],
+        metadata: dict[str, Any],
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ) -> SafetensorsDataset: ...
 
     @classmethod
-    def load_from_file(cls, path: Path) -> SafetensorsDataset: ...
+    def load_from_file(
+        cls,
+        path: Path,
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ) -> SafetensorsDataset: ...
 
     @classmethod
     def from_dict(cls, x: dict[str, Tensor | list[Tensor]], *, preprocess: bool=False) -> SafetensorsDataset: ...
@@ -83,13 +136,31 @@ class SafetensorsDataset(torch.utils.data.Dataset):
     def from_list(cls, x: list[dict[str, Tensor]], *, preprocess: bool=False) -> SafetensorsDataset: ...
 
     @staticmethod
-    def unpack_list_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]): ...
+    def unpack_list_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ): ...
 
     @staticmethod
-    def unpack_nested_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]): ...
+    def unpack_nested_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ): ...
 
     @staticmethod
-    def unpack_sparse_tensor(key: str, metadata: Mapping[str, Any], meta: Mapping[str, Any], storage: Mapping[str, torch.Tensor]): ...
+    def unpack_sparse_tensor(
+        key: str,
+        metadata: Mapping[str, Any],
+        meta: Mapping[str, Any],
+        storage: Mapping[str, torch.Tensor],
+        rows: Optional[slice] = None,
+    ): ...
 
     @staticmethod
     def pack_single_tensor(key: str, tensor: torch.Tensor) -> pack_return_t: ...
@@ -97,25 +168,88 @@ class SafetensorsDataset(torch.utils.data.Dataset):
     def pack_tensor_list(self, key: str, tensors: Sequence[torch.Tensor]) -> pack_return_t: ...
 
 class ShardedSafetensorsDataset(torch.utils.data.Dataset):
-    shards: tuple[SafetensorsDataset, ...]
+    shards: Sequence[SafetensorsDataset]
+    shard_offsets: Tensor
     shard_size: int
 
-    def __init__(self, shards: tuple[SafetensorsDataset, ...]): ...
+    def __init__(self, shards: Sequence[SafetensorsDataset], shard_offsets: Optional[Sequence[int]] = None): ...
+
+    @classmethod
+    def concat(cls, datasets: Sequence[SafetensorsDataset | ShardedSafetensorsDataset]) -> ShardedSafetensorsDataset: ...
+
+    def append_shard(self, shard: SafetensorsDataset) -> Self: ...
 
     def __contains__(self, item) -> bool: ...
 
+    def keys(self) -> set[str]: ...
+
     def __len__(self) -> int: ...
 
     def __getitem__(self, item: int | str) -> dict[str, torch.Tensor] | torch.Tensor: ...
 
+    def share_memory(self) -> Self: ...
+
     def get_shard(self, pos: Optional[int] = None) -> SafetensorsDataset: ...
 
-    def __getitems__(self, indices: list[int]) -> list[dict[str, torch.Tensor]]: ...
+    def __getitems__(self, indices: list[int]) -> list[dict[str, torch.Tensor]] | dict[str, Any]: ...
+
+    def set_batch_output(
+        self,
+        enabled: bool = True,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> Self: ...
+
+    def set_transform(self, transform: Optional[Callable[[dict[str, Any]], dict[str, Any]]]) -> Self: ...
+
+    def with_transform(self, transform: Callable[[dict[str, Any]], dict[str, Any]]) -> Self: ...
 
-    def save_to_file(self, path: Union[str, Path]): ...
+    def get_batch(
+        self,
+        indices: Sequence[int] | Tensor,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+    ) -> dict[str, Any]: ...
+
+    def save_to_file(
+        self,
+        path: Union[str, Path],
+        separate_files: Optional[bool] = None,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ): ...
+
+    def save_shard(
+        self,
+        path: Union[str, Path],
+        pos: int,
+        encodings: Optional[Mapping[str, encoding_spec_t]] = None,
+        chunk_size: Optional[int] = None,
+    ): ...
+
+    @classmethod
+    def load_from_index(
+        cls,
+        path: Union[str, Path],
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ) -> ShardedSafetensorsDataset: ...
 
     @classmethod
-    def _load_from_dict(cls, tensors: dict[str, Tensor], metadata: dict[str, Any]) -> ShardedSafetensorsDataset: ...
+    def _load_from_dict(
+        cls,
+        tensors: Mapping[str, Tensor],
+        metadata: dict[str, Any],
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ) -> ShardedSafetensorsDataset: ...
 
     @classmethod
-    def load_from_file(cls, path: Union[str, Path]) -> ShardedSafetensorsDataset: ...
\ No newline at end of file
+    def load_from_file(
+        cls,
+        path: Union[str, Path],
+        mmap: bool = False,
+        columns: Optional[Iterable[str]] = None,
+        rows: Optional[slice] = None,
+    ) -> ShardedSafetensorsDataset: ...
\ No newline at end of file
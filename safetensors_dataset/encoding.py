@@ -0,0 +1,329 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Mapping, Iterator, Optional, Sequence, Union
+
+import torch
+
+from safetensors_dataset.utils import (
+    get_torch_dtype_from_str, _LazyRows, _gather_value, _concat_gathered_values,
+)
+
+encoding_spec_t = Union[str, Sequence[str]]
+
+# codecs are always applied in this order and reversed in the opposite order on load
+_CODECS = ("delta", "narrow", "zlib", "zstd", "lz4")
+_COMPRESSION_CODECS = ("zlib", "zstd", "lz4")
+_NARROW_DTYPES = (torch.uint8, torch.int8, torch.int16, torch.int32)
+
+
+def _compression_module(codec: str):
+    try:
+        if codec == "zlib":
+            import zlib
+            return zlib
+        elif codec == "zstd":
+            import zstandard
+            return zstandard
+        elif codec == "lz4":
+            import lz4.frame
+            return lz4.frame
+    except ImportError as e:
+        package = "zstandard" if codec == "zstd" else codec
+        raise ImportError(f"The {codec} encoding requires the {package} package, install it with `pip install {package}`") from e
+    raise ValueError(f"Unknown compression codec {codec}")
+
+
+def _compress(codec: str, data: bytes) -> bytes:
+    module = _compression_module(codec)
+    if codec == "zstd":
+        return module.ZstdCompressor().compress(data)
+    return module.compress(data)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    module = _compression_module(codec)
+    if codec == "zstd":
+        return module.ZstdDecompressor().decompress(data)
+    return module.decompress(data)
+
+
+def _bytes_to_tensor(data: bytes) -> torch.Tensor:
+    if len(data) == 0:
+        return torch.zeros((0,), dtype=torch.uint8)
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8)
+
+
+def _tensor_to_bytes(tensor: torch.Tensor) -> bytes:
+    return tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+
+def _normalize_encoding(key: str, encoding: encoding_spec_t) -> tuple[str, ...]:
+    codecs = (encoding,) if isinstance(encoding, str) else tuple(encoding)
+    if unknown_codecs := set(codecs) - set(_CODECS):
+        raise ValueError(f"Unknown encodings {', '.join(sorted(unknown_codecs))} for key {key}, use any of {_CODECS}")
+    if len(set(codecs) & set(_COMPRESSION_CODECS)) > 1:
+        raise ValueError(f"Only one of {_COMPRESSION_CODECS} can be used for key {key}")
+    for codec in set(codecs) & set(_COMPRESSION_CODECS):
+        # fail before anything is written if the compression library is missing
+        _compression_module(codec)
+    return tuple(codec for codec in _CODECS if codec in codecs)
+
+
+def _narrowest_dtype(tensor: torch.Tensor) -> torch.dtype:
+    if tensor.numel() == 0:
+        return _NARROW_DTYPES[0]
+    low, high = tensor.min().item(), tensor.max().item()
+    for dtype in _NARROW_DTYPES:
+        info = torch.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return tensor.dtype
+
+
+def _is_integer_tensor(tensor: torch.Tensor) -> bool:
+    return not tensor.dtype.is_floating_point and not tensor.dtype.is_complex and tensor.dtype != torch.bool
+
+
+def _encode_tensor(
+    tensor: torch.Tensor,
+    codecs: Sequence[str],
+    delta: bool,
+) -> tuple[torch.Tensor, Optional[dict[str, Any]]]:
+    """
+    Apply `codecs` to a stored tensor, codecs that do not apply to the tensor are skipped. `delta` controls
+    whether the tensor holds (mostly) sorted positions along its last dimension that benefit from delta encoding.
+
+    :return: the encoded tensor and the information needed to decode it, or None if no codec was applied
+    """
+    info = {"codecs": [], "dtype": repr(tensor.dtype), "shape": list(tensor.shape)}
+    if "delta" in codecs and delta and _is_integer_tensor(tensor) and tensor.dim() > 0:
+        tensor = tensor.diff(dim=-1, prepend=tensor.new_zeros(tensor.shape[:-1] + (1,)))
+        info["codecs"].append("delta")
+    if "narrow" in codecs and _is_integer_tensor(tensor):
+        dtype = _narrowest_dtype(tensor)
+        if dtype.itemsize < tensor.dtype.itemsize:
+            tensor = tensor.to(dtype)
+            info["codecs"].append("narrow")
+            info["narrow_dtype"] = repr(dtype)
+    for codec in codecs:
+        if codec in _COMPRESSION_CODECS:
+            tensor = _bytes_to_tensor(_compress(codec, _tensor_to_bytes(tensor)))
+            info["codecs"].append(codec)
+    if not info["codecs"]:
+        return tensor, None
+    return tensor, info
+
+
+def _decode_tensor(tensor: torch.Tensor, info: Mapping[str, Any]) -> torch.Tensor:
+    codecs = info["codecs"]
+    dtype = get_torch_dtype_from_str(info["dtype"])
+    shape = info["shape"]
+    for codec in reversed(codecs):
+        if codec in _COMPRESSION_CODECS:
+            encoded_dtype = get_torch_dtype_from_str(info["narrow_dtype"]) if "narrow" in codecs else dtype
+            tensor = _bytes_to_tensor(_decompress(codec, _tensor_to_bytes(tensor))).view(encoded_dtype).view(shape)
+        elif codec == "narrow":
+            tensor = tensor.to(dtype)
+        elif codec == "delta":
+            tensor = tensor.to(dtype).cumsum(dim=-1, dtype=dtype)
+    return tensor
+
+
+def _encode_pack(
+    key: str,
+    pack: Mapping[str, torch.Tensor],
+    metadata: Optional[dict[str, Any]],
+    encoding: encoding_spec_t,
+) -> tuple[dict[str, torch.Tensor], Optional[dict[str, Any]]]:
+    # positions stored by sparse and nested tensors are sorted, dense integer tensors are delta encoded on request
+    codecs = _normalize_encoding(key, encoding)
+    is_list = metadata is not None and metadata.get("list", False)
+    delta_encoded = {key + ".indices", key + ".storage_offsets"} | (set() if is_list else {key})
+
+    encoded_pack, encodings = dict(), dict()
+    for name, tensor in pack.items():
+        encoded_pack[name], info = _encode_tensor(tensor, codecs, name in delta_encoded)
+        if info is not None:
+            encodings[name] = info
+    if encodings:
+        metadata = dict(metadata or dict())
+        metadata["encodings"] = encodings
+    return encoded_pack, metadata
+
+
+class _DecodedStorage(Mapping[str, torch.Tensor]):
+    """
+    View of `storage` that reverses the encodings recorded in the metadata of the dataset when a tensor is accessed
+    """
+
+    def __init__(self, storage: Mapping[str, torch.Tensor], encodings: Mapping[str, Mapping[str, Any]]):
+        self.storage = storage
+        self.encodings = encodings
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        tensor = self.storage[key]
+        if (info := self.encodings.get(key)) is not None:
+            return _decode_tensor(tensor, info)
+        return tensor
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.storage
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.storage)
+
+    def __len__(self) -> int:
+        return len(self.storage)
+
+
+def _decoded_storage(storage: Mapping[str, torch.Tensor], metadata: Mapping[str, Any]) -> Mapping[str, torch.Tensor]:
+    encodings = dict()
+    for meta in metadata.values():
+        if isinstance(meta, dict) and "encodings" in meta:
+            encodings.update(meta["encodings"])
+    if not encodings:
+        return storage
+    return _DecodedStorage(storage, encodings)
+
+
+def _encode_chunked(
+    key: str,
+    value: Any,
+    encoding: encoding_spec_t,
+    chunk_size: int,
+    pack: Callable[[str, torch.Tensor], tuple[dict[str, torch.Tensor], Optional[dict[str, Any]]]],
+) -> tuple[dict[str, torch.Tensor], dict[str, Any]]:
+    """
+    Split the rows of `value` into chunks of `chunk_size` rows that are packed and encoded independently.
+    The encoded tensors of all chunks are concatenated into one byte tensor, their locations in it are
+    recorded in the chunk table of the metadata.
+    """
+    codecs = _normalize_encoding(key, encoding)
+    size = len(value) if not isinstance(value, torch.Tensor) else value.size(0)
+    if size == 0:
+        raise ValueError(f"Cannot store the empty key {key} in chunks")
+    chunks, parts, offset = list(), list(), 0
+    for start in range(0, size, chunk_size):
+        rows = torch.arange(start, min(start + chunk_size, size))
+        chunk_pack, chunk_meta = pack(key, _gather_value(key, value, rows))
+        chunk_pack, chunk_meta = _encode_pack(key, chunk_pack, chunk_meta, codecs)
+        tensors = dict()
+        for name, tensor in chunk_pack.items():
+            data = _tensor_to_bytes(tensor)
+            tensors[name] = [offset, offset + len(data), repr(tensor.dtype), list(tensor.shape)]
+            parts.append(data)
+            offset += len(data)
+        chunks.append({"rows": rows.numel(), "meta": chunk_meta, "tensors": tensors})
+    metadata = {"chunked": True, "numel": size, "chunk_size": chunk_size, "chunks": chunks}
+    return {key + ".chunks": _bytes_to_tensor(b"".join(parts))}, metadata
+
+
+class _ChunkedTensor(_LazyRows):
+    """
+    Rows of a key stored in independently encoded chunks. Only the chunks of the accessed rows are decoded,
+    the most recently used `cache_size` decoded chunks are kept in memory.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        meta: Mapping[str, Any],
+        data: torch.Tensor,
+        unpack: Callable[[str, Mapping[str, Any], Mapping[str, Any], Mapping[str, torch.Tensor]], Any],
+        cache_size: int = 16,
+        rows: Optional[slice] = None,
+    ):
+        chunks = meta["chunks"]
+        chunk_offsets = torch.tensor([0] + [chunk["rows"] for chunk in chunks], dtype=torch.long).cumsum(0)
+        start, stop = (0, int(chunk_offsets[-1])) if rows is None else (rows.start, rows.stop)
+        if rows is not None and stop > start:
+            # only keep the chunks (and their bytes) that overlap the rows
+            first = int(torch.searchsorted(chunk_offsets, start, right=True)) - 1
+            last = int(torch.searchsorted(chunk_offsets, stop))
+            chunks = chunks[first:last]
+            start, stop = start - int(chunk_offsets[first]), stop - int(chunk_offsets[first])
+            chunk_offsets = chunk_offsets[first:last + 1] - chunk_offsets[first]
+            data_start, data_stop = _chunk_data_range(chunks)
+            data = data[data_start:data_stop]
+            chunks = [_shift_chunk(chunk, -data_start) for chunk in chunks]
+        self.key = key
+        self.meta = {"chunks": chunks}
+        self.data = data
+        self.unpack = unpack
+        self.cache_size = cache_size
+        self.chunk_offsets = chunk_offsets
+        self.start = start
+        self.stop = stop
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["cache"], state["lock"] = OrderedDict(), None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def clone(self) -> "_ChunkedTensor":
+        chunked = _ChunkedTensor.__new__(_ChunkedTensor)
+        chunked.__setstate__(self.__getstate__() | {"data": self.data.clone()})
+        return chunked
+
+    def _decode_chunk(self, pos: int) -> torch.Tensor:
+        chunk = self.meta["chunks"][pos]
+        storage = {
+            # copy the bytes, they may not be aligned to the dtype in the file
+            name: self.data[start:stop].clone().view(get_torch_dtype_from_str(dtype)).view(shape)
+            for name, (start, stop, dtype, shape) in chunk["tensors"].items()
+        }
+        chunk_meta = chunk["meta"] or dict()
+        return self.unpack(self.key, chunk_meta, {"size": chunk["rows"]}, _decoded_storage(storage, {self.key: chunk_meta}))
+
+    def chunk(self, pos: int) -> torch.Tensor:
+        with self.lock:
+            if pos in self.cache:
+                self.cache.move_to_end(pos)
+                return self.cache[pos]
+        value = self._decode_chunk(pos)
+        with self.lock:
+            self.cache[pos] = value
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return value
+
+    def gather(self, indices: torch.Tensor) -> torch.Tensor:
+        positions = indices + self.start
+        chunk_ids = torch.searchsorted(self.chunk_offsets, positions, right=True) - 1
+        if positions.numel() == 0:
+            return _gather_value(self.key, self.chunk(0), positions)
+        order = torch.argsort(chunk_ids, stable=True)
+        chunk_ids, positions = chunk_ids[order], positions[order]
+        unique_chunks, counts = torch.unique_consecutive(chunk_ids, return_counts=True)
+        values = [
+            _gather_value(self.key, self.chunk(pos), chunk_positions - self.chunk_offsets[pos])
+            for pos, chunk_positions in zip(unique_chunks.tolist(), torch.split(positions, counts.tolist()))
+        ]
+        value = _concat_gathered_values(self.key, values)
+        if bool(order.eq(torch.arange(order.numel())).all()):
+            return value
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(order.numel())
+        return _gather_value(self.key, value, inverse)
+
+
+def _chunk_data_range(chunks: Sequence[Mapping[str, Any]]) -> tuple[int, int]:
+    ranges = [(start, stop) for chunk in chunks for start, stop, _, _ in chunk["tensors"].values()]
+    return min(start for start, _ in ranges), max(stop for _, stop in ranges)
+
+
+def _shift_chunk(chunk: Mapping[str, Any], shift: int) -> dict[str, Any]:
+    tensors = {
+        name: [start + shift, stop + shift, dtype, shape]
+        for name, (start, stop, dtype, shape) in chunk["tensors"].items()
+    }
+    return dict(chunk) | {"tensors": tensors}
@@ -1,14 +1,46 @@
 import json
 import pathlib
 from os import PathLike
-from typing import Union
+from typing import Iterable, Optional, Union
 
 from .dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset
 from .safetensors_dict import SafetensorsDict
-from .utils import _load_safetensors_metadata
+from .utils import _load_safetensors_metadata, _rows_of_rank
 
 
-def load_safetensors(path: Union[str, pathlib.Path]) -> Union[SafetensorsDataset, ShardedSafetensorsDataset, SafetensorsDict]:
+def _sharded_size(metadata: dict) -> int:
+    if "shard_offsets" in metadata:
+        return metadata["shard_offsets"][-1]
+    return sum(int(metadata[f"shards.{pos}.size"]) for pos in range(int(metadata["num_shards"])))
+
+
+def load_safetensors(
+    path: Union[str, pathlib.Path],
+    mmap: bool = False,
+    columns: Optional[Iterable[str]] = None,
+    rows: Optional[slice] = None,
+    rank: Optional[int] = None,
+    world_size: Optional[int] = None,
+) -> Union[SafetensorsDataset, ShardedSafetensorsDataset, SafetensorsDict]:
+    """
+    Load a dataset, a sharded dataset or a dict of datasets from `path`.
+
+    :param mmap: serve the tensors as zero-copy views of the memory-mapped files
+    :param columns: only load these keys
+    :param rows: only load this contiguous range of rows
+    :param rank: together with `world_size`, only load the contiguous part of the
+        rows that belongs to this rank, every split of a dict is divided separately
+    """
+    if (rank is None) != (world_size is None):
+        raise ValueError("rank and world_size must be passed together")
+    elif rank is not None and rows is not None:
+        raise ValueError("Pass either rows or rank and world_size")
+
+    def rows_for_size(size: int) -> Optional[slice]:
+        if rank is None:
+            return rows
+        return _rows_of_rank(rank, world_size, size)
+
     if isinstance(path, str):
         path = pathlib.Path(path)
     if path.is_dir() and (path / "index.json").exists():
@@ -18,14 +50,27 @@ def load_safetensors(path: Union[str, pathlib.Path]) -> Union[SafetensorsDataset
     else:
         metadata = _load_safetensors_metadata(path)
         if "num_shards" in metadata:
-            return ShardedSafetensorsDataset.load_from_file(path)
-        return SafetensorsDataset.load_from_file(path)
+            return ShardedSafetensorsDataset.load_from_file(
+                path, mmap=mmap, columns=columns, rows=rows_for_size(_sharded_size(metadata))
+            )
+        return SafetensorsDataset.load_from_file(path, mmap=mmap, columns=columns, rows=rows_for_size(metadata["size"]))
 
     with open(index_path) as f:
         index_dict = json.load(f)
 
+    if isinstance(index_dict, dict) and "shards" in index_dict:
+        return ShardedSafetensorsDataset.load_from_index(
+            index_path, mmap=mmap, columns=columns, rows=rows_for_size(index_dict["shard_offsets"][-1])
+        )
+
+    def load_split(split_path: pathlib.Path):
+        split_rows = None
+        if rows is not None or rank is not None:
+            split_rows = rows_for_size(_load_safetensors_metadata(split_path)["size"])
+        return SafetensorsDataset.load_from_file(split_path, mmap=mmap, columns=columns, rows=split_rows)
+
     return SafetensorsDict({
-        index["split"]: SafetensorsDataset.load_from_file(index_path.parent / index["file"])
+        index["split"]: load_split(index_path.parent / index["file"])
         for index in index_dict
     })
 
@@ -0,0 +1,220 @@
+import queue
+import threading
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Iterable, Iterator, Optional, Sequence, Union
+
+import torch
+
+from safetensors_dataset.dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset
+from safetensors_dataset.utils import (
+    NestedBatchLayout, _apply_transforms, _collate_gathered_batch, _gather_value, _index_tensor,
+)
+
+_END = object()
+
+
+class _StagingBuffers:
+    """
+    Reusable pinned host buffers for the tensors of one batch, the buffer of every key only grows
+    """
+
+    def __init__(self, pin_memory: bool = True):
+        self.pin_memory = pin_memory
+        self.buffers: dict[str, torch.Tensor] = dict()
+
+    def empty(self, key: str, shape: Sequence[int], dtype: torch.dtype) -> torch.Tensor:
+        nbytes = torch.Size(shape).numel() * dtype.itemsize
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < nbytes:
+            buffer = torch.empty((max(nbytes, 1),), dtype=torch.uint8, pin_memory=self.pin_memory)
+            self.buffers[key] = buffer
+        return buffer[:nbytes].view(dtype).view(shape)
+
+    def stage(self, key: str, tensor: torch.Tensor) -> torch.Tensor:
+        if self.pin_memory and tensor.is_pinned():
+            return tensor
+        return self.empty(key, tensor.shape, tensor.dtype).copy_(tensor)
+
+
+def _stage_value(key: str, value: Any, staging: _StagingBuffers) -> Any:
+    # copy a batched value into the staging buffers, nested and sparse tensors are staged by their flat components
+    if not isinstance(value, torch.Tensor):
+        return value
+    elif value.is_sparse:
+        return torch.sparse_coo_tensor(
+            staging.stage(key + ".indices", value._indices()),
+            staging.stage(key + ".values", value._values()),
+            size=value.shape,
+            is_coalesced=value.is_coalesced(),
+        )
+    elif value.is_nested and value.layout == torch.jagged:
+        return torch.nested.nested_tensor_from_jagged(
+            staging.stage(key + ".values", value.values()),
+            staging.stage(key + ".offsets", value.offsets()),
+        )
+    elif value.is_nested:
+        return torch._nested_view_from_buffer(
+            staging.stage(key + ".buffer", value.values()),
+            value._nested_tensor_size(),
+            value._nested_tensor_strides(),
+            value._nested_tensor_storage_offsets(),
+        )
+    return staging.stage(key, value)
+
+
+def _gather_batch(
+    dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset],
+    indices: Sequence[int],
+    staging: Optional[_StagingBuffers],
+    nested_layout: NestedBatchLayout,
+    padding_value: float,
+) -> dict[str, Any]:
+    if staging is None:
+        return dataset.get_batch(indices, nested_layout, padding_value)
+    elif not isinstance(dataset, SafetensorsDataset):
+        batch = dataset.get_batch(indices, nested_layout, padding_value)
+        return {key: _stage_value(key, value, staging) for key, value in batch.items()}
+
+    # dense keys are gathered straight into the pinned buffers, everything else is copied there after collation
+    indices = _index_tensor(indices, len(dataset))
+    batch = dict()
+    for key, value in dataset.dataset.items():
+        if isinstance(value, torch.Tensor) and value.layout == torch.strided and not value.is_nested:
+            out = staging.empty(key, (indices.numel(),) + value.shape[1:], value.dtype)
+            batch[key] = torch.index_select(value, 0, indices, out=out)
+        else:
+            batch[key] = _gather_value(key, value, indices)
+    batch = _apply_transforms(dataset._transforms, _collate_gathered_batch(batch, nested_layout, padding_value))
+    return {key: _stage_value(key, value, staging) for key, value in batch.items()}
+
+
+def _record_stream(value: Any, stream: "torch.cuda.Stream"):
+    # mark the memory of a device tensor, and of all components of nested and sparse tensors, as used on `stream`
+    if not isinstance(value, torch.Tensor):
+        return
+    elif value.is_sparse:
+        components = (value._indices(), value._values())
+    elif value.is_nested and value.layout == torch.jagged:
+        components = (value.values(), value.offsets())
+    elif value.is_nested:
+        components = (value.values(),)
+    else:
+        components = (value,)
+    for component in components:
+        if component.device.type == "cuda":
+            component.record_stream(stream)
+
+
+class PrefetchLoader:
+    """
+    Loads the batches of `batch_sampler` with `get_batch()` in a background thread and moves them to `device`.
+
+    For CUDA devices, the batches are gathered into reusable pinned staging buffers (dense keys directly, nested and
+    sparse keys by their flattened buffers), and the copies to the device are issued without blocking on a separate
+    stream, `prefetch` batches ahead of the batch that is currently used. This replaces the DataLoader's
+    `pin_memory`, which copies every batch into newly pinned memory. For other devices, the batches are only
+    gathered ahead of time in the background thread. `pin_memory` can only be used with CUDA devices, the staging
+    buffers are reused for later batches once the batch has been copied to the device.
+    """
+
+    def __init__(
+        self,
+        dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset],
+        batch_sampler: Iterable[Sequence[int]],
+        device: Union[torch.device, str, int, None] = None,
+        prefetch: int = 2,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+        pin_memory: Optional[bool] = None,
+    ):
+        if prefetch < 1:
+            raise ValueError(f"prefetch must be at least 1, got {prefetch}")
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.device = torch.device(device) if device is not None else None
+        self.prefetch = prefetch
+        self.nested_layout = nested_layout
+        self.padding_value = padding_value
+        if pin_memory is None:
+            pin_memory = self.device is not None and self.device.type == "cuda"
+        elif pin_memory and (self.device is None or self.device.type != "cuda"):
+            raise ValueError("pin_memory requires a CUDA device, the batches would be returned in reused buffers")
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _produce(self, batches: queue.Queue, free_staging: queue.Queue, stop: threading.Event):
+        try:
+            for indices in self.batch_sampler:
+                staging = free_staging.get() if self.pin_memory else None
+                batch = _gather_batch(self.dataset, indices, staging, self.nested_layout, self.padding_value)
+                while not stop.is_set():
+                    try:
+                        batches.put((batch, staging), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            batches.put((_END, None))
+        except BaseException as e:
+            batches.put((e, None))
+
+    def _to_device(self, batch: dict[str, Any], stream: Optional["torch.cuda.Stream"]) -> dict[str, Any]:
+        if self.device is None:
+            return batch
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            return {
+                key: value.to(self.device, non_blocking=self.pin_memory) if isinstance(value, torch.Tensor) else value
+                for key, value in batch.items()
+            }
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        batches = queue.Queue(maxsize=self.prefetch)
+        free_staging = queue.Queue()
+        # staging buffers are in use while being filled, while waiting in the queue and while being copied
+        for _ in range(2 * self.prefetch + 2 if self.pin_memory else 0):
+            free_staging.put(_StagingBuffers())
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, free_staging, stop), daemon=True)
+        producer.start()
+
+        use_stream = self.device is not None and self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if use_stream else None
+        in_flight = deque()
+        try:
+            while True:
+                batch, staging = batches.get()
+                if batch is _END:
+                    break
+                elif isinstance(batch, BaseException):
+                    raise batch
+                device_batch = self._to_device(batch, stream)
+                event = None
+                if stream is not None:
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                in_flight.append((device_batch, event, staging))
+                if len(in_flight) > self.prefetch:
+                    yield self._release(in_flight.popleft(), free_staging)
+            while in_flight:
+                yield self._release(in_flight.popleft(), free_staging)
+        finally:
+            stop.set()
+            # unblock the producer if it waits for a staging buffer
+            free_staging.put(_StagingBuffers() if self.pin_memory else None)
+
+    def _release(self, entry, free_staging: queue.Queue) -> dict[str, Any]:
+        device_batch, event, staging = entry
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+            for value in device_batch.values():
+                # the batch was allocated on the copy stream, but is used on the current stream
+                _record_stream(value, torch.cuda.current_stream(self.device))
+            # the copies out of the staging buffers have to finish before the buffers are refilled
+            event.synchronize()
+        if staging is not None:
+            free_staging.put(staging)
+        return device_batch
@@ -9,7 +9,7 @@ import torch
 from more_itertools.more import first
 
 from .dict_dataset import SafetensorsDataset
-from .utils import TensorLayout
+from .utils import TensorLayout, _shard_directory
 
 STK: TypeAlias = Union[str, int]
 
@@ -33,14 +33,24 @@ class SafetensorsDict(dict[STK, SafetensorsDataset]):
         use_tqdm: bool = True,
         batched: bool = False,
         batch_size: int = 1,
+        num_proc: Optional[int] = None,
+        output_path: Optional[Union[str, Path]] = None,
+        writer_batch_size: int = 10000,
+        cache_dir: Optional[Union[str, Path]] = None,
     ) -> "SafetensorsDict":
+        # with output_path, every split is written to its own sharded dataset in the directory output_path
+        directory = _shard_directory(Path(output_path)) if output_path is not None else None
         return SafetensorsDict({
             name: dataset.map(
                 func,
                 info,
-                use_tqdm,
-                batched,
-                batch_size
+                use_tqdm=use_tqdm,
+                batched=batched,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                output_path=directory / f"{name}.safetensors" if directory is not None else None,
+                writer_batch_size=writer_batch_size,
+                cache_dir=cache_dir,
             )
             for name, dataset in self.items()
         })
@@ -53,13 +63,12 @@ class SafetensorsDict(dict[STK, SafetensorsDataset]):
         batched: bool = False,
         batch_size: int = 1,
     ) -> "SafetensorsDict":
-        if batched is True:
-            raise NotImplementedError(f"{batched=}")
-
         return SafetensorsDict({
             name: dataset.filter(
                 func,
-                tqdm=use_tqdm,
+                use_tqdm=use_tqdm,
+                batched=batched,
+                batch_size=batch_size,
             )
             for name, dataset in self.items()
         })
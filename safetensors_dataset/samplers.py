@@ -0,0 +1,269 @@
+import math
+from typing import Iterator, Optional, Sequence, Union
+
+import torch
+import torch.distributed
+import torch.utils.data
+
+from safetensors_dataset.dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset
+
+
+def _shard_offsets_of(dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset]) -> torch.Tensor:
+    if isinstance(dataset, ShardedSafetensorsDataset):
+        return dataset.shard_offsets
+    return torch.tensor([0, len(dataset)], dtype=torch.long)
+
+
+# a contiguous range of rows of a shard, (shard, start, stop) with positions relative to the dataset
+_segment_t = tuple[int, int, int]
+
+
+def _split_segments(segments: Sequence[_segment_t], num_buckets: int) -> list[list[_segment_t]]:
+    # cut the rows of the segments, in their current order, into `num_buckets` contiguous parts whose sizes differ
+    # by at most one row, a segment is only split where it crosses the boundary of two parts
+    total_size = sum(stop - start for _, start, stop in segments)
+    bounds = [bucket * total_size // num_buckets for bucket in range(num_buckets + 1)]
+    buckets = [list() for _ in range(num_buckets)]
+    offset = 0
+    for shard, start, stop in segments:
+        for bucket in range(num_buckets):
+            bucket_start = max(start, start + bounds[bucket] - offset)
+            bucket_stop = min(stop, start + bounds[bucket + 1] - offset)
+            if bucket_start < bucket_stop:
+                buckets[bucket].append((shard, bucket_start, bucket_stop))
+        offset += stop - start
+    return buckets
+
+
+class ShardAwareSampler(torch.utils.data.Sampler[int]):
+    """
+    Sampler for sharded datasets that keeps the accessed rows local to a few shards at a time.
+
+    Every epoch, the order of the shards is shuffled and the rows of the shards, in this order, are divided into
+    contiguous parts of the same size for the ranks (and optionally the DataLoader workers of every rank) without
+    overlap. A shard is only split between two ranks where it crosses the boundary of their parts, so datasets
+    with fewer shards than ranks are divided as well. The rows are then shuffled within windows of `window_size`
+    consecutive shards, so a worker only reads from `window_size` shards at any point in time.
+
+    With `num_workers` and `batch_size` set to the values used by the DataLoader, the batches are interleaved so
+    that the n-th batch is built from the shards of worker `n % num_workers`, which matches the order in which
+    the DataLoader hands out batches to its workers.
+
+    Like DistributedSampler, every rank yields the same number of rows per epoch. The parts of the ranks differ
+    by at most one row, which is repeated to fill up the smaller parts, or dropped from the larger ones if
+    `drop_last` is set.
+    """
+
+    def __init__(
+        self,
+        dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset],
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        window_size: int = 2,
+        num_workers: int = 0,
+        batch_size: int = 1,
+        drop_last: bool = False,
+    ):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank must be in [0, {num_replicas}), got {rank}")
+        if window_size < 1:
+            raise ValueError(f"window_size must be at least 1, got {window_size}")
+
+        self.shard_offsets = _shard_offsets_of(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.window_size = window_size
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.step = 0
+
+        total_size = int(self.shard_offsets[-1])
+        if drop_last:
+            self.num_samples = total_size // num_replicas
+        else:
+            self.num_samples = math.ceil(total_size / num_replicas)
+
+    def set_epoch(self, epoch: int, step: int = 0):
+        """
+        Select the shuffling of `epoch`. To resume an interrupted epoch, `step` is the number of rows
+        this rank has already consumed in it, these rows are skipped.
+        """
+        if not 0 <= step <= self.num_samples:
+            raise ValueError(f"step must be in [0, {self.num_samples}], got {step}")
+        self.epoch = epoch
+        self.step = step
+
+    def _rows_of_segments(self, segments: Sequence[_segment_t], generator: torch.Generator) -> torch.Tensor:
+        windows = list()
+        for pos in range(0, len(segments), self.window_size):
+            rows = torch.cat([
+                torch.arange(start, stop)
+                for _, start, stop in segments[pos:pos + self.window_size]
+            ])
+            if self.shuffle:
+                rows = rows[torch.randperm(rows.numel(), generator=generator)]
+            windows.append(rows)
+        return torch.cat(windows) if windows else torch.zeros((0,), dtype=torch.long)
+
+    def _interleave_batches(self, streams: Sequence[torch.Tensor]) -> torch.Tensor:
+        batches = [list(torch.split(stream, self.batch_size)) for stream in streams]
+        interleaved = list()
+        for pos in range(max(map(len, batches), default=0)):
+            interleaved.extend(worker_batches[pos] for worker_batches in batches if pos < len(worker_batches))
+        return torch.cat(interleaved) if interleaved else torch.zeros((0,), dtype=torch.long)
+
+    def indices(self) -> torch.Tensor:
+        """
+        All rows this rank yields in the current epoch, including the ones skipped by `step`
+        """
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        num_shards = self.shard_offsets.numel() - 1
+        shards = torch.randperm(num_shards, generator=generator) if self.shuffle else torch.arange(num_shards)
+        segments = [
+            (shard, int(self.shard_offsets[shard]), int(self.shard_offsets[shard + 1]))
+            for shard in shards.tolist()
+        ]
+        rank_segments = _split_segments(segments, self.num_replicas)[self.rank]
+
+        if self.num_workers > 1:
+            worker_segments = _split_segments(rank_segments, self.num_workers)
+            indices = self._interleave_batches([
+                self._rows_of_segments(segments, generator) for segments in worker_segments
+            ])
+        else:
+            indices = self._rows_of_segments(rank_segments, generator)
+
+        if indices.numel() < self.num_samples:
+            if indices.numel() == 0:
+                # fewer rows than ranks, fill up with a row of the other ranks
+                indices = torch.tensor([segments[0][1]], dtype=torch.long)
+            indices = indices.repeat(math.ceil(self.num_samples / indices.numel()))
+        return indices[:self.num_samples]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices()[self.step:].tolist())
+
+    def __len__(self) -> int:
+        return self.num_samples - self.step
+
+
+def _lengths_of(dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset], key: str) -> torch.Tensor:
+    if isinstance(dataset, ShardedSafetensorsDataset):
+        return torch.cat([_lengths_of(shard, key) for shard in dataset.shards])
+    value = dataset[key]
+    if isinstance(value, torch.Tensor) and value.is_nested:
+        # only the sizes are read, the buffer of the tensor is not touched
+        return value._nested_tensor_size()[:, 0]
+    elif isinstance(value, torch.Tensor) and value.is_sparse:
+        raise ValueError(f"Cannot determine the lengths of the rows of the sparse key {key}")
+    elif isinstance(value, torch.Tensor):
+        return torch.full((value.size(0),), value.size(1) if value.dim() > 1 else 1, dtype=torch.long)
+    return torch.tensor([elem.size(0) if elem.dim() > 0 else 1 for elem in value], dtype=torch.long)
+
+
+class LengthBucketedBatchSampler(torch.utils.data.Sampler[list[int]]):
+    """
+    Batch sampler that groups rows of similar length to reduce padding. The lengths are the sizes of the first
+    dimension of the rows of `key` and are read from the sizes of nested tensors, without touching their buffers.
+
+    Rows are shuffled and split into pools of `pool_size` rows, every pool is sorted by length and cut into
+    batches of at most `batch_size` rows and at most `max_tokens` padded elements, i.e. the number of rows of
+    a batch times the length of its longest row. The order of the batches is shuffled again, so consecutive
+    batches do not have increasing lengths. Use it as `batch_sampler` of a DataLoader, the batches are then
+    fetched with a single `__getitems__` call.
+    """
+
+    def __init__(
+        self,
+        dataset: Union[SafetensorsDataset, ShardedSafetensorsDataset],
+        key: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        lengths: Optional[Union[Sequence[int], torch.Tensor]] = None,
+        pool_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        drop_last: bool = False,
+    ):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("Either batch_size or max_tokens must be set")
+        if (key is None) == (lengths is None):
+            raise ValueError("Pass either the key to read the lengths from or the lengths")
+        self.lengths = _lengths_of(dataset, key) if lengths is None else torch.as_tensor(lengths, dtype=torch.long)
+        if self.lengths.numel() != len(dataset):
+            raise ValueError(f"Expected {len(dataset)} lengths, got {self.lengths.numel()}")
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size or self.lengths.numel()
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        # the batches of the last epoch they were built for, so that len() does not build them again
+        self._batches: Optional[tuple[int, list[list[int]]]] = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split_pool(self, indices: torch.Tensor, lengths: torch.Tensor) -> list[torch.Tensor]:
+        if self.max_tokens is None:
+            return list(torch.split(indices, self.batch_size))
+        batches = list()
+        start, longest = 0, 0
+        for pos, length in enumerate(lengths.tolist()):
+            # the pool is sorted, so the current row is the longest one of the batch
+            longest = max(longest, length)
+            num_rows = pos - start + 1
+            if pos > start and (
+                num_rows * longest > self.max_tokens
+                or (self.batch_size is not None and num_rows > self.batch_size)
+            ):
+                batches.append(indices[start:pos])
+                start, longest = pos, length
+        if start < indices.numel():
+            batches.append(indices[start:])
+        return batches
+
+    def batches(self) -> list[list[int]]:
+        """
+        The batches of this rank in the current epoch
+        """
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        num_rows = self.lengths.numel()
+        indices = torch.randperm(num_rows, generator=generator) if self.shuffle else torch.arange(num_rows)
+        batches = list()
+        for pool in torch.split(indices, self.pool_size):
+            pool_lengths, order = self.lengths[pool].sort(stable=True)
+            pool_batches = self._split_pool(pool[order], pool_lengths)
+            if self.drop_last and self.max_tokens is None and pool_batches and pool_batches[-1].numel() < self.batch_size:
+                pool_batches = pool_batches[:-1]
+            batches.extend(pool_batches)
+        if self.shuffle:
+            batches = [batches[pos] for pos in torch.randperm(len(batches), generator=generator).tolist()]
+        # every rank receives the same number of batches
+        num_batches = len(batches) // self.num_replicas * self.num_replicas
+        batches = [batch.tolist() for batch in batches[self.rank:num_batches:self.num_replicas]]
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        return iter(self.batches())
+
+    def __len__(self) -> int:
+        return len(self.batches())
@@ -1,6 +1,7 @@
 import inspect
 import warnings
 from collections import deque
+from pathlib import Path
 from typing import (
     Iterable,
     Mapping,
@@ -21,8 +22,10 @@ import safetensors.torch
 from more_itertools.more import first
 from tqdm import tqdm
 
-from safetensors_dataset.dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset
-from safetensors_dataset.utils import TensorLayout, _map_batch_into_dataset, _apply_function_to_iterable
+from safetensors_dataset.dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset, _map_to_file
+from safetensors_dataset.utils import (
+    TensorLayout, _map_batch_into_dataset, _apply_function_to_iterable, _apply_function_in_processes,
+)
 
 
 class CachingIterable:
@@ -200,7 +203,10 @@ class SequenceSafetensorsDataset:
         use_tqdm: bool = True,
         batched: bool = False,
         batch_size: int = 1,
-    ) -> "SafetensorsDataset":
+        num_proc: Optional[int] = None,
+        output_path: Optional[Union[str, Path]] = None,
+        writer_batch_size: int = 10000,
+    ) -> "SafetensorsDataset | ShardedSafetensorsDataset":
         pass
 
     def map(
@@ -211,20 +217,51 @@ class SequenceSafetensorsDataset:
         use_tqdm: bool = True,
         batched: bool = False,
         batch_size: int = 1,
-    ) -> "SafetensorsDataset":
-        def batch_fn():
-            for batch in more_itertools.batched(self.dataset, n=batch_size):
+        num_proc: Optional[int] = None,
+        output_path: Optional[Union[str, Path]] = None,
+        writer_batch_size: int = 10000,
+    ) -> "SafetensorsDataset | ShardedSafetensorsDataset":
+        def batch_fn(elements=None):
+            for batch in more_itertools.batched(self.dataset if elements is None else elements, n=batch_size):
                 out_batch = {_key: [] for _key in batch[0].keys()}
                 for _element in batch:
                     for _key, _value in out_batch.items():
                         _value.append(_element[_key])
                 yield out_batch
 
+        if num_proc is not None and num_proc > 1:
+            if output_path is not None:
+                raise ValueError("num_proc cannot be combined with output_path")
+            if not isinstance(self.dataset, Sequence):
+                # the workers index into the dataset, a generator avoids the length hint of CachingIterable
+                self.dataset = tuple(element for element in self.dataset)
+
+            def items_for_range(start: int, stop: int):
+                elements = (self.dataset[pos] for pos in range(start, stop))
+                return elements if not batched else batch_fn(elements)
+
+            dataset = _apply_function_in_processes(
+                func, items_for_range, len(self), batched, batch_size, num_proc, disable_tqdm=not use_tqdm
+            )
+            return SafetensorsDataset(dataset, preprocess=True)
+
         items = (
             self.dataset
             if not batched
             else batch_fn()
         )
+        if output_path is not None:
+            return _map_to_file(
+                func,
+                items,
+                len(self),
+                batched=batched,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                disable_tqdm=not use_tqdm,
+                output_path=output_path,
+                writer_batch_size=writer_batch_size,
+            )
 
         dataset = _apply_function_to_iterable(func, items, len(self), batched, batch_size, disable_tqdm=not use_tqdm)
 
@@ -0,0 +1,177 @@
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional, Union
+
+import torch
+import torch.distributed
+import torch.utils.data
+
+from safetensors_dataset.dict_dataset import SafetensorsDataset, ShardedSafetensorsDataset
+from safetensors_dataset.loading import load_safetensors
+from safetensors_dataset.utils import NestedBatchLayout, _concat_gathered_values, _gather_value
+
+
+def _read_chunk(shard: SafetensorsDataset, start: int, stop: int) -> SafetensorsDataset:
+    # copy a contiguous range of rows out of the (memory-mapped) shard
+    rows = torch.arange(start, stop)
+    return SafetensorsDataset({key: _gather_value(key, value, rows) for key, value in shard.dataset.items()})
+
+
+def _concat_chunks(first: SafetensorsDataset, second: SafetensorsDataset) -> SafetensorsDataset:
+    return SafetensorsDataset({
+        key: _concat_gathered_values(key, [value, second.dataset[key]]) for key, value in first.dataset.items()
+    })
+
+
+class StreamingSafetensorsDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset that reads the shards of a dataset sequentially in large contiguous chunks.
+
+    The rows of the dataset are split between all DataLoader workers of all ranks, every worker reads a
+    contiguous part of the dataset in chunks of `chunk_size` rows. Like DistributedSampler, every worker reads the
+    same number of rows, the parts are filled up with rows from the start of the dataset, or cut to the same size
+    if `drop_last` is set. While the rows of a chunk are being yielded, the next `readahead` chunks are read in a
+    background thread. With `batch_size`, batches as returned by `get_batch()` are yielded instead of single rows,
+    use `batch_size=None` in the DataLoader then. Batches are continued across chunks, so every worker yields the
+    same number of batches, only the last one may be smaller unless `drop_last` is set.
+
+    If the dataset is given as a path, it is opened memory-mapped in every worker process, so only the
+    chunks currently in use are resident in memory. The transforms of a given dataset (see `with_transform`)
+    are applied to the rows and batches that are yielded.
+    """
+
+    def __init__(
+        self,
+        dataset: Union[str, Path, SafetensorsDataset, ShardedSafetensorsDataset],
+        batch_size: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        readahead: int = 2,
+        columns: Optional[Iterable[str]] = None,
+        nested_layout: NestedBatchLayout = "padded",
+        padding_value: float = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        drop_last: bool = False,
+    ):
+        if isinstance(dataset, (str, Path)):
+            self.path = Path(dataset)
+            self.dataset = None
+        elif isinstance(dataset, (SafetensorsDataset, ShardedSafetensorsDataset)):
+            self.path = None
+            self.dataset = dataset
+        else:
+            raise ValueError(f"Cannot stream a {type(dataset)}")
+        if (rank is None) != (world_size is None):
+            raise ValueError("Pass both rank and world_size, or neither of them")
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size or (batch_size or 1) * 256
+        self.readahead = readahead
+        self.columns = tuple(columns) if columns is not None else None
+        self.nested_layout = nested_layout
+        self.padding_value = padding_value
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.path is not None:
+            # every worker opens the memory-mapped file itself
+            state["dataset"] = None
+        return state
+
+    def _load(self) -> Union[SafetensorsDataset, ShardedSafetensorsDataset]:
+        if self.dataset is None:
+            dataset = load_safetensors(self.path, mmap=True, columns=self.columns)
+            if not isinstance(dataset, (SafetensorsDataset, ShardedSafetensorsDataset)):
+                raise ValueError(f"Cannot stream a {type(dataset)}")
+            self.dataset = dataset
+        return self.dataset
+
+    def _shard_sizes(self) -> list[int]:
+        dataset = self._load()
+        if isinstance(dataset, ShardedSafetensorsDataset):
+            return dataset.shard_offsets.diff().tolist()
+        return [len(dataset)]
+
+    def _get_shard(self, pos: int) -> SafetensorsDataset:
+        dataset = self._load()
+        if isinstance(dataset, ShardedSafetensorsDataset):
+            return dataset.shards[pos]
+        return dataset
+
+    def _consumer(self) -> tuple[int, int]:
+        rank, world_size = self.rank, self.world_size
+        if rank is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            world_size = torch.distributed.get_world_size() if distributed else 1
+            rank = torch.distributed.get_rank() if distributed else 0
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return rank, world_size
+        return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+    def chunks(self) -> list[tuple[int, int, int]]:
+        """
+        The chunks (shard, start, stop) read by the calling process
+        """
+        shard_sizes = self._shard_sizes()
+        shard_offsets = torch.tensor([0] + shard_sizes, dtype=torch.long).cumsum(0).tolist()
+        total_size = shard_offsets[-1]
+        consumer, num_consumers = self._consumer()
+        if self.drop_last:
+            num_rows = total_size // num_consumers
+        else:
+            num_rows = -(-total_size // num_consumers)
+        if total_size == 0:
+            return []
+
+        # the positions past the end of the dataset wrap around to its start
+        chunks = list()
+        pos, end = consumer * num_rows, (consumer + 1) * num_rows
+        while pos < end:
+            row = pos % total_size
+            # empty shards share their offset with the next shard and are skipped
+            shard = bisect.bisect_right(shard_offsets, row) - 1
+            start = row - shard_offsets[shard]
+            stop = min(shard_sizes[shard], start + self.chunk_size, start + end - pos)
+            chunks.append((shard, start, stop))
+            pos += stop - start
+        return chunks
+
+    def _read_chunks(self) -> Iterator[SafetensorsDataset]:
+        chunks = deque(self.chunks())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            try:
+                while chunks or pending:
+                    while chunks and len(pending) <= self.readahead:
+                        shard, start, stop = chunks.popleft()
+                        pending.append(executor.submit(_read_chunk, self._get_shard(shard), start, stop))
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def __iter__(self) -> Iterator[Any]:
+        transforms = self._load()._transforms
+        # the rows of the last chunk that did not fill a batch
+        remainder = None
+        for chunk in self._read_chunks():
+            if self.batch_size is None:
+                chunk._transforms = transforms
+                yield from chunk.__getitems__(list(range(len(chunk))))
+                continue
+            if remainder is not None:
+                chunk = _concat_chunks(remainder, chunk)
+            chunk._transforms = transforms
+            num_full_rows = len(chunk) - len(chunk) % self.batch_size
+            for start in range(0, num_full_rows, self.batch_size):
+                rows = torch.arange(start, start + self.batch_size)
+                yield chunk.get_batch(rows, self.nested_layout, self.padding_value)
+            remainder = _read_chunk(chunk, num_full_rows, len(chunk)) if num_full_rows < len(chunk) else None
+        if remainder is not None and not self.drop_last:
+            remainder._transforms = transforms
+            yield remainder.get_batch(torch.arange(len(remainder)), self.nested_layout, self.padding_value)
@@ -2,10 +2,13 @@ import inspect
 import json
 from enum import Enum
 from pathlib import Path
-from typing import cast, MutableMapping, Mapping, Any, Sequence, Union, Generator
+from typing import (
+    cast, MutableMapping, Mapping, Any, Sequence, Union, Generator, Iterator, Literal, Optional, Callable, Iterable,
+)
 
 import torch
 from more_itertools import first
+from safetensors import safe_open
 from more_itertools.recipes import flatten
 from tqdm import tqdm
 
@@ -27,13 +30,15 @@ def slice_tensor(tensor: Any, s: slice):
         return tensor[s]
 
     if tensor.is_nested:
-        dim = tensor.size(0)
-        stop = min(s.stop if s.stop is not None else dim, dim)
-        step = s.step if s.step is not None else 1
-        return torch.nested.nested_tensor([tensor[pos] for pos in range(s.start, stop, step)])
+        return _gather_nested_tensor(tensor, torch.arange(*s.indices(tensor.size(0))))
+    elif tensor.is_sparse:
+        return _gather_sparse_tensor(tensor, torch.arange(*s.indices(tensor.size(0))))
     return tensor[s]
 
 
+NestedBatchLayout = Literal["padded", "jagged", "nested"]
+
+
 class TensorLayout(Enum):  # TensorStructure ?
     STANDARD = 1
     NO_TENSOR = 2
@@ -62,8 +67,122 @@ def _load_safetensors_metadata(fp: str | Path) -> dict[str, Any]:
         metadata = {k: json.loads(v) for k, v in metadata.items()}
         return metadata
 
+
+def _shard_directory(path: Path) -> Path:
+    # same layout as SafetensorsDict, data.safetensors -> data/index.json
+    if path.suffix == ".safetensors":
+        return path.parent / path.stem
+    return path
+
+
+def _save_shard_index(directory: Path, shard_offsets: Sequence[int]):
+    num_shards = len(shard_offsets) - 1
+    index = {
+        "num_shards": num_shards,
+        "shard_offsets": list(shard_offsets),
+        "shards": [f"shards.{pos}.safetensors" for pos in range(num_shards)],
+    }
+    with open(directory / "index.json", "w") as f:
+        json.dump(index, f, indent=2)
+
+
 _CHECK_INVARIANTS = False
 
+
+class _LazySafetensorsStorage(Mapping[str, torch.Tensor]):
+    """
+    Read-only mapping over the tensors of a safetensors file. Tensors are only created on access
+    and are views into the memory-mapped file, so no data is read before it is actually used.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.handle = safe_open(str(path), framework="pt", device="cpu")
+        self.storage_keys = frozenset(self.handle.keys())
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        if key not in self.storage_keys:
+            raise KeyError(key)
+        return self.handle.get_tensor(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.storage_keys
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.storage_keys)
+
+    def __len__(self) -> int:
+        return len(self.storage_keys)
+
+
+class _PrefixedStorage(Mapping[str, torch.Tensor]):
+    """
+    View of all tensors in `storage` that start with `prefix`, with the prefix removed from the keys
+    """
+
+    def __init__(self, storage: Mapping[str, torch.Tensor], prefix: str):
+        self.storage = storage
+        self.prefix = prefix
+        self.storage_keys = tuple(key[len(prefix):] for key in storage.keys() if key.startswith(prefix))
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        return self.storage[self.prefix + key]
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and (self.prefix + key) in self.storage
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.storage_keys)
+
+    def __len__(self) -> int:
+        return len(self.storage_keys)
+
+
+class _LazyRows(Sequence[torch.Tensor]):
+    """
+    Dataset value that is not held in memory as a whole, the rows are only materialized on access.
+    Subclasses implement `gather()`, which returns the requested rows as one dense, nested or sparse tensor.
+    """
+
+    def gather(self, indices: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def clone(self) -> "_LazyRows":
+        raise NotImplementedError
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.gather(torch.arange(*item.indices(len(self))))
+        elif isinstance(item, (Sequence, torch.Tensor)):
+            return self.gather(_index_tensor(item, len(self)))
+        return self.gather(_index_tensor([item], len(self)))[0]
+
+
+def _sparse_indices_are_coalesced(indices: torch.Tensor, size: Sequence[int]) -> bool:
+    # coalesced indices are sorted lexicographically without duplicates,
+    # i.e. their linearized positions are strictly increasing
+    if indices.size(1) < 2:
+        return True
+    strides = torch.tensor(tuple(size[1:]) + (1,), dtype=torch.long).flip(0).cumprod(0).flip(0)
+    linear_indices = (indices * strides.unsqueeze(1)).sum(dim=0)
+    return bool(linear_indices[1:].gt(linear_indices[:-1]).all())
+
+
+def _sparse_coo_tensor_from_storage(
+    indices: torch.Tensor,
+    values: torch.Tensor,
+    size: Sequence[int],
+    coalesced: Optional[bool] = None,
+) -> torch.Tensor:
+    # avoid the copy made by coalesce() if the stored indices are already coalesced,
+    # files without the recorded state are checked in a single pass over the indices
+    size = tuple(size)
+    if coalesced is None:
+        coalesced = _sparse_indices_are_coalesced(indices, size)
+    if coalesced:
+        return torch.sparse_coo_tensor(indices, values, size=size, is_coalesced=True, check_invariants=_CHECK_INVARIANTS)
+    return torch.sparse_coo_tensor(indices, values, size=size, check_invariants=_CHECK_INVARIANTS).coalesce()
+
 def _concat_sparse_tensors_of_different_shapes(tensors: Sequence[torch.Tensor], batched: bool):
     if not batched:
         tensors = [tensor.unsqueeze(0) for tensor in tensors]
@@ -87,6 +206,7 @@ def _concat_sparse_tensors_of_different_shapes(tensors: Sequence[torch.Tensor],
         values.append(tensor_values)
 
         max_sizes = tuple(max(tensor_size, max_size) for tensor_size, max_size in zip(tensor.shape, max_sizes))
+    max_sizes = (pos,) + max_sizes[1:]
 
     if numel > 0:
         indices = torch.cat(indices, dim=1)
@@ -104,12 +224,335 @@ def _concat_sparse_tensors_of_different_shapes(tensors: Sequence[torch.Tensor],
     )
 
 
+def _resolve_row_range(rows: slice, size: int) -> slice:
+    start, stop, step = rows.indices(size)
+    if step != 1:
+        raise ValueError(f"Only contiguous row ranges can be loaded, got a step of {step}")
+    return slice(start, max(start, stop))
+
+
+def _rows_of_rank(rank: int, world_size: int, size: int) -> slice:
+    # contiguous and balanced split of `size` rows over `world_size` ranks
+    if not 0 <= rank < world_size:
+        raise ValueError(f"rank must be in [0, {world_size}), got {rank}")
+    return slice(size * rank // world_size, size * (rank + 1) // world_size)
+
+
+def _nested_tensor_rows_from_storage(
+    buffer: torch.Tensor,
+    sizes: torch.Tensor,
+    strides: torch.Tensor,
+    storage_offsets: torch.Tensor,
+    rows: slice,
+) -> torch.Tensor:
+    # view of the rows in `rows`, the offsets are relative to the storage of the buffer,
+    # so the buffer is kept whole and only the parts of it belonging to these rows are ever read
+    return torch._nested_view_from_buffer(buffer, sizes[rows], strides[rows], storage_offsets[rows])
+
+
+def _sparse_coo_tensor_rows_from_storage(
+    indices: torch.Tensor,
+    values: torch.Tensor,
+    size: Sequence[int],
+    rows: slice,
+    coalesced: Optional[bool] = None,
+) -> torch.Tensor:
+    # the rows of a coalesced tensor are sorted, so the range of entries of `rows` is found with a binary search
+    first_indices = indices[0]
+    if coalesced is None and first_indices.size(0) > 1 and not bool(first_indices[1:].ge(first_indices[:-1]).all()):
+        coalesced = False
+    if coalesced is False:
+        tensor = _sparse_coo_tensor_from_storage(indices, values, size, coalesced)
+        return _gather_sparse_tensor(tensor, torch.arange(rows.start, rows.stop))
+    bounds = torch.searchsorted(first_indices, torch.tensor([rows.start, rows.stop], dtype=first_indices.dtype))
+    start, stop = bounds.tolist()
+    indices = indices[:, start:stop].clone()
+    indices[0] -= rows.start
+    size = (rows.stop - rows.start,) + tuple(size[1:])
+    return _sparse_coo_tensor_from_storage(indices, values[start:stop], size, coalesced)
+
+
+def _clone_value(value: Any) -> Any:
+    # copy a value so that it no longer references the storage it was loaded from
+    if isinstance(value, list):
+        return [_clone_value(elem) for elem in value]
+    elif isinstance(value, _LazyRows):
+        return value.clone()
+    elif not isinstance(value, torch.Tensor):
+        return value
+    elif value.is_nested:
+        # only copies the parts of the buffer that belong to the rows of the tensor
+        return _gather_nested_tensor(value, torch.arange(value.size(0)))
+    elif value.is_sparse:
+        return torch.sparse_coo_tensor(
+            value._indices().clone(),
+            value._values().clone(),
+            size=value.shape,
+            is_coalesced=value.is_coalesced(),
+            check_invariants=_CHECK_INVARIANTS,
+        )
+    return value.clone()
+
+
+def _is_view_of_larger_storage(tensor: torch.Tensor) -> bool:
+    return tensor.untyped_storage().nbytes() > tensor.numel() * tensor.element_size()
+
+
+def _compact_value(value: Any) -> Any:
+    # copy values that are views of a larger storage, f. e. shards that share the storage of their
+    # dataset, so that only their own elements are saved, values that own their storage are kept
+    if isinstance(value, list):
+        return [_compact_value(elem) for elem in value]
+    elif not isinstance(value, torch.Tensor):
+        return value
+    elif value.is_nested:
+        buffer_numel = int(value._nested_tensor_size().prod(dim=1).sum()) if value.size(0) > 0 else 0
+        if value.values().numel() > buffer_numel or any(
+            _is_view_of_larger_storage(component)
+            for component in (
+                value._nested_tensor_size(), value._nested_tensor_strides(), value._nested_tensor_storage_offsets(),
+            )
+        ):
+            return _gather_nested_tensor(value, torch.arange(value.size(0)))
+        return value
+    elif value.is_sparse:
+        if _is_view_of_larger_storage(value._indices()) or _is_view_of_larger_storage(value._values()):
+            return _clone_value(value)
+        return value
+    elif _is_view_of_larger_storage(value):
+        return value.clone()
+    return value
+
+
+def _share_memory_of_value(value: Any) -> Any:
+    # moves the backing buffers of dense, nested and sparse tensors into shared memory
+    if isinstance(value, list):
+        return [_share_memory_of_value(elem) for elem in value]
+    elif not isinstance(value, torch.Tensor):
+        return value
+    elif value.is_nested:
+        return torch._nested_view_from_buffer(
+            value.values().share_memory_(),
+            value._nested_tensor_size().share_memory_(),
+            value._nested_tensor_strides().share_memory_(),
+            value._nested_tensor_storage_offsets().share_memory_(),
+        )
+    elif value.is_sparse:
+        value._indices().share_memory_()
+        value._values().share_memory_()
+        return value
+    return value.share_memory_()
+
+
+def _value_is_shared(value: Any) -> bool:
+    if isinstance(value, list):
+        return all(_value_is_shared(elem) for elem in value)
+    elif not isinstance(value, torch.Tensor):
+        return False
+    elif value.is_nested:
+        return value.values().is_shared()
+    elif value.is_sparse:
+        return value._indices().is_shared() and value._values().is_shared()
+    return value.is_shared()
+
+
+def _index_tensor(indices: Sequence[int] | torch.Tensor, size: int) -> torch.Tensor:
+    indices = torch.as_tensor(indices, dtype=torch.long)
+    indices = torch.where(indices < 0, indices + size, indices)
+    if indices.numel() > 0 and (indices.min() < 0 or indices.max() >= size):
+        raise IndexError(f"Indices out of range for dimension of size {size}")
+    return indices
+
+
+def _ranges_to_positions(starts: torch.Tensor, counts: torch.Tensor) -> torch.Tensor:
+    # concatenation of arange(start, start + count) for all ranges, without a python loop
+    total = int(counts.sum())
+    range_offsets = counts.cumsum(0) - counts
+    shift = (starts - range_offsets).repeat_interleave(counts, output_size=total)
+    return torch.arange(total, dtype=torch.long) + shift
+
+
+def _contiguous_nested_strides(sizes: torch.Tensor) -> torch.Tensor:
+    ones = torch.ones_like(sizes[:, :1])
+    return torch.cat((sizes[:, 1:], ones), dim=1).flip(1).cumprod(1).flip(1)
+
+
+def _gather_nested_tensor(tensor: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """
+    Select the rows `indices` of a nested tensor into a new nested tensor with a
+    single gather on the underlying buffer.
+    """
+    if type(tensor) is not torch.Tensor or indices.numel() == 0:
+        return torch.nested.nested_tensor([tensor[i] for i in indices.tolist()])
+    sizes = tensor._nested_tensor_size()[indices]
+    strides = tensor._nested_tensor_strides()[indices]
+    if not strides.equal(_contiguous_nested_strides(sizes)):
+        # elements of a row are not stored consecutively in the buffer
+        return torch.nested.nested_tensor([tensor[i] for i in indices.tolist()])
+    storage_offsets = tensor._nested_tensor_storage_offsets()[indices]
+    numels = sizes.prod(dim=1)
+    buffer = tensor.values()[_ranges_to_positions(storage_offsets, numels)]
+    return torch._nested_view_from_buffer(buffer, sizes, strides, numels.cumsum(0) - numels)
+
+
+def _gather_sparse_tensor(tensor: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """
+    Select the rows `indices` of a sparse tensor, the nonzero elements of every row are
+    located with a binary search on the sorted indices of a coalesced tensor.
+    """
+    if not tensor.is_coalesced():
+        return tensor.index_select(0, indices)
+    tensor_indices, tensor_values = tensor._indices(), tensor._values()
+    rows = tensor_indices[0].contiguous()
+    starts = torch.searchsorted(rows, indices)
+    counts = torch.searchsorted(rows, indices, right=True) - starts
+    positions = _ranges_to_positions(starts, counts)
+    gathered_indices = tensor_indices[:, positions]
+    gathered_indices[0] = torch.arange(indices.numel()).repeat_interleave(counts, output_size=positions.numel())
+    return torch.sparse_coo_tensor(
+        gathered_indices,
+        tensor_values[positions],
+        size=(indices.numel(),) + tensor.shape[1:],
+        is_coalesced=True,
+        check_invariants=_CHECK_INVARIANTS,
+    )
+
+
+def _gather_value(key: str, value: Any, indices: torch.Tensor) -> Any:
+    """
+    Select the rows `indices` of a dataset value as one batched value, i.e. a dense, nested or sparse
+    tensor for tensor values and a list for everything else
+    """
+    if isinstance(value, torch.Tensor):
+        indices = _index_tensor(indices, value.size(0))
+        if value.is_nested:
+            return _gather_nested_tensor(value, indices)
+        elif value.is_sparse:
+            return _gather_sparse_tensor(value, indices)
+        return value[indices]
+    elif isinstance(value, _LazyRows):
+        return value.gather(_index_tensor(indices, len(value)))
+    elif isinstance(value, Sequence):
+        elements = [value[pos] for pos in _index_tensor(indices, len(value)).tolist()]
+        if len(elements) == 0 or not all(isinstance(element, torch.Tensor) for element in elements):
+            return elements
+        elif len(set(map(lambda t: t.shape, elements))) == 1 and not first(elements).is_sparse:
+            return torch.stack(elements, dim=0)
+        elif not any(map(lambda t: t.is_sparse, elements)):
+            return torch.nested.nested_tensor(elements)
+        return _concat_sparse_tensors_of_different_shapes(elements, batched=False)
+    raise ValueError(f"{key} must be a torch.Tensor or a Sequence, got {type(value)}")
+
+
+def _concat_gathered_values(key: str, values: Sequence[Any]) -> Any:
+    """
+    Concatenate values returned by _gather_value() for different parts of a batch
+    """
+    if len(values) == 1:
+        return values[0]
+    elif not all(isinstance(value, torch.Tensor) for value in values):
+        return list(flatten(values))
+    elif any(value.is_sparse for value in values):
+        return _concat_sparse_tensors_of_different_shapes(values, batched=True)
+    elif not any(value.is_nested for value in values) and len(set(map(lambda t: t.shape[1:], values))) == 1:
+        return torch.cat(values, dim=0)
+    elif not all(value.dim() == values[0].dim() for value in values):
+        raise ValueError(f"Cannot concatenate {key} with different dimensions")
+    return torch.cat([value if value.is_nested else torch.nested.as_nested_tensor(value) for value in values], dim=0)
+
+
+def _collate_gathered_batch(
+    batch: Mapping[str, Any],
+    nested_layout: NestedBatchLayout = "padded",
+    padding_value: float = 0,
+) -> dict[str, Any]:
+    """
+    Convert the nested tensors of a gathered batch into the requested layout. In the padded layout, every nested key
+    `key` is returned as a padded tensor and the lengths of its rows as `key.lengths`, or their full shapes if the
+    rows have more than one dimension.
+    """
+    out = dict()
+    for key, value in batch.items():
+        if not isinstance(value, torch.Tensor) or not value.is_nested or nested_layout == "nested":
+            out[key] = value
+            continue
+
+        sizes = value._nested_tensor_size()
+        if nested_layout == "padded":
+            if value.size(0) == 0:
+                out[key] = value.values().new_empty((0,) + (0,) * sizes.size(1))
+            else:
+                out[key] = torch.nested.to_padded_tensor(value, padding_value)
+            out[key + ".lengths"] = sizes[:, 0] if sizes.size(1) == 1 else sizes
+        elif nested_layout == "jagged":
+            if sizes.size(0) > 0 and not sizes[:, 1:].eq(sizes[:1, 1:]).all():
+                raise ValueError(f"The jagged layout requires {key} to only vary in the first dimension")
+            if not value.is_contiguous():
+                value = _gather_nested_tensor(value, torch.arange(value.size(0)))
+            lengths = sizes[:, 0]
+            offsets = torch.cat((lengths.new_zeros((1,)), lengths.cumsum(0)))
+            inner_shape = tuple(sizes[0, 1:].tolist()) if sizes.size(0) > 0 else ()
+            values = value.values().view((-1,) + inner_shape)
+            out[key] = torch.nested.nested_tensor_from_jagged(values, offsets)
+        else:
+            raise ValueError(f"Unknown nested layout {nested_layout}")
+    return out
+
+
+def _apply_transforms(
+    transforms: Sequence[Callable[[dict[str, Any]], dict[str, Any]]],
+    batch: dict[str, Any],
+) -> dict[str, Any]:
+    for transform in transforms:
+        batch = transform(batch)
+    return batch
+
+
+def _unbind_batch(batch: Mapping[str, Any], num_rows: int) -> list[dict[str, Any]]:
+    """
+    Split a batch as returned by get_batch() with the nested layout "nested" into its samples
+    """
+    rows_per_key = dict()
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor) and value.dim() == 0:
+            raise ValueError(f"Expected {num_rows} rows for {key}, got a scalar")
+        elif isinstance(value, torch.Tensor) and (value.is_nested or value.layout == torch.strided):
+            rows = value.unbind(0)
+        elif isinstance(value, torch.Tensor):
+            rows = [value[pos] for pos in range(value.size(0))]
+        else:
+            rows = list(value)
+        if len(rows) != num_rows:
+            raise ValueError(f"Expected {num_rows} rows for {key}, got {len(rows)}")
+        rows_per_key[key] = rows
+    return [{key: rows[pos] for key, rows in rows_per_key.items()} for pos in range(num_rows)]
+
+
 def _maybe_wrap_index(pos: int, size: int) -> int:
     if pos < 0:
         return size + pos
     return pos
 
 
+def _collect_output(
+    output: Union[Sequence[Mapping[str, Any]], Generator[Mapping[str, Any], None, None], Mapping[str, Any]],
+    target: MutableMapping[str, list[Any]],
+):
+    if isinstance(output, bool) and output is False:
+        return
+    elif (
+        isinstance(output, Sequence)
+        or inspect.isgenerator(output)
+    ):
+        for element in output:
+            _collect_output(element, target)
+    else:
+        for key, value in output.items():
+            if key not in target:
+                target[key] = list()
+            target[key].append(value)
+
+
 def _apply_function_to_iterable(
     func,
     iterable,
@@ -117,27 +560,17 @@ def _apply_function_to_iterable(
     batched: bool,
     batch_size: int,
     disable_tqdm: bool = False,
+    writer=None,
+    writer_batch_size: Optional[int] = None,
 ):
-    def _collect_output(
-        output: Union[Sequence[Mapping[str, Any]], Generator[Mapping[str, Any], None, None], Mapping[str, Any]],
-        target: MutableMapping[str, list[Any]],
-    ):
-        if isinstance(output, bool) and output is False:
-            return
-        elif (
-            isinstance(output, Sequence)
-            or inspect.isgenerator(output)
-        ):
-            for element in output:
-                _collect_output(element, target)
-        else:
-            for key, value in output.items():
-                if key not in target:
-                    target[key] = list()
-                target[key].append(value)
-
+    """
+    Apply `func` to all items of `iterable` and collect the outputs into a dataset. With `writer`, the outputs
+    collected for every `writer_batch_size` input elements are written to it instead, so that only these
+    outputs are held in memory at any time.
+    """
     out = {}
     done = 0
+    pending = 0
     desc = getattr(func, "__name__", None)
     with tqdm(desc=desc, disable=disable_tqdm, total=numel) as progress_bar:
         for pos, item in enumerate(iterable):
@@ -148,9 +581,82 @@ def _apply_function_to_iterable(
             progress_bar.update(progress)
             done += progress
 
+            pending += progress
+            if writer is not None and pending >= writer_batch_size:
+                writer.write_batch(_map_into_dataset(out, batched=batched))
+                out, pending = {}, 0
+
+    if writer is not None:
+        if out:
+            writer.write_batch(_map_into_dataset(out, batched=batched))
+        return None
     return _map_into_dataset(out, batched=batched)
 
 
+# state of the map() running in the parent process, inherited by the forked workers of the pool
+_map_worker_state: Optional[tuple[Callable, Callable[[int, int], Iterable], bool, int]] = None
+
+
+def _apply_function_to_range_in_worker(bounds: tuple[int, int]) -> MutableMapping[str, Any]:
+    func, items_for_range, batched, batch_size = _map_worker_state
+    start, stop = bounds
+    return _apply_function_to_iterable(
+        func,
+        items_for_range(start, stop),
+        stop - start,
+        batched=batched,
+        batch_size=batch_size,
+        disable_tqdm=True,
+    )
+
+
+def _apply_function_in_processes(
+    func,
+    items_for_range: Callable[[int, int], Iterable],
+    numel: int,
+    batched: bool,
+    batch_size: int,
+    num_proc: int,
+    disable_tqdm: bool = False,
+):
+    """
+    Parallel version of _apply_function_to_iterable(). The range [0, numel) is split into num_proc contiguous chunks,
+    each chunk is mapped by a forked worker process over the items returned by items_for_range(start, stop) and
+    the results are concatenated in the order of the chunks. Workers inherit func and the source data from the
+    parent, so neither has to be picklable.
+    """
+    chunk_size = -(-numel // max(num_proc, 1))
+    if batched:
+        # keep the batches identical to the ones of a serial map()
+        chunk_size = -(-chunk_size // batch_size) * batch_size
+    bounds = [(start, min(start + chunk_size, numel)) for start in range(0, numel, max(chunk_size, 1))]
+    if len(bounds) <= 1:
+        return _apply_function_to_iterable(
+            func, items_for_range(0, numel), numel, batched, batch_size, disable_tqdm=disable_tqdm
+        )
+    if "fork" not in torch.multiprocessing.get_all_start_methods():
+        raise ValueError("num_proc > 1 requires the 'fork' start method")
+
+    global _map_worker_state
+    _map_worker_state = (func, items_for_range, batched, batch_size)
+    chunks = list()
+    desc = getattr(func, "__name__", None)
+    try:
+        context = torch.multiprocessing.get_context("fork")
+        with context.Pool(len(bounds)) as pool, tqdm(desc=desc, disable=disable_tqdm, total=numel) as progress_bar:
+            for (start, stop), chunk in zip(bounds, pool.imap(_apply_function_to_range_in_worker, bounds)):
+                chunks.append(chunk)
+                progress_bar.update(stop - start)
+    finally:
+        _map_worker_state = None
+
+    keys = dict.fromkeys(key for chunk in chunks for key in chunk.keys())
+    return {
+        key: _concat_gathered_values(key, [chunk[key] for chunk in chunks if key in chunk])
+        for key in keys
+    }
+
+
 def _batched_map_into_dataset(
     dataset: Mapping[str, list[torch.Tensor] | tuple[torch.Tensor, ...]]
 ) -> MutableMapping[str, torch.Tensor]:
@@ -0,0 +1,313 @@
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence, Union
+
+import torch
+
+from safetensors_dataset.version import __version__
+from safetensors_dataset.utils import (
+    _contiguous_nested_strides, _gather_nested_tensor, _gather_value, _save_shard_index, _shard_directory,
+)
+
+_SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+class _TemporaryTensorFile:
+    def __init__(self, path: Path, buffer_size: int):
+        self.path = path
+        self.file = open(path, "wb", buffering=buffer_size)
+        self.nbytes = 0
+
+    def write(self, tensor: torch.Tensor):
+        data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+        self.file.write(data.data)
+        self.nbytes += data.nbytes
+
+    def close(self):
+        self.file.close()
+
+
+# storage key, dtype, shape and the files that contain the data of the tensor in order
+_storage_entry_t = tuple[str, torch.dtype, tuple[int, ...], list[_TemporaryTensorFile]]
+
+
+class _ColumnWriter:
+    """
+    Appends the rows of a single key to temporary files, with the same layout that pack_single_tensor uses
+    """
+
+    def __init__(self, key: str, directory: Path, buffer_size: int):
+        self.key = key
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.files: dict[str, _TemporaryTensorFile] = dict()
+        self.dtype: Optional[torch.dtype] = None
+        self.sparse: Optional[bool] = None
+        self.num_rows = 0
+        # shape of the first row, or the largest shape for sparse keys
+        self.row_shape: Optional[tuple[int, ...]] = None
+        self.uniform = True
+        self.numel = 0
+        self.values_shape: tuple[int, ...] = ()
+
+    def _file(self, name: str) -> _TemporaryTensorFile:
+        if name not in self.files:
+            self.files[name] = _TemporaryTensorFile(self.directory / f"{self.key}.{name}", self.buffer_size)
+        return self.files[name]
+
+    def _check(self, tensor: torch.Tensor, sparse: bool):
+        if self.dtype is None:
+            if tensor.dtype not in _SAFETENSORS_DTYPES:
+                raise ValueError(f"Cannot write {self.key} with dtype {tensor.dtype}")
+            self.dtype = tensor.dtype
+            self.sparse = sparse
+        elif tensor.dtype != self.dtype:
+            raise ValueError(f"{self.key} was written with dtype {self.dtype}, got {tensor.dtype}")
+        elif sparse != self.sparse:
+            raise ValueError(f"Cannot mix sparse and non-sparse values for {self.key}")
+
+    def _check_row_dims(self, row_dims: int):
+        if self.row_shape is not None and row_dims != len(self.row_shape):
+            raise ValueError(f"Elements of '{self.key}' are of different dimensionality")
+
+    def append_rows(self, values: torch.Tensor, sizes: torch.Tensor):
+        self._check(values, sparse=False)
+        if sizes.size(0) == 0:
+            return
+        self._check_row_dims(sizes.size(1))
+        if self.row_shape is None:
+            self.row_shape = tuple(sizes[0].tolist())
+        self.uniform = self.uniform and bool(sizes.eq(torch.tensor(self.row_shape, dtype=torch.long)).all())
+
+        numels = sizes.prod(dim=1)
+        self._file("buffer").write(values)
+        self._file("sizes").write(sizes)
+        if sizes.size(1) > 1:
+            self._file("strides").write(_contiguous_nested_strides(sizes))
+            self._file("storage_offsets").write(numels.cumsum(0) - numels + self.numel)
+        self.numel += int(numels.sum())
+        self.num_rows += sizes.size(0)
+
+    def append_sparse(self, tensor: torch.Tensor):
+        self._check(tensor, sparse=True)
+        tensor = tensor.coalesce()
+        row_shape = tuple(tensor.shape[1:])
+        self._check_row_dims(len(row_shape))
+        self.row_shape = row_shape if self.row_shape is None else tuple(map(max, self.row_shape, row_shape))
+        self.values_shape = tuple(tensor._values().shape[1:])
+
+        indices = tensor._indices()
+        self._file("indices.0").write(indices[0] + self.num_rows)
+        for dim in range(1, indices.size(0)):
+            self._file(f"indices.{dim}").write(indices[dim])
+        if self.dtype != torch.bool:
+            self._file("values").write(tensor._values())
+        self.numel += indices.size(1)
+        self.num_rows += tensor.size(0)
+
+    def append(self, value: Any, num_rows: int):
+        if isinstance(value, (list, tuple)):
+            for element in value:
+                if not isinstance(element, torch.Tensor):
+                    raise ValueError(f"Elements of '{self.key}' must be tensors, got {type(element)}")
+                self.append(element.unsqueeze(0), 1)
+        elif not isinstance(value, torch.Tensor):
+            raise ValueError(f"{self.key} must be a tensor or a list of tensors, got {type(value)}")
+        elif value.is_sparse:
+            self.append_sparse(value)
+        elif value.is_nested:
+            if not value.is_contiguous():
+                value = _gather_nested_tensor(value, torch.arange(value.size(0)))
+            self.append_rows(value.values(), value._nested_tensor_size())
+        else:
+            sizes = torch.tensor(value.shape[1:], dtype=torch.long).expand(num_rows, value.dim() - 1)
+            self.append_rows(value, sizes)
+
+    def storage(self) -> tuple[list[_storage_entry_t], Optional[dict[str, Any]]]:
+        for file in self.files.values():
+            file.close()
+
+        key, row_shape = self.key, self.row_shape or ()
+        if self.sparse:
+            indices = [self.files[f"indices.{dim}"] for dim in range(len(self.files)) if f"indices.{dim}" in self.files]
+            metadata = {
+                "sparse": True,
+                "dtype": repr(self.dtype),
+                "dims": [self.num_rows, *row_shape],
+                "numel": self.num_rows,
+                # every part is coalesced and starts after the rows of the previous part
+                "coalesced": True,
+            }
+            indices_shape = (len(indices), self.numel)
+            if self.dtype == torch.bool:
+                return [(key, torch.long, indices_shape, indices)], metadata
+            return [
+                (key + ".indices", torch.long, indices_shape, indices),
+                (key + ".values", self.dtype, (self.numel,) + self.values_shape, [self.files["values"]]),
+            ], metadata
+        elif self.uniform:
+            buffer = [self.files["buffer"]] if "buffer" in self.files else []
+            return [(key, self.dtype or torch.float, (self.num_rows, *row_shape), buffer)], None
+
+        sizes_shape = (self.num_rows, len(row_shape))
+        entries = [
+            (key + ".buffer", self.dtype, (self.numel,), [self.files["buffer"]]),
+            (key + ".sizes", torch.long, sizes_shape, [self.files["sizes"]]),
+        ]
+        if "strides" in self.files:
+            entries.append((key + ".strides", torch.long, sizes_shape, [self.files["strides"]]))
+            entries.append((key + ".storage_offsets", torch.long, (self.num_rows,), [self.files["storage_offsets"]]))
+        return entries, {"nested": True, "dtype": repr(self.dtype), "numel": self.num_rows}
+
+
+def _write_safetensors_file(path: Path, entries: list[_storage_entry_t], metadata: dict[str, str], buffer_size: int):
+    # like safetensors, store larger dtypes first so that every tensor is aligned
+    entries = sorted(entries, key=lambda entry: entry[1].itemsize, reverse=True)
+    header: dict[str, Any] = dict()
+    offset = 0
+    for key, dtype, shape, files in entries:
+        nbytes = sum(file.nbytes for file in files)
+        header[key] = {"dtype": _SAFETENSORS_DTYPES[dtype], "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header["__metadata__"] = metadata
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, byteorder="little", signed=False))
+        f.write(header_bytes)
+        for _, _, _, files in entries:
+            for file in files:
+                with open(file.path, "rb") as data:
+                    shutil.copyfileobj(data, f, buffer_size)
+
+
+class SafetensorsDatasetWriter:
+    """
+    Write a dataset that is larger than the available memory. Samples or batches are appended to temporary files
+    per key and combined into a safetensors file on close(), so memory usage is bounded by the write buffers.
+    With `shard_size`, a new file is started every `shard_size` elements, in the same layout as
+    `ShardedSafetensorsDataset.save_to_file(path, separate_files=True)`.
+    """
+
+    def __init__(self, path: Union[str, Path], shard_size: Optional[int] = None, buffer_size: int = 2 ** 20):
+        self.path = Path(path)
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        if shard_size is not None:
+            self.directory = _shard_directory(self.path)
+            self.directory.mkdir(parents=True, exist_ok=True)
+        else:
+            self.directory = self.path.parent
+        self.shard_offsets = [0]
+        self.keys: Optional[set[str]] = None
+        self.columns: dict[str, _ColumnWriter] = dict()
+        self.temporary_directory: Optional[Path] = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._remove_temporary_files()
+
+    def __len__(self):
+        return self.shard_offsets[-1] + self._rows_in_shard()
+
+    def _rows_in_shard(self) -> int:
+        return next((column.num_rows for column in self.columns.values()), 0)
+
+    def write(self, sample: Mapping[str, torch.Tensor]):
+        self.write_batch({key: [value] for key, value in sample.items()})
+
+    def write_batch(self, batch: Mapping[str, Union[torch.Tensor, Sequence[torch.Tensor]]]):
+        if self.closed:
+            raise ValueError("Cannot write to a closed writer")
+        for key in batch.keys():
+            if "." in key:
+                raise ValueError(f". is not allowed in a safetensors dataset (used in {key})")
+        if self.keys is None:
+            self.keys = set(batch.keys())
+        elif set(batch.keys()) != self.keys:
+            raise ValueError(f"Expected keys {self.keys}, got {set(batch.keys())}")
+        batch_sizes = {key: len(value) if not isinstance(value, torch.Tensor) else value.size(0) for key, value in batch.items()}
+        if len(set(batch_sizes.values())) > 1:
+            raise ValueError(f"All keys of a batch must have the same number of elements, got {batch_sizes}")
+        batch_size = next(iter(batch_sizes.values()), 0)
+
+        start = 0
+        while start < batch_size:
+            end = batch_size
+            if self.shard_size is not None:
+                end = min(end, start + self.shard_size - self._rows_in_shard())
+            if start == 0 and end == batch_size:
+                part = batch
+            else:
+                indices = torch.arange(start, end)
+                part = {key: _gather_value(key, value, indices) for key, value in batch.items()}
+            self._write_part(part, end - start)
+            start = end
+            if self.shard_size is not None and self._rows_in_shard() == self.shard_size:
+                self._finish_file()
+
+    def _write_part(self, batch: Mapping[str, Any], num_rows: int):
+        if self.temporary_directory is None:
+            self.temporary_directory = Path(tempfile.mkdtemp(prefix=".safetensors-", dir=self.directory))
+        for key, value in batch.items():
+            if key not in self.columns:
+                self.columns[key] = _ColumnWriter(key, self.temporary_directory, self.buffer_size)
+            self.columns[key].append(value, num_rows)
+
+    def _finish_file(self):
+        num_rows = self._rows_in_shard()
+        if self.shard_size is not None:
+            path = self.directory / f"shards.{len(self.shard_offsets) - 1}.safetensors"
+        else:
+            path = self.path
+
+        entries, metadata = list(), {"size": num_rows, "version": __version__}
+        for key, column in self.columns.items():
+            column_entries, column_metadata = column.storage()
+            entries.extend(column_entries)
+            if column_metadata is not None:
+                metadata[key] = column_metadata
+        metadata = {k: json.dumps(v) for k, v in metadata.items()}
+        _write_safetensors_file(path, entries, metadata, self.buffer_size)
+
+        self.shard_offsets.append(self.shard_offsets[-1] + num_rows)
+        self._remove_temporary_files()
+        self.columns = dict()
+
+    def _remove_temporary_files(self):
+        for column in self.columns.values():
+            for file in column.files.values():
+                file.close()
+        if self.temporary_directory is not None:
+            shutil.rmtree(self.temporary_directory, ignore_errors=True)
+            self.temporary_directory = None
+
+    def close(self):
+        if self.closed:
+            return
+        if self.shard_size is None or self._rows_in_shard() > 0:
+            self._finish_file()
+        if self.shard_size is not None:
+            _save_shard_index(self.directory, self.shard_offsets)
+        self._remove_temporary_files()
+        self.closed = True
@@ -0,0 +1,145 @@
+import importlib.util
+import os
+import unittest
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import SafetensorsDataset, load_safetensors
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+from safetensors_dataset.encoding import _ChunkedTensor
+from safetensors_dataset.utils import _load_safetensors_metadata
+
+
+def available_compression_codecs():
+    codecs = ["zlib"]
+    if importlib.util.find_spec("zstandard") is not None:
+        codecs.append("zstd")
+    if importlib.util.find_spec("lz4") is not None:
+        codecs.append("lz4")
+    return codecs
+
+
+class EncodingTestCase(TestCase):
+    def setUp(self):
+        self.path = Path("encoding_test.safetensors")
+        self.dataset = SafetensorsDataset.from_dict({
+            "labels": torch.randint(5, (50,)),
+            "features": torch.randn((50, 4)),
+            "positions": torch.arange(50 * 3).view(50, 3) * 1000,
+            "tokens": torch.nested.nested_tensor([torch.randint(30000, (pos % 7 + 1,)) for pos in range(50)]),
+            "matrices": torch.nested.nested_tensor([torch.randint(100, (pos % 3 + 1, 2)) for pos in range(50)]),
+            "sparse": torch.randint(4, (50, 30)).eq(0).to_sparse().long(),
+            "mask": torch.randint(4, (50, 30)).eq(0).to_sparse(),
+        })
+
+    def tearDown(self):
+        if self.path.exists():
+            os.remove(self.path)
+
+    def assertDatasetEqual(self, dataset, other):
+        self.assertEqual(dataset.keys(), other.keys())
+        for key in dataset.keys():
+            value, other_value = dataset[key], other[key]
+            self.assertEqual(value.dtype, other_value.dtype, key)
+            if value.is_sparse:
+                value, other_value = value.to_dense(), other_value.to_dense()
+            if value.is_nested:
+                self.assertTrue(all(a.equal(b) for a, b in zip(value.unbind(), other_value.unbind())), key)
+            else:
+                self.assertTrue(value.equal(other_value), key)
+
+    def test_roundtrip(self):
+        for codec in available_compression_codecs():
+            encodings = {key: ("delta", "narrow", codec) for key in self.dataset.keys()}
+            for mmap in (False, True):
+                with self.subTest(codec=codec, mmap=mmap):
+                    self.dataset.save_to_file(self.path, encodings=encodings)
+                    self.assertDatasetEqual(self.dataset, SafetensorsDataset.load_from_file(self.path, mmap=mmap))
+
+    def test_narrow(self):
+        self.dataset.save_to_file(self.path)
+        raw_size = self.path.stat().st_size
+        self.dataset.save_to_file(self.path, encodings={"labels": "narrow", "tokens": "narrow", "features": "narrow"})
+        metadata = _load_safetensors_metadata(self.path)
+        self.assertEqual(metadata["labels"]["encodings"]["labels"]["narrow_dtype"], "torch.uint8")
+        self.assertEqual(metadata["tokens"]["encodings"]["tokens.buffer"]["narrow_dtype"], "torch.int16")
+        # floating point tensors cannot be narrowed
+        self.assertNotIn("features", metadata)
+        self.assertLess(self.path.stat().st_size, raw_size - 50 * 7 - 50 * 6)
+        self.assertDatasetEqual(self.dataset, load_safetensors(self.path))
+
+    def test_load_columns_and_rows(self):
+        self.dataset.save_to_file(self.path, encodings={"positions": ("delta", "narrow"), "sparse": ("delta", "zlib")})
+        loaded = SafetensorsDataset.load_from_file(self.path, columns=("positions", "sparse"), rows=slice(10, 20))
+        self.assertTrue(loaded["positions"].equal(self.dataset["positions"][10:20]))
+        self.assertTrue(loaded["sparse"].to_dense().equal(self.dataset["sparse"].to_dense()[10:20]))
+
+    def test_sharded(self):
+        sharded = ShardedSafetensorsDataset.concat([self.dataset.select(range(20)), self.dataset.select(range(20, 50))])
+        sharded.save_to_file(self.path, encodings={"labels": "narrow", "tokens": ("narrow", "zlib")})
+        loaded = load_safetensors(self.path)
+        self.assertIsInstance(loaded, ShardedSafetensorsDataset)
+        for pos in range(len(sharded.shards)):
+            self.assertDatasetEqual(sharded.shards[pos], loaded.shards[pos])
+
+    def test_chunked(self):
+        encodings = {key: ("delta", "narrow", "zlib") for key in self.dataset.keys() if key != "features"}
+        self.dataset.save_to_file(self.path, encodings=encodings, chunk_size=8)
+        for mmap in (False, True):
+            loaded = SafetensorsDataset.load_from_file(self.path, mmap=mmap)
+            self.assertIsInstance(loaded.dataset["tokens"], _ChunkedTensor)
+            self.assertEqual(len(loaded), 50)
+            indices = [49, 3, 17, 4, 3, 30]
+            for key, value in loaded.get_batch(indices).items():
+                expected = self.dataset.get_batch(indices)[key]
+                if value.is_sparse:
+                    value, expected = value.to_dense(), expected.to_dense()
+                self.assertTrue(value.equal(expected), key)
+            for sample, pos in zip(loaded.__getitems__(indices), indices):
+                self.assertTrue(sample["tokens"].equal(self.dataset["tokens"][pos]))
+                self.assertTrue(sample["sparse"].to_dense().equal(self.dataset["sparse"][pos].to_dense()))
+            self.assertTrue(loaded[20]["matrices"].equal(self.dataset["matrices"][20]))
+            # only the chunks of the accessed rows were decoded
+            self.assertEqual(sorted(loaded.dataset["tokens"].cache.keys()), [0, 2, 3, 6])
+
+    def test_chunked_rows(self):
+        self.dataset.save_to_file(self.path, encodings={"labels": "zlib", "tokens": ("narrow", "zlib")}, chunk_size=8)
+        loaded = SafetensorsDataset.load_from_file(self.path, rows=slice(10, 27))
+        self.assertEqual(len(loaded), 17)
+        self.assertEqual(len(loaded.dataset["tokens"].meta["chunks"]), 3)
+        self.assertTrue(loaded["labels"][:].equal(self.dataset["labels"][10:27]))
+        for pos in range(17):
+            self.assertTrue(loaded[pos]["tokens"].equal(self.dataset["tokens"][10 + pos]))
+        # saving materializes the chunked keys
+        loaded.save_to_file(self.path)
+        self.assertTrue(load_safetensors(self.path)["labels"].equal(self.dataset["labels"][10:27]))
+
+    def test_chunked_single_row_chunk(self):
+        # 50 rows in chunks of 7 rows, the last chunk has a single row
+        self.dataset.save_to_file(self.path, encodings={"tokens": "zlib", "matrices": "zlib"}, chunk_size=7)
+        for mmap in (False, True):
+            loaded = SafetensorsDataset.load_from_file(self.path, mmap=mmap)
+            for key in ("tokens", "matrices"):
+                self.assertTrue(loaded[49][key].equal(self.dataset[key][49]), key)
+                self.assertTrue(loaded[48][key].equal(self.dataset[key][48]), key)
+
+    def test_chunk_cache_is_bounded(self):
+        self.dataset.save_to_file(self.path, encodings={"labels": "zlib"}, chunk_size=2)
+        loaded = SafetensorsDataset.load_from_file(self.path)
+        for pos in range(50):
+            self.assertEqual(loaded[pos]["labels"], self.dataset["labels"][pos])
+        self.assertEqual(len(loaded.dataset["labels"].cache), 16)
+
+    def test_invalid_encodings(self):
+        with self.assertRaises(ValueError):
+            self.dataset.save_to_file(self.path, encodings={"labels": "gzip"})
+        with self.assertRaises(ValueError):
+            self.dataset.save_to_file(self.path, encodings={"labels": ("zlib", "zstd")})
+        with self.assertRaises(KeyError):
+            self.dataset.save_to_file(self.path, encodings={"missing": "narrow"})
+
+
+if __name__ == '__main__':
+    unittest.main()
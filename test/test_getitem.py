@@ -21,3 +21,141 @@ class GetItemTestCase(TestCase):
         for index in range(self.inputs.size(0)):
             elem = self.dataset[index]
             self.assertTrue(elem["inputs"].equal(self.inputs[index]))
+
+    def test_getitems_nested(self):
+        values = [torch.randn((length % 5 + 1, 3)) for length in range(32)]
+        dataset = SafetensorsDataset.from_dict({
+            "values": torch.nested.nested_tensor(values)
+        })
+        indices = [3, 0, 31, 3, -1]
+        for index, elem in zip(indices, dataset.__getitems__(indices)):
+            self.assertTrue(elem["values"].equal(values[index]))
+
+    def test_getitems_sparse(self):
+        values = torch.randint(4, (32, 8, 2)).eq(0).to_sparse().float()
+        dataset = SafetensorsDataset.from_dict({
+            "values": values
+        })
+        indices = [7, 7, 0, 31, -2]
+        for index, elem in zip(indices, dataset.__getitems__(indices)):
+            self.assertTrue(elem["values"].is_sparse)
+            self.assertTrue(elem["values"].to_dense().equal(values.to_dense()[index]))
+
+    def test_getitems_out_of_range(self):
+        dataset = SafetensorsDataset.from_dict({
+            "values": torch.nested.nested_tensor([torch.randn(length) for length in range(1, 5)])
+        })
+        with self.assertRaises(IndexError):
+            dataset.__getitems__([0, 4])
+
+    def test_get_batch(self):
+        values = [torch.randn(length % 5 + 1) for length in range(32)]
+        sparse = torch.randint(4, (32, 8)).eq(0).to_sparse().float()
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs,
+            "values": torch.nested.nested_tensor(values),
+            "sparse": sparse,
+        }).set_batch_output(padding_value=-1)
+        indices = [5, 1, 30]
+        batch = dataset.__getitems__(indices)
+        self.assertTrue(batch["inputs"].equal(self.inputs[indices]))
+        self.assertTrue(batch["sparse"].to_dense().equal(sparse.to_dense()[indices]))
+        self.assertEqual(batch["values.lengths"].tolist(), [values[index].numel() for index in indices])
+        self.assertEqual(batch["values"].shape, (3, max(values[index].numel() for index in indices)))
+        for row, index in enumerate(indices):
+            length = values[index].numel()
+            self.assertTrue(batch["values"][row, :length].equal(values[index]))
+            self.assertTrue(batch["values"][row, length:].eq(-1).all())
+
+    def test_get_batch_jagged(self):
+        values = [torch.randn((length % 5 + 1, 2)) for length in range(32)]
+        dataset = SafetensorsDataset.from_dict({
+            "values": torch.nested.nested_tensor(values)
+        })
+        batch = dataset.get_batch([3, 4, 0], nested_layout="jagged")
+        self.assertEqual(batch["values"].layout, torch.jagged)
+        for elem, index in zip(batch["values"].unbind(), [3, 4, 0]):
+            self.assertTrue(elem.equal(values[index]))
+
+    def test_batch_output_dataloader(self):
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs
+        }).set_batch_output()
+        loader = torch.utils.data.DataLoader(dataset, batch_size=8, collate_fn=torch.utils.data.default_convert)
+        batches = list(loader)
+        self.assertEqual(len(batches), 4)
+        self.assertTrue(torch.cat([batch["inputs"] for batch in batches]).equal(self.inputs))
+
+    def test_with_transform(self):
+        calls = []
+
+        def scale(batch):
+            calls.append("scale")
+            return dict(batch, inputs=batch["inputs"] * 2)
+
+        def truncate(batch):
+            calls.append("truncate")
+            return dict(batch, values=batch["values"][:, :2], **{"values.lengths": batch["values.lengths"].clamp(max=2)})
+
+        values = [torch.randn(length % 5 + 1) for length in range(32)]
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs,
+            "values": torch.nested.nested_tensor(values),
+        })
+        transformed = dataset.with_transform(scale).with_transform(truncate).set_batch_output()
+        indices = [4, 9, 2]
+        batch = transformed.__getitems__(indices)
+        # both transforms are applied once to the whole batch, in the order they were added
+        self.assertEqual(calls, ["scale", "truncate"])
+        self.assertTrue(batch["inputs"].equal(self.inputs[indices] * 2))
+        self.assertEqual(batch["values"].shape, (3, 2))
+        self.assertEqual(batch["values.lengths"].tolist(), [min(values[index].numel(), 2) for index in indices])
+        # the original dataset and its tensors are left untouched
+        self.assertEqual(dataset._transforms, ())
+        self.assertTrue(dataset[4]["inputs"].equal(self.inputs[4]))
+        self.assertTrue(transformed["inputs"].equal(self.inputs))
+
+    def test_set_transform_samples(self):
+        def mask(batch):
+            return {"inputs": batch["inputs"].clamp(min=0), "index": torch.arange(batch["inputs"].size(0))}
+
+        self.dataset.set_transform(mask)
+        samples = self.dataset.__getitems__([3, 1])
+        self.assertEqual([int(sample["index"]) for sample in samples], [0, 1])
+        self.assertTrue(samples[1]["inputs"].equal(self.inputs[1].clamp(min=0)))
+        self.assertTrue(self.dataset[5]["inputs"].equal(self.inputs[5].clamp(min=0)))
+        self.assertEqual(len(list(torch.utils.data.DataLoader(self.dataset, batch_size=8))), 4)
+        self.dataset.set_transform(None)
+        self.assertTrue(self.dataset[5]["inputs"].equal(self.inputs[5]))
+
+    def test_transform_is_applied_to_tensors_in_every_mode(self):
+        values = [torch.randn(length % 5 + 1) for length in range(32)]
+        sparse = torch.randint(4, (32, 8)).eq(0).to_sparse().float()
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs,
+            "values": torch.nested.nested_tensor(values),
+            "sparse": sparse,
+        }).with_transform(lambda batch: dict(batch, inputs=batch["inputs"] * 2, sparse=batch["sparse"] * 3))
+        for index, sample in zip([1, 2], dataset.__getitems__([1, 2])):
+            self.assertTrue(sample["inputs"].equal(self.inputs[index] * 2))
+            self.assertTrue(sample["values"].equal(values[index]))
+            self.assertTrue(sample["sparse"].to_dense().equal(sparse[index].to_dense() * 3))
+        self.assertTrue(dataset[3]["inputs"].equal(self.inputs[3] * 2))
+        self.assertTrue(dataset[-1]["values"].equal(values[-1]))
+        self.assertTrue(dataset.get_batch([1, 2])["inputs"].equal(self.inputs[[1, 2]] * 2))
+        self.assertTrue(dataset.set_batch_output().__getitems__([1, 2])["inputs"].equal(self.inputs[[1, 2]] * 2))
+        # single rows are samples, also when batches are returned from __getitems__
+        self.assertTrue(dataset[3]["inputs"].equal(self.inputs[3] * 2))
+        self.assertTrue(dataset[-1]["values"].equal(values[-1]))
+
+    def test_transform_with_wrong_number_of_rows(self):
+        dataset = self.dataset.with_transform(lambda batch: {"inputs": batch["inputs"][:1]})
+        with self.assertRaises(ValueError):
+            dataset.__getitems__([1, 2])
+        self.assertEqual(dataset.get_batch([1, 2])["inputs"].size(0), 1)
+
+    def test_to_keeps_transforms(self):
+        dataset = self.dataset.with_transform(lambda batch: {"inputs": batch["inputs"] * 2}).set_batch_output()
+        moved = dataset.to("meta")
+        self.assertEqual(moved._transforms, dataset._transforms)
+        self.assertEqual(moved._batch_output, dataset._batch_output)
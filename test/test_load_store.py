@@ -6,6 +6,8 @@ from unittest import TestCase
 import torch
 
 from safetensors_dataset import SafetensorsDataset, SafetensorsDict, load_safetensors
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+from safetensors_dataset.utils import _load_safetensors_metadata
 
 
 def try_delete_file(path: Path):
@@ -53,11 +55,11 @@ class StoreDatasetTestCase(TestCase):
             self.check_datasets_are_equal(dataset, loaded[name])
 
     @staticmethod
-    def store_and_reload_dataset(dataset: SafetensorsDataset):
+    def store_and_reload_dataset(dataset: SafetensorsDataset, mmap: bool = False):
         save_path = Path.cwd() / "dataset.safetensors"
         try:
             dataset.save_to_file(save_path)
-            dataset = load_safetensors(save_path)
+            dataset = load_safetensors(save_path, mmap=mmap)
         finally:
             try_delete_file(save_path)
         return dataset
@@ -147,6 +149,166 @@ class StoreDatasetTestCase(TestCase):
         loaded_dataset = self.store_and_reload_dataset(dataset)
         self.check_datasets_are_equal(dataset.pack(), loaded_dataset)
 
+    def test_store_mmap_dataset(self):
+        lengths = range(1, 10)
+        dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((9, 4)),
+            "nested": torch.nested.nested_tensor([torch.randn(length) for length in lengths]),
+            "sparse": torch.randint(10, (9, 12)).eq(0).to_sparse().int(),
+        })
+        loaded_dataset = self.store_and_reload_dataset(dataset, mmap=True)
+        self.check_datasets_are_equal(dataset, loaded_dataset)
+        self.assertTrue(loaded_dataset["sparse"].is_coalesced())
+        for item, loaded_item in zip(dataset.__getitems__([0, 8, 3]), loaded_dataset.__getitems__([0, 8, 3])):
+            for key in dataset.keys():
+                self.assertTrue(item[key].to_dense().equal(loaded_item[key].to_dense()))
+
+    def test_store_mmap_sharded_dataset(self):
+        sharded = SafetensorsDataset.from_dict({
+            "values": torch.nested.nested_tensor([torch.randn(length) for length in range(1, 11)]),
+        }).shard(chunk_size=4)
+        loaded_dataset = self.store_and_reload_dataset(sharded, mmap=True)
+        self.assertEqual(len(sharded), len(loaded_dataset))
+        for shard, loaded_shard in zip(sharded.shards, loaded_dataset.shards):
+            self.check_datasets_are_equal(shard, loaded_shard)
+
+    def test_store_variable_size_shards(self):
+        sharded = ShardedSafetensorsDataset.concat([
+            SafetensorsDataset.from_dict({"values": torch.randn((size, 3))})
+            for size in (7, 2, 11)
+        ])
+        loaded_dataset = self.store_and_reload_dataset(sharded)
+        self.assertEqual(loaded_dataset.shard_offsets.tolist(), [0, 7, 9, 20])
+        for shard, loaded_shard in zip(sharded.shards, loaded_dataset.shards):
+            self.check_datasets_are_equal(shard, loaded_shard)
+
+    def test_store_shards_into_separate_files(self):
+        sharded = ShardedSafetensorsDataset.concat([
+            SafetensorsDataset.from_dict({
+                "values": torch.nested.nested_tensor([torch.randn(length + 1) for length in range(size)])
+            })
+            for size in (5, 3, 8)
+        ])
+        save_path = Path.cwd() / "sharded"
+        try:
+            sharded.save_to_file(save_path, separate_files=True)
+            self.assertEqual(len(list(save_path.glob("*.safetensors"))), 3)
+            loaded_dataset = load_safetensors(save_path, mmap=True)
+            self.assertIsInstance(loaded_dataset, ShardedSafetensorsDataset)
+            self.assertEqual(len(loaded_dataset), 16)
+            self.assertTrue(all(isinstance(entry, Path) for entry in loaded_dataset.shards.entries))
+            self.assertTrue(loaded_dataset[6]["values"].equal(sharded[6]["values"]))
+            self.assertIsInstance(loaded_dataset.shards.entries[1], SafetensorsDataset)
+            self.assertIsInstance(loaded_dataset.shards.entries[0], Path)
+
+            sharded.shards[2].dataset["values"] = torch.nested.nested_tensor([torch.randn(2)])
+            sharded.save_shard(save_path, 2)
+            loaded_dataset = load_safetensors(save_path)
+            self.assertEqual(len(loaded_dataset), 9)
+            for shard, loaded_shard in zip(sharded.shards, loaded_dataset.shards):
+                self.check_datasets_are_equal(shard, loaded_shard)
+        finally:
+            for file in save_path.glob("*"):
+                try_delete_file(file)
+            if save_path.exists():
+                save_path.rmdir()
+
+    def test_load_columns(self):
+        dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((6, 4)),
+            "nested": torch.nested.nested_tensor([torch.randn(length + 1) for length in range(6)]),
+            "sparse": torch.randint(3, (6, 5)).ne(0).to_sparse().float(),
+        })
+        save_path = Path.cwd() / "columns.safetensors"
+        try:
+            dataset.save_to_file(save_path)
+            for mmap in (False, True):
+                loaded_dataset = load_safetensors(save_path, mmap=mmap, columns=["nested", "sparse"])
+                self.assertEqual(loaded_dataset.keys(), {"nested", "sparse"})
+                for pos in range(len(dataset)):
+                    self.assertTrue(loaded_dataset[pos]["nested"].equal(dataset[pos]["nested"]))
+                    self.assertTrue(loaded_dataset[pos]["sparse"].to_dense().equal(dataset[pos]["sparse"].to_dense()))
+            with self.assertRaises(KeyError):
+                load_safetensors(save_path, columns=["labels"])
+
+            sharded = dataset.shard(chunk_size=4)
+            sharded.save_to_file(save_path)
+            loaded_dataset = load_safetensors(save_path, columns=["dense"])
+            self.assertEqual(len(loaded_dataset), 6)
+            self.assertEqual(loaded_dataset[5].keys(), {"dense"})
+        finally:
+            try_delete_file(save_path)
+
+    def test_load_rows(self):
+        dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((10, 4)),
+            "nested": torch.nested.nested_tensor([torch.randn(length % 4 + 1) for length in range(10)]),
+            "matrices": torch.nested.nested_tensor([torch.randn(length % 3 + 1, 2) for length in range(10)]),
+            "sparse": torch.randint(3, (10, 5)).eq(0).to_sparse().float(),
+            "mask": torch.randint(3, (10, 5)).eq(0).to_sparse(),
+        })
+        save_path = Path.cwd() / "rows.safetensors"
+
+        def check_rows(loaded_dataset, start: int):
+            for pos in range(len(loaded_dataset)):
+                for key, value in loaded_dataset[pos].items():
+                    expected = dataset[start + pos][key]
+                    if value.is_sparse:
+                        value, expected = value.to_dense(), expected.to_dense()
+                    self.assertTrue(value.equal(expected), (start, pos, key))
+
+        try:
+            dataset.save_to_file(save_path)
+            for mmap in (False, True):
+                loaded_dataset = load_safetensors(save_path, mmap=mmap, rows=slice(3, 8))
+                self.assertEqual(len(loaded_dataset), 5)
+                self.assertEqual(loaded_dataset["sparse"].shape, (5, 5))
+                check_rows(loaded_dataset, 3)
+
+            ranks = [load_safetensors(save_path, rank=rank, world_size=3) for rank in range(3)]
+            self.assertEqual([len(rank_dataset) for rank_dataset in ranks], [3, 3, 4])
+            for rank_dataset, start in zip(ranks, (0, 3, 6)):
+                check_rows(rank_dataset, start)
+            self.assertEqual(len(load_safetensors(save_path, rows=slice(10, None))), 0)
+
+            sharded = ShardedSafetensorsDataset.concat([dataset.select(range(4)), dataset.select(range(4, 10))])
+            for separate_files in (False, True):
+                sharded.save_to_file(save_path, separate_files=separate_files)
+                loaded_dataset = load_safetensors(save_path, rows=slice(2, 7))
+                self.assertIsInstance(loaded_dataset, ShardedSafetensorsDataset)
+                self.assertEqual(loaded_dataset.shard_offsets.tolist(), [0, 2, 5])
+                check_rows(loaded_dataset, 2)
+                try_delete_file(save_path)
+        finally:
+            try_delete_file(save_path)
+            shard_directory = save_path.parent / save_path.stem
+            for file in shard_directory.glob("*"):
+                try_delete_file(file)
+            if shard_directory.exists():
+                shard_directory.rmdir()
+
+    def test_store_coalesced_state(self):
+        indices = torch.tensor([[2, 0, 0, 1], [1, 3, 3, 0]])
+        uncoalesced = torch.sparse_coo_tensor(indices, torch.arange(4.), size=(3, 4))
+        dataset = SafetensorsDataset.from_dict({
+            "coalesced": torch.randint(3, (3, 4)).eq(0).to_sparse().float(),
+            "uncoalesced": uncoalesced,
+        })
+        save_path = Path.cwd() / "coalesced.safetensors"
+        try:
+            dataset.save_to_file(save_path)
+            metadata = _load_safetensors_metadata(save_path)
+            self.assertTrue(metadata["coalesced"]["coalesced"])
+            self.assertFalse(metadata["uncoalesced"]["coalesced"])
+            for rows in (None, slice(0, 2)):
+                loaded_dataset = load_safetensors(save_path, rows=rows)
+                for key in ("coalesced", "uncoalesced"):
+                    expected = dataset[key].to_dense()[rows or slice(None)]
+                    self.assertTrue(loaded_dataset[key].is_coalesced())
+                    self.assertTrue(loaded_dataset[key].to_dense().equal(expected), (rows, key))
+        finally:
+            try_delete_file(save_path)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,204 @@
+import shutil
+import warnings
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import SafetensorsDataset, SafetensorsDict
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset, config
+from safetensors_dataset.sequence_dataset import SequenceSafetensorsDataset
+
+
+def tokenize(element):
+    length = int(element["lengths"]) % 5 + 1
+    return {
+        "tokens": torch.arange(length) + element["inputs"][0],
+        "inputs": element["inputs"] * 2,
+        "sparse": element["sparse"].float(),
+    }
+
+
+class MapTestCase(TestCase):
+    def setUp(self):
+        self.dataset = SafetensorsDataset.from_dict({
+            "inputs": torch.randint(10, (25, 3)),
+            "lengths": torch.arange(25),
+            "sparse": torch.randint(3, (25, 6)).eq(0).to_sparse(),
+        })
+
+    def assertDatasetEqual(self, first: SafetensorsDataset, second: SafetensorsDataset):
+        self.assertEqual(first.keys(), second.keys())
+        self.assertEqual(len(first), len(second))
+        for pos in range(len(first)):
+            for key, value in first[pos].items():
+                if value.is_sparse:
+                    value, other = value.to_dense(), second[pos][key].to_dense()
+                else:
+                    other = second[pos][key]
+                self.assertTrue(value.equal(other), (pos, key))
+
+    def test_map_num_proc(self):
+        expected = self.dataset.map(tokenize, use_tqdm=False)
+        for num_proc in (2, 3, 4):
+            actual = self.dataset.map(tokenize, use_tqdm=False, num_proc=num_proc)
+            self.assertTrue(actual["tokens"].is_nested)
+            self.assertTrue(actual["sparse"].is_sparse)
+            self.assertDatasetEqual(expected, actual)
+
+    def test_map_num_proc_batched(self):
+        def batch_sizes(batch):
+            return {"inputs": batch["inputs"], "batch_size": torch.full((batch["inputs"].size(0),), batch["inputs"].size(0))}
+
+        expected = self.dataset.map(batch_sizes, use_tqdm=False, batched=True, batch_size=4)
+        actual = self.dataset.map(batch_sizes, use_tqdm=False, batched=True, batch_size=4, num_proc=3)
+        self.assertDatasetEqual(expected, actual)
+
+    def test_map_num_proc_dropped_rows(self):
+        def drop_odd(element):
+            return bool(element["lengths"] % 2 == 0) and {"lengths": element["lengths"]}
+
+        actual = self.dataset.map(drop_odd, use_tqdm=False, num_proc=4)
+        self.assertEqual(actual["lengths"].tolist(), list(range(0, 25, 2)))
+
+    def test_sequence_map_num_proc(self):
+        dataset = SequenceSafetensorsDataset(self.dataset[pos] for pos in range(len(self.dataset)))
+        expected = self.dataset.map(tokenize, use_tqdm=False)
+        self.assertDatasetEqual(expected, dataset.map(tokenize, use_tqdm=False, num_proc=2))
+
+    def test_dict_map_num_proc(self):
+        dataset = SafetensorsDict({"train": self.dataset, "test": self.dataset})
+        actual = dataset.map(tokenize, use_tqdm=False, num_proc=2)
+        expected = self.dataset.map(tokenize, use_tqdm=False)
+        self.assertDatasetEqual(expected, actual["train"])
+        self.assertDatasetEqual(expected, actual["test"])
+
+    def test_map_to_file(self):
+        directory = Path.cwd() / "map_output"
+        try:
+            expected = self.dataset.map(tokenize, use_tqdm=False)
+            actual = self.dataset.map(tokenize, use_tqdm=False, output_path=directory, writer_batch_size=10)
+            self.assertIsInstance(actual, ShardedSafetensorsDataset)
+            self.assertEqual(actual.shard_offsets.tolist(), [0, 10, 20, 25])
+            self.assertDatasetEqual(expected, actual)
+
+            def batch_sizes(batch):
+                return {"inputs": batch["inputs"], "batch_size": torch.full((batch["inputs"].size(0),), batch["inputs"].size(0))}
+
+            expected = self.dataset.map(batch_sizes, use_tqdm=False, batched=True, batch_size=4)
+            actual = self.dataset.map(
+                batch_sizes, use_tqdm=False, batched=True, batch_size=4, output_path=directory / "batched", writer_batch_size=6
+            )
+            self.assertEqual(actual.shard_offsets.tolist(), [0, 6, 12, 18, 24, 25])
+            self.assertDatasetEqual(expected, actual)
+
+            dataset = SequenceSafetensorsDataset(self.dataset[pos] for pos in range(len(self.dataset)))
+            self.assertDatasetEqual(
+                self.dataset.map(tokenize, use_tqdm=False),
+                dataset.map(tokenize, use_tqdm=False, output_path=directory / "sequence", writer_batch_size=7),
+            )
+            with self.assertRaises(ValueError):
+                self.dataset.map(tokenize, use_tqdm=False, num_proc=2, output_path=directory / "processes")
+            with self.assertRaises(ValueError):
+                dataset.map(tokenize, use_tqdm=False, num_proc=2, output_path=directory / "processes")
+            self.assertFalse((directory / "processes").exists())
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_map_cache(self):
+        directory = Path.cwd() / "map_cache"
+        try:
+            def scale(factor):
+                return lambda element: {"inputs": element["inputs"] * factor}
+
+            expected = self.dataset.map(tokenize, use_tqdm=False)
+            actual = self.dataset.map(tokenize, use_tqdm=False, cache_dir=directory)
+            self.assertIsNone(actual._mmap_path)
+            self.assertEqual(len(list(directory.glob("map-*.safetensors"))), 1)
+            cached = self.dataset.map(tokenize, use_tqdm=False, cache_dir=directory)
+            self.assertIsNotNone(cached._mmap_path)
+            self.assertDatasetEqual(expected, cached)
+
+            # the contents of the dataset, the arguments and the closure of the function are part of the fingerprint
+            other = SafetensorsDataset.from_dict({key: value.clone() for key, value in self.dataset.dataset.items()})
+            self.assertIsNotNone(other.map(tokenize, use_tqdm=False, cache_dir=directory)._mmap_path)
+            other.dataset["inputs"][0, 0] += 1
+            self.assertIsNone(other.map(tokenize, use_tqdm=False, cache_dir=directory)._mmap_path)
+            self.assertIsNone(self.dataset.map(scale(3), use_tqdm=False, batched=True, batch_size=5, cache_dir=directory)._mmap_path)
+            self.assertIsNone(self.dataset.map(scale(2), use_tqdm=False, cache_dir=directory)._mmap_path)
+            doubled = self.dataset.map(scale(3), use_tqdm=False, cache_dir=directory)
+            self.assertIsNone(doubled._mmap_path)
+            self.assertTrue(doubled["inputs"].equal(self.dataset["inputs"] * 3))
+            self.assertIsNotNone(self.dataset.map(scale(3), use_tqdm=False, cache_dir=directory)._mmap_path)
+
+            # memory-mapped datasets are fingerprinted by their file
+            self.dataset.save_to_file(directory / "source.safetensors")
+            source = SafetensorsDataset.load_from_file(directory / "source.safetensors", mmap=True)
+            self.assertIsNone(source.map(tokenize, use_tqdm=False, cache_dir=directory)._mmap_path)
+            self.assertIsNotNone(source.map(tokenize, use_tqdm=False, cache_dir=directory)._mmap_path)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_map_cache_unsaveable_output(self):
+        directory = Path.cwd() / "map_cache"
+        try:
+            def name(element):
+                return {"name": f"row {int(element['lengths'])}", "lengths": element["lengths"]}
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                mapped = self.dataset.map(name, use_tqdm=False, cache_dir=directory)
+            self.assertTrue(any("Not caching" in str(warning.message) for warning in caught))
+            self.assertEqual(mapped["name"][3], "row 3")
+            self.assertEqual(list(directory.glob("*")), [])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_map_cache_non_tensor_column(self):
+        directory = Path.cwd() / "map_cache"
+        try:
+            def double(element):
+                return {"inputs": element["inputs"] * 2}
+
+            self.dataset.dataset["names"] = [f"row {pos}" for pos in range(25)]
+            # shards keep the rows of list columns as tuples
+            shard = self.dataset.select(range(20)).shard(chunk_size=10).shards[1]
+            for dataset in (self.dataset, self.dataset.select(range(10)), shard):
+                self.assertIsNone(dataset.map(double, use_tqdm=False, cache_dir=directory)._mmap_path)
+                cached = dataset.map(double, use_tqdm=False, cache_dir=directory)
+                self.assertIsNotNone(cached._mmap_path)
+                self.assertTrue(cached["inputs"].equal(dataset["inputs"] * 2))
+            renamed = self.dataset.select(range(10))
+            renamed.dataset["names"] = ("other",) + tuple(renamed.dataset["names"][1:])
+            self.assertIsNone(renamed.map(double, use_tqdm=False, cache_dir=directory)._mmap_path)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_map_cache_eviction(self):
+        directory = Path.cwd() / "map_cache"
+        max_size = config["map_cache_size"]
+        try:
+            def shift(offset):
+                return lambda element: {"inputs": element["inputs"] + offset}
+
+            self.dataset.map(shift(0), use_tqdm=False, cache_dir=directory)
+            entry_size = next(directory.glob("map-*.safetensors")).stat().st_size
+            config["map_cache_size"] = 3 * entry_size
+            for offset in range(1, 5):
+                self.dataset.map(shift(offset), use_tqdm=False, cache_dir=directory)
+                if offset == 2:
+                    # a hit marks the entry as recently used
+                    self.assertIsNotNone(self.dataset.map(shift(0), use_tqdm=False, cache_dir=directory)._mmap_path)
+            self.assertEqual(len(list(directory.glob("map-*.safetensors"))), 3)
+            for offset, is_cached in ((0, True), (3, True), (4, True), (1, False)):
+                self.assertEqual(self.dataset.map(shift(offset), use_tqdm=False, cache_dir=directory)._mmap_path is not None, is_cached, offset)
+
+            # entries served by a dataset of this process are not evicted
+            served = self.dataset.map(shift(4), use_tqdm=False, cache_dir=directory)
+            config["map_cache_size"] = 0
+            self.dataset.map(shift(5), use_tqdm=False, cache_dir=directory)
+            self.assertTrue(served._mmap_path.exists())
+            self.assertEqual(len(list(directory.glob("map-*.safetensors"))), 2)
+        finally:
+            config["map_cache_size"] = max_size
+            shutil.rmtree(directory, ignore_errors=True)
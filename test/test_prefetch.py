@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import PrefetchLoader, SafetensorsDataset
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+from safetensors_dataset.prefetch import _gather_batch, _StagingBuffers
+
+
+class PrefetchTestCase(TestCase):
+    def setUp(self):
+        self.dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((20, 3)),
+            "tokens": torch.nested.nested_tensor([torch.arange(length % 6 + 1) for length in range(20)]),
+            "sparse": torch.randint(3, (20, 4)).ne(0).to_sparse().float(),
+        })
+        self.batches = [[3, 1, 4], [15, 9, 2, 6], [5], [19, 0]]
+
+    def assertBatchEqual(self, batch, expected):
+        self.assertEqual(batch.keys(), expected.keys())
+        for key, value in batch.items():
+            other = expected[key]
+            if value.is_nested:
+                self.assertEqual(len(value.unbind()), len(other.unbind()))
+                for row, other_row in zip(value.unbind(), other.unbind()):
+                    self.assertTrue(row.equal(other_row), key)
+                continue
+            elif value.is_sparse:
+                value, other = value.to_dense(), other.to_dense()
+            self.assertTrue(value.equal(other), key)
+
+    def test_prefetch(self):
+        loader = PrefetchLoader(self.dataset, self.batches, device="cpu", prefetch=2)
+        self.assertEqual(len(loader), 4)
+        loaded = list(loader)
+        self.assertEqual(len(loaded), 4)
+        for batch, indices in zip(loaded, self.batches):
+            self.assertBatchEqual(batch, self.dataset.get_batch(indices))
+
+    def test_prefetch_sharded(self):
+        sharded = ShardedSafetensorsDataset.concat([self.dataset.select(range(8)), self.dataset.select(range(8, 20))])
+        for batch, indices in zip(PrefetchLoader(sharded, self.batches, nested_layout="jagged"), self.batches):
+            self.assertTrue(batch["dense"].equal(self.dataset["dense"][indices]))
+
+    def test_pin_memory_requires_cuda(self):
+        for device in (None, "cpu"):
+            with self.assertRaises(ValueError):
+                PrefetchLoader(self.dataset, self.batches, device=device, pin_memory=True)
+
+    def test_stop_early(self):
+        loader = PrefetchLoader(self.dataset, [[pos] for pos in range(20)], prefetch=1)
+        for pos, batch in enumerate(loader):
+            if pos == 2:
+                break
+        self.assertTrue(batch["dense"].equal(self.dataset["dense"][2:3]))
+
+    def test_errors_are_raised(self):
+        with self.assertRaises(IndexError):
+            list(PrefetchLoader(self.dataset, [[0], [20]]))
+
+    def test_staging_buffers_are_reused(self):
+        staging = _StagingBuffers(pin_memory=False)
+        for nested_layout in ("padded", "jagged", "nested"):
+            for indices in self.batches:
+                batch = _gather_batch(self.dataset, indices, staging, nested_layout, 0)
+                self.assertBatchEqual(batch, self.dataset.get_batch(indices, nested_layout))
+        self.assertEqual(staging.buffers["dense"].numel(), 4 * 3 * 4)
+        batch = _gather_batch(self.dataset, [7], staging, "padded", 0)
+        self.assertEqual(batch["dense"].untyped_storage().data_ptr(), staging.buffers["dense"].data_ptr())
@@ -0,0 +1,138 @@
+from unittest import TestCase
+
+import torch
+import torch.utils.data
+
+from safetensors_dataset import SafetensorsDataset, ShardAwareSampler, LengthBucketedBatchSampler
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+
+
+class ShardAwareSamplerTestCase(TestCase):
+    def setUp(self):
+        sizes = (5, 3, 8, 4, 6, 2)
+        self.dataset = ShardedSafetensorsDataset.concat([
+            SafetensorsDataset.from_dict({"values": torch.arange(size)}) for size in sizes
+        ])
+        self.shard_of_row = torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes))
+
+    def test_ranks_do_not_overlap(self):
+        samplers = [ShardAwareSampler(self.dataset, num_replicas=2, rank=rank, drop_last=True) for rank in range(2)]
+        indices = [sampler.indices() for sampler in samplers]
+        self.assertEqual([len(sampler) for sampler in samplers], [14, 14])
+        self.assertEqual(sorted(torch.cat(indices).tolist()), list(range(28)))
+        shards = [set(self.shard_of_row[rank_indices].tolist()) for rank_indices in indices]
+        # only the shard at the boundary of the parts of the ranks is split
+        self.assertLessEqual(len(shards[0] & shards[1]), 1)
+        self.assertEqual(shards[0] | shards[1], set(range(6)))
+
+    def test_balanced_ranks(self):
+        dataset = ShardedSafetensorsDataset.concat([
+            SafetensorsDataset.from_dict({"values": torch.arange(10)}) for _ in range(10)
+        ])
+        indices = [ShardAwareSampler(dataset, num_replicas=3, rank=rank).indices() for rank in range(3)]
+        self.assertEqual([rank_indices.numel() for rank_indices in indices], [34] * 3)
+        self.assertEqual(set(torch.cat(indices).tolist()), set(range(100)))
+
+    def test_unsharded_dataset(self):
+        dataset = SafetensorsDataset.from_dict({"values": torch.arange(100)})
+        indices = [ShardAwareSampler(dataset, num_replicas=2, rank=rank).indices() for rank in range(2)]
+        self.assertEqual(sorted(torch.cat(indices).tolist()), list(range(100)))
+        indices = [ShardAwareSampler(dataset, num_replicas=3, rank=rank, drop_last=True).indices() for rank in range(3)]
+        self.assertEqual([rank_indices.numel() for rank_indices in indices], [33] * 3)
+        self.assertEqual(len(set(torch.cat(indices).tolist())), 99)
+
+    def test_covers_dataset(self):
+        sampler = ShardAwareSampler(self.dataset)
+        self.assertEqual(sorted(sampler), list(range(28)))
+        sampler.set_epoch(1)
+        self.assertEqual(sorted(sampler), list(range(28)))
+        self.assertNotEqual(list(sampler), ShardAwareSampler(self.dataset).indices().tolist())
+
+    def test_window(self):
+        sampler = ShardAwareSampler(self.dataset, window_size=1)
+        shards = self.shard_of_row[sampler.indices()]
+        # every shard is read in one go
+        self.assertEqual(shards.unique_consecutive().numel(), 6)
+
+    def test_workers(self):
+        sampler = ShardAwareSampler(self.dataset, num_workers=2, batch_size=3, shuffle=False)
+        batches = torch.split(sampler.indices(), 3)
+        self.assertEqual(sorted(sampler.indices().tolist()), list(range(28)))
+        worker_shards = [set(), set()]
+        for pos, batch in enumerate(batches[:8]):
+            worker_shards[pos % 2].update(self.shard_of_row[batch].tolist())
+        self.assertLessEqual(len(worker_shards[0] & worker_shards[1]), 1)
+
+    def test_resume(self):
+        sampler = ShardAwareSampler(self.dataset, seed=3)
+        sampler.set_epoch(2)
+        indices = list(sampler)
+        sampler.set_epoch(2, step=10)
+        self.assertEqual(len(sampler), 18)
+        self.assertEqual(list(sampler), indices[10:])
+
+    def test_data_loader(self):
+        sampler = ShardAwareSampler(self.dataset, num_replicas=4, rank=3)
+        loader = torch.utils.data.DataLoader(self.dataset, sampler=sampler, batch_size=4)
+        self.assertEqual(sum(batch["values"].size(0) for batch in loader), 7)
+
+
+class LengthBucketedBatchSamplerTestCase(TestCase):
+    def setUp(self):
+        self.lengths = torch.randint(1, 20, (50,))
+        self.dataset = SafetensorsDataset.from_dict({
+            "tokens": torch.nested.nested_tensor([torch.arange(length) for length in self.lengths.tolist()]),
+        })
+
+    def test_max_tokens(self):
+        sampler = LengthBucketedBatchSampler(self.dataset, "tokens", max_tokens=40)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(index for batch in batches for index in batch), list(range(50)))
+        for batch in batches:
+            lengths = self.lengths[batch]
+            self.assertTrue(len(batch) == 1 or len(batch) * int(lengths.max()) <= 40)
+
+    def test_batch_size(self):
+        sampler = LengthBucketedBatchSampler(self.dataset, "tokens", batch_size=8, shuffle=False, drop_last=True)
+        batches = list(sampler)
+        self.assertEqual([len(batch) for batch in batches], [8] * 6)
+        lengths = torch.cat([self.lengths[batch] for batch in batches])
+        self.assertTrue(lengths.equal(lengths.sort().values))
+
+    def test_pools(self):
+        sampler = LengthBucketedBatchSampler(self.dataset, "tokens", batch_size=5, pool_size=10)
+        self.assertEqual(len(sampler), 10)
+        sampler.set_epoch(1)
+        self.assertEqual(sorted(index for batch in sampler for index in batch), list(range(50)))
+
+    def test_batches_are_built_once_per_epoch(self):
+        sampler = LengthBucketedBatchSampler(self.dataset, "tokens", max_tokens=40)
+        batches = sampler.batches()
+        self.assertEqual(len(sampler), len(batches))
+        self.assertIs(sampler.batches(), batches)
+        self.assertEqual(list(sampler), batches)
+        sampler.set_epoch(1)
+        self.assertIsNot(sampler.batches(), batches)
+        self.assertEqual(
+            sorted(index for batch in sampler for index in batch), sorted(index for batch in batches for index in batch)
+        )
+
+    def test_ranks(self):
+        batches = [
+            LengthBucketedBatchSampler(self.dataset, "tokens", batch_size=4, num_replicas=2, rank=rank).batches()
+            for rank in range(2)
+        ]
+        self.assertEqual(len(batches[0]), len(batches[1]))
+        self.assertFalse(
+            set(index for batch in batches[0] for index in batch) & set(index for batch in batches[1] for index in batch)
+        )
+
+    def test_data_loader(self):
+        self.dataset.set_batch_output(nested_layout="padded")
+        sampler = LengthBucketedBatchSampler(self.dataset, "tokens", max_tokens=64)
+        loader = torch.utils.data.DataLoader(
+            self.dataset, batch_sampler=sampler, collate_fn=torch.utils.data.default_convert
+        )
+        for batch in loader:
+            self.assertLessEqual(batch["tokens"].numel(), max(64, batch["tokens"].size(1)))
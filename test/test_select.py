@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import SafetensorsDataset
+
+
+class SelectTestCase(TestCase):
+    def setUp(self):
+        self.dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((12, 3)),
+            "nested": torch.nested.nested_tensor([torch.randn(length % 4 + 1, 2) for length in range(12)]),
+            "sparse": torch.randint(3, (12, 5)).eq(0).to_sparse().float(),
+        })
+
+    def assertRowsEqual(self, dataset: SafetensorsDataset, indices: list[int]):
+        self.assertEqual(len(dataset), len(indices))
+        for pos, index in enumerate(indices):
+            for key, value in dataset[pos].items():
+                expected = self.dataset[index][key]
+                if value.is_sparse:
+                    value, expected = value.to_dense(), expected.to_dense()
+                self.assertTrue(value.equal(expected), (pos, key))
+
+    def test_select(self):
+        indices = [3, 0, 11, 3, -1]
+        selected = self.dataset.select(indices)
+        self.assertTrue(selected["nested"].is_nested)
+        self.assertTrue(selected["sparse"].is_sparse)
+        self.assertRowsEqual(selected, indices)
+
+    def test_select_copies(self):
+        selected = self.dataset.select([0, 1])
+        selected["dense"].zero_()
+        self.assertFalse(self.dataset["dense"][0].eq(0).all())
+
+    def test_select_list(self):
+        dataset = SafetensorsDataset({"list": [torch.randn(length + 1) for length in range(5)]})
+        selected = dataset.select([4, 1])
+        self.assertTrue(selected["list"][0].equal(dataset["list"][4]))
+        self.assertTrue(selected["list"][1].equal(dataset["list"][1]))
+
+    def test_select_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.dataset.select([12])
+
+    def test_filter(self):
+        filtered = self.dataset.filter(lambda row: row["dense"][0] > 0, use_tqdm=False)
+        self.assertRowsEqual(filtered, self.dataset["dense"][:, 0].gt(0).nonzero().squeeze(1).tolist())
+
+    def test_filter_batched(self):
+        expected = self.dataset["nested"]._nested_tensor_size()[:, 0].gt(2).nonzero().squeeze(1).tolist()
+        filtered = self.dataset.filter(
+            lambda batch: batch["nested"]._nested_tensor_size()[:, 0] > 2,
+            use_tqdm=False,
+            batched=True,
+            batch_size=5,
+        )
+        self.assertTrue(filtered["sparse"].is_sparse)
+        self.assertRowsEqual(filtered, expected)
+
+    def test_filter_batched_wrong_mask(self):
+        with self.assertRaises(ValueError):
+            self.dataset.filter(lambda batch: [True], use_tqdm=False, batched=True, batch_size=5)
@@ -0,0 +1,171 @@
+import os
+import pickle
+import shutil
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import SafetensorsDataset, load_safetensors
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+
+
+class ShardedDatasetTestCase(TestCase):
+    def setUp(self):
+        self.values = [torch.randn(length % 7 + 1) for length in range(50)]
+        self.inputs = torch.randn((50, 4))
+        self.sparse = torch.randint(4, (50, 6)).eq(0).to_sparse().float()
+        self.dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs.clone(),
+            "values": torch.nested.nested_tensor(self.values),
+            "sparse": self.sparse.clone(),
+        }).shard(chunk_size=8)
+
+    def test_getitems(self):
+        indices = torch.randint(50, (40,)).tolist() + [-1, 0]
+        items = self.dataset.__getitems__(indices)
+        self.assertEqual(len(items), len(indices))
+        for index, item in zip(indices, items):
+            self.assertTrue(item["inputs"].equal(self.inputs[index]))
+            self.assertTrue(item["values"].equal(self.values[index]))
+            self.assertTrue(item["sparse"].to_dense().equal(self.sparse.to_dense()[index]))
+
+    def test_getitems_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.dataset.__getitems__([0, 50])
+
+    def test_get_batch(self):
+        indices = [49, 3, 17, 3, 8, 0]
+        batch = self.dataset.set_batch_output().__getitems__(indices)
+        self.assertTrue(batch["inputs"].equal(self.inputs[indices]))
+        self.assertTrue(batch["sparse"].to_dense().equal(self.sparse.to_dense()[indices]))
+        self.assertEqual(batch["values.lengths"].tolist(), [self.values[index].numel() for index in indices])
+        for row, index in enumerate(indices):
+            self.assertTrue(batch["values"][row, :self.values[index].numel()].equal(self.values[index]))
+
+    def test_with_transform(self):
+        def scale(batch):
+            return dict(batch, inputs=batch["inputs"] * 2)
+
+        def drop_sparse(batch):
+            return {"inputs": batch["inputs"]}
+
+        transformed = self.dataset.with_transform(scale).with_transform(drop_sparse)
+        indices = [49, 3, 17, 3, 8, 0]
+        for index, item in zip(indices, transformed.__getitems__(indices)):
+            self.assertEqual(item.keys(), {"inputs"})
+            self.assertTrue(item["inputs"].equal(self.inputs[index] * 2))
+        self.assertTrue(transformed[-1]["inputs"].equal(self.inputs[-1] * 2))
+        batch = transformed.get_batch(indices)
+        self.assertEqual(batch.keys(), {"inputs"})
+        self.assertTrue(batch["inputs"].equal(self.inputs[indices] * 2))
+        self.assertEqual(self.dataset[0].keys(), {"inputs", "values", "sparse"})
+        transformed.set_batch_output()
+        self.assertTrue(transformed[-1]["inputs"].equal(self.inputs[-1] * 2))
+        self.assertTrue(transformed.__getitems__(indices)["inputs"].equal(self.inputs[indices] * 2))
+
+    def test_append_shard_to_any_sequence(self):
+        first, second, third = self.dataset.shards[0], self.dataset.shards[1], self.dataset.shards[2]
+        for dataset in (ShardedSafetensorsDataset.concat([first, second]), ShardedSafetensorsDataset([first, second])):
+            dataset.append_shard(third)
+            self.assertEqual(dataset.shard_offsets.tolist(), [0, 8, 16, 24])
+            self.assertTrue(dataset[20]["inputs"].equal(self.inputs[20]))
+
+        path = Path.cwd() / "append_shard.safetensors"
+        try:
+            ShardedSafetensorsDataset.concat([first, second]).save_to_file(path, separate_files=True)
+            loaded = load_safetensors(path)
+            loaded.append_shard(third)
+            self.assertEqual(len(loaded.shards), 3)
+            self.assertTrue(loaded[3]["inputs"].equal(self.inputs[3]))
+            self.assertTrue(loaded[20]["inputs"].equal(self.inputs[20]))
+        finally:
+            shutil.rmtree(path.parent / path.stem, ignore_errors=True)
+
+    def test_variable_size_shards(self):
+        sizes = [5, 1, 0, 12, 3]
+        shards = [
+            SafetensorsDataset.from_dict({"inputs": torch.arange(size) + 100 * pos})
+            for pos, size in enumerate(sizes)
+        ]
+        dataset = ShardedSafetensorsDataset.concat(shards)
+        expected = torch.cat([shard["inputs"] for shard in shards])
+        self.assertEqual(len(dataset), sum(sizes))
+        self.assertEqual(dataset.shard_offsets.tolist(), [0, 5, 6, 6, 18, 21])
+        for index in range(len(dataset)):
+            self.assertTrue(dataset[index]["inputs"].equal(expected[index]))
+        indices = torch.randperm(len(dataset)).tolist()
+        items = dataset.__getitems__(indices)
+        self.assertTrue(torch.stack([item["inputs"] for item in items]).equal(expected[indices]))
+        with self.assertRaises(IndexError):
+            dataset[len(dataset)]
+
+    def test_append_shard(self):
+        dataset = ShardedSafetensorsDataset.concat([self.dataset])
+        dataset.append_shard(SafetensorsDataset.from_dict({
+            "inputs": torch.randn((3, 4)),
+            "values": torch.nested.nested_tensor([torch.randn(2), torch.randn(1), torch.randn(4)]),
+            "sparse": torch.randn((3, 6)).to_sparse(),
+        }))
+        self.assertEqual(len(dataset), 53)
+        self.assertEqual(dataset[52]["values"].numel(), 4)
+        with self.assertRaises(ValueError):
+            dataset.append_shard(SafetensorsDataset.from_dict({"other": torch.randn(3)}))
+
+    def test_shard_without_copy(self):
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": self.inputs.clone(),
+            "values": torch.nested.nested_tensor(self.values),
+            "sparse": self.sparse.clone(),
+        })
+        sharded = dataset.shard(chunk_size=8, copy=False)
+        self.assertEqual(dataset.keys(), {"inputs", "values", "sparse"})
+        self.assertEqual(sharded.shard_offsets.tolist(), [0, 8, 16, 24, 32, 40, 48, 50])
+        shard = sharded.shards[2]
+        self.assertEqual(shard["inputs"].data_ptr(), dataset["inputs"][16].data_ptr())
+        self.assertEqual(shard["values"].values().data_ptr(), dataset["values"].values().data_ptr())
+        for index in range(50):
+            self.assertTrue(sharded[index]["inputs"].equal(self.inputs[index]))
+            self.assertTrue(sharded[index]["values"].equal(self.values[index]))
+
+        path = Path.cwd() / "shard_views.safetensors"
+        try:
+            # the views are compacted when saved, so every shard only stores its own rows
+            shard.save_to_file(path)
+            self.assertLess(path.stat().st_size, 2000)
+            for separate_files in (False, True):
+                sharded.save_to_file(path, separate_files=separate_files)
+                loaded = load_safetensors(path)
+                for index in range(50):
+                    self.assertTrue(loaded[index]["values"].equal(self.values[index]))
+                    self.assertTrue(loaded[index]["sparse"].to_dense().equal(self.sparse[index].to_dense()))
+                if path.exists():
+                    os.remove(path)
+        finally:
+            if path.exists():
+                os.remove(path)
+            shutil.rmtree(path.parent / path.stem, ignore_errors=True)
+
+    def test_pickle_shards_without_copy(self):
+        dataset = SafetensorsDataset.from_dict({
+            "inputs": torch.randn((1000, 16)),
+            "values": torch.nested.nested_tensor([torch.randn(pos % 13 + 1) for pos in range(1000)]),
+        })
+        view_shard = dataset.shard(chunk_size=100, copy=False).shards[3]
+        copied_shard = dataset.shard(chunk_size=100, copy=True).shards[3]
+        # the views are compacted when pickled, instead of pickling the storage of the whole dataset
+        self.assertLess(len(pickle.dumps(view_shard)), 1.1 * len(pickle.dumps(copied_shard)))
+        unpickled = pickle.loads(pickle.dumps(view_shard))
+        for index in range(100):
+            self.assertTrue(unpickled[index]["inputs"].equal(copied_shard[index]["inputs"]))
+            self.assertTrue(unpickled[index]["values"].equal(copied_shard[index]["values"]))
+
+    def test_shard_sparse_with_empty_chunks(self):
+        sparse = torch.zeros((20, 3))
+        sparse[2, 1], sparse[3, 0], sparse[17, 2], sparse[19, 1] = 1, 2, 3, 4
+        for copy in (True, False):
+            sharded = SafetensorsDataset.from_dict({"sparse": sparse.to_sparse()}).shard(chunk_size=5, copy=copy)
+            self.assertEqual([shard["sparse"]._nnz() for shard in sharded.shards], [2, 0, 0, 2])
+            self.assertEqual([shard["sparse"].shape for shard in sharded.shards], [(5, 3)] * 4)
+            for index in range(20):
+                self.assertTrue(sharded[index]["sparse"].to_dense().equal(sparse[index]))
@@ -0,0 +1,56 @@
+import io
+import os
+import pickle
+from multiprocessing.reduction import ForkingPickler
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+import torch.multiprocessing  # noqa, registers the reductions for tensors
+
+from safetensors_dataset import SafetensorsDataset, load_safetensors
+
+
+def fork_pickle(obj):
+    buffer = io.BytesIO()
+    ForkingPickler(buffer).dump(obj)
+    return pickle.loads(buffer.getvalue())
+
+
+class ShareMemoryTestCase(TestCase):
+    def setUp(self):
+        self.dataset = SafetensorsDataset.from_dict({
+            "dense": torch.randn((8, 4)),
+            "nested": torch.nested.nested_tensor([torch.randn(length) for length in range(1, 9)]),
+            "sparse": torch.randint(4, (8, 6)).eq(0).to_sparse().float(),
+        })
+
+    def test_share_memory(self):
+        self.dataset.share_memory()
+        self.assertTrue(self.dataset["dense"].is_shared())
+        self.assertTrue(self.dataset["nested"].values().is_shared())
+        self.assertTrue(self.dataset["sparse"]._values().is_shared())
+        self.assertTrue(self.dataset["sparse"]._indices().is_shared())
+
+    def test_pickle_nested_without_copy(self):
+        self.dataset.share_memory()
+        unpickled = fork_pickle(self.dataset)
+        self.assertEqual(self.dataset.keys(), unpickled.keys())
+        self.assertTrue(unpickled["nested"].values().is_shared())
+        for index in range(len(self.dataset)):
+            for key in self.dataset.keys():
+                self.assertTrue(self.dataset[index][key].to_dense().equal(unpickled[index][key].to_dense()))
+
+    def test_pickle_mmap_dataset(self):
+        path = Path.cwd() / "share_memory.safetensors"
+        try:
+            self.dataset.save_to_file(path)
+            dataset = load_safetensors(path, mmap=True)
+            state = pickle.dumps(dataset)
+            self.assertLess(len(state), 1024)
+            unpickled = pickle.loads(state)
+            self.assertTrue(unpickled["dense"].equal(self.dataset["dense"]))
+            self.assertTrue(unpickled["nested"].values().equal(self.dataset["nested"].values()))
+        finally:
+            if path.exists():
+                os.remove(path)
@@ -0,0 +1,98 @@
+import shutil
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+import torch.utils.data
+
+from safetensors_dataset import SafetensorsDataset, StreamingSafetensorsDataset
+from safetensors_dataset.dict_dataset import ShardedSafetensorsDataset
+
+
+class StreamingTestCase(TestCase):
+    def setUp(self):
+        self.directory = Path.cwd() / "streaming_test"
+        self.directory.mkdir(exist_ok=True)
+        self.dataset = SafetensorsDataset.from_dict({
+            "index": torch.arange(30),
+            "tokens": torch.nested.nested_tensor([torch.arange(length % 5 + 1) for length in range(30)]),
+            "sparse": torch.randint(3, (30, 4)).ne(0).to_sparse().float(),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_stream_rows(self):
+        rows = list(StreamingSafetensorsDataset(self.dataset, chunk_size=7))
+        self.assertEqual([int(row["index"]) for row in rows], list(range(30)))
+        for pos, row in enumerate(rows):
+            self.assertTrue(row["tokens"].equal(self.dataset[pos]["tokens"]))
+            self.assertTrue(row["sparse"].to_dense().equal(self.dataset[pos]["sparse"].to_dense()))
+
+    def test_stream_batches_from_shards(self):
+        path = self.directory / "sharded.safetensors"
+        ShardedSafetensorsDataset.concat([self.dataset.select(range(12)), self.dataset.select(range(12, 30))]) \
+            .save_to_file(path, separate_files=True)
+        stream = StreamingSafetensorsDataset(path, batch_size=4, chunk_size=8, columns=["index", "tokens"])
+        batches = list(stream)
+        self.assertEqual([batch["index"].size(0) for batch in batches], [4, 4, 4, 4, 4, 4, 4, 2])
+        self.assertEqual(torch.cat([batch["index"] for batch in batches]).tolist(), list(range(30)))
+        self.assertEqual(set(batches[0].keys()), {"index", "tokens", "tokens.lengths"})
+
+    def test_split_between_ranks_and_workers(self):
+        path = self.directory / "dataset.safetensors"
+        self.dataset.save_to_file(path)
+        seen = list()
+        for rank in range(2):
+            stream = StreamingSafetensorsDataset(path, batch_size=3, chunk_size=3, rank=rank, world_size=2)
+            loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=2)
+            seen.extend(torch.cat([batch["index"] for batch in loader]).tolist())
+        # every worker reads 8 rows, the last one is filled up with rows from the start
+        self.assertEqual(len(seen), 32)
+        self.assertEqual(set(seen), set(range(30)))
+
+    def test_same_number_of_batches_on_every_rank(self):
+        dataset = SafetensorsDataset.from_dict({"index": torch.arange(1000)})
+        for drop_last, expected in ((False, [32] * 10 + [14]), (True, [32] * 10)):
+            seen = list()
+            for rank in range(3):
+                stream = StreamingSafetensorsDataset(dataset, batch_size=32, rank=rank, world_size=3, drop_last=drop_last)
+                batches = list(stream)
+                self.assertEqual([batch["index"].numel() for batch in batches], expected)
+                seen.extend(torch.cat([batch["index"] for batch in batches]).tolist())
+            self.assertEqual(len(set(seen)), 1000 if not drop_last else 960)
+
+    def test_batches_across_shards(self):
+        sharded = ShardedSafetensorsDataset.concat([self.dataset.select(range(5)), self.dataset.select(range(5, 30))])
+        batches = list(StreamingSafetensorsDataset(sharded, batch_size=4, chunk_size=3))
+        self.assertEqual([batch["index"].numel() for batch in batches], [4] * 7 + [2])
+        self.assertEqual(torch.cat([batch["index"] for batch in batches]).tolist(), list(range(30)))
+        for batch in batches:
+            for row, index in enumerate(batch["index"].tolist()):
+                length = int(batch["tokens.lengths"][row])
+                self.assertTrue(batch["tokens"][row, :length].equal(self.dataset[index]["tokens"]))
+                self.assertTrue(batch["sparse"][row].to_dense().equal(self.dataset[index]["sparse"].to_dense()))
+
+    def test_chunks_skip_empty_shards(self):
+        sharded = ShardedSafetensorsDataset.concat([
+            self.dataset.select(range(0)), self.dataset.select(range(10)),
+            self.dataset.select(range(10, 10)), self.dataset.select(range(10, 30)),
+        ])
+        stream = StreamingSafetensorsDataset(sharded, chunk_size=8)
+        self.assertEqual(stream.chunks(), [(1, 0, 8), (1, 8, 10), (3, 0, 8), (3, 8, 16), (3, 16, 20)])
+        self.assertEqual([int(row["index"]) for row in stream], list(range(30)))
+
+    def test_rank_requires_world_size(self):
+        with self.assertRaises(ValueError):
+            StreamingSafetensorsDataset(self.dataset, rank=1)
+        with self.assertRaises(ValueError):
+            StreamingSafetensorsDataset(self.dataset, world_size=2)
+
+    def test_stream_with_transform(self):
+        dataset = self.dataset.with_transform(lambda batch: dict(batch, index=batch["index"] + 100))
+        rows = list(StreamingSafetensorsDataset(dataset, chunk_size=7))
+        self.assertEqual([int(row["index"]) for row in rows], list(range(100, 130)))
+        sharded = ShardedSafetensorsDataset.concat([self.dataset.select(range(12)), self.dataset.select(range(12, 30))])
+        batches = list(StreamingSafetensorsDataset(sharded.with_transform(lambda batch: {"index": batch["index"] * 2}), batch_size=8))
+        self.assertEqual(torch.cat([batch["index"] for batch in batches]).tolist(), list(range(0, 60, 2)))
+        self.assertEqual(batches[0].keys(), {"index"})
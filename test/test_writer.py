@@ -0,0 +1,78 @@
+import shutil
+from pathlib import Path
+from unittest import TestCase
+
+import torch
+
+from safetensors_dataset import SafetensorsDataset, SafetensorsDatasetWriter, load_safetensors
+
+
+class WriterTestCase(TestCase):
+    def setUp(self):
+        self.directory = Path.cwd() / "writer_test"
+        self.directory.mkdir(exist_ok=True)
+        self.inputs = torch.randn((20, 3))
+        self.tokens = [torch.randint(100, (length % 6 + 1,)) for length in range(20)]
+        self.matrices = [torch.randn((length % 3 + 1, 2)).to(torch.bfloat16) for length in range(20)]
+        self.sparse = torch.randint(3, (20, 5)).eq(0).to_sparse().float()
+        self.mask = torch.randint(3, (20, 4)).eq(0).to_sparse()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, writer: SafetensorsDatasetWriter):
+        for start in range(0, 20, 7):
+            end = min(start + 7, 20)
+            if start == 7:
+                for pos in range(start, end):
+                    writer.write({
+                        "inputs": self.inputs[pos],
+                        "tokens": self.tokens[pos],
+                        "matrices": self.matrices[pos],
+                        "sparse": self.sparse[pos],
+                        "mask": self.mask[pos],
+                    })
+                continue
+            writer.write_batch({
+                "inputs": self.inputs[start:end],
+                "tokens": torch.nested.nested_tensor(self.tokens[start:end]),
+                "matrices": self.matrices[start:end],
+                "sparse": self.sparse.index_select(0, torch.arange(start, end)),
+                "mask": self.mask.index_select(0, torch.arange(start, end)),
+            })
+
+    def check_dataset(self, dataset):
+        self.assertEqual(len(dataset), 20)
+        for pos in range(20):
+            item = dataset[pos]
+            self.assertTrue(item["inputs"].equal(self.inputs[pos]))
+            self.assertTrue(item["tokens"].equal(self.tokens[pos]))
+            self.assertTrue(item["matrices"].equal(self.matrices[pos]))
+            self.assertTrue(item["sparse"].to_dense().equal(self.sparse[pos].to_dense()))
+            self.assertTrue(item["mask"].to_dense().equal(self.mask[pos].to_dense()))
+
+    def test_write_file(self):
+        path = self.directory / "dataset.safetensors"
+        with SafetensorsDatasetWriter(path) as writer:
+            self.write(writer)
+        dataset = load_safetensors(path)
+        self.assertIsInstance(dataset, SafetensorsDataset)
+        self.assertTrue(dataset["tokens"].is_nested)
+        self.assertFalse(dataset["inputs"].is_nested)
+        self.assertEqual(list(self.directory.iterdir()), [path])
+        self.check_dataset(dataset)
+
+    def test_write_shards(self):
+        path = self.directory / "sharded.safetensors"
+        with SafetensorsDatasetWriter(path, shard_size=6) as writer:
+            self.write(writer)
+        dataset = load_safetensors(path)
+        self.assertEqual(dataset.shard_offsets.tolist(), [0, 6, 12, 18, 20])
+        self.check_dataset(dataset)
+
+    def test_write_mismatched_keys(self):
+        with self.assertRaises(ValueError):
+            with SafetensorsDatasetWriter(self.directory / "dataset.safetensors") as writer:
+                writer.write({"inputs": self.inputs[0]})
+                writer.write({"labels": self.inputs[0]})
+        self.assertEqual(list(self.directory.iterdir()), [])